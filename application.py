@@ -1,7 +1,7 @@
-from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QLabel
+from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QLabel, QTabWidget
 
 from test_area import TestArea
-from flows.assembled_electrical.flow import AssembledHexaboardFlow
+from flows.assembled_electrical.flow import AssembledHexaboardFlow, load_stations
 
 import logging
 import os
@@ -69,7 +69,18 @@ class MainWindow(QMainWindow):
 
 
         # Add Testing Area
-        layout.addWidget(TestArea(AssembledHexaboardFlow()))
+        # One per station, sharing this process's hardware connections and logs
+        stations = load_stations()
+        if len(stations) == 0:
+            layout.addWidget(TestArea(AssembledHexaboardFlow()))
+        else:
+            tabs = QTabWidget()
+            for station in stations:
+                overrides = dict(station)
+                name = overrides.pop("name")
+                logger.info(f"Adding station {name} with overrides {overrides}")
+                tabs.addTab(TestArea(AssembledHexaboardFlow(overrides), name), name)
+            layout.addWidget(tabs)
 
         # Finalization
         widget = QWidget()
@@ -0,0 +1,73 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger("broker")
+
+# Process-wide registry of hardware connections and polled values
+# Test slots running in the same process share one connection per
+# device, and one poll per interval, instead of each opening their own
+class HardwareBroker:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._handles = {}
+        self._cache = {}
+
+    # One lock per key, so slow connects don't block unrelated devices
+    def _key_lock(self, key) -> threading.Lock:
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    # Get the shared handle for key, creating it with factory() if no slot holds it yet
+    def acquire(self, key, factory) -> object:
+        with self._key_lock(key):
+            if key in self._handles:
+                entry = self._handles[key]
+                entry["users"] += 1
+                logger.debug(f"Reusing {key}, now used by {entry['users']} slots")
+                return entry["handle"]
+
+            handle = factory()
+            self._handles[key] = {"handle": handle, "users": 1}
+            logger.info(f"Opened shared handle for {key}")
+            return handle
+
+    # Whether a handle for key is currently open
+    def holds(self, key) -> bool:
+        return key in self._handles
+
+    # Drop one user of key. The last user closes the handle with closer(handle)
+    def release(self, key, closer=None) -> None:
+        with self._key_lock(key):
+            if key not in self._handles:
+                logger.warning(f"Released {key}, but it isn't held")
+                return
+
+            entry = self._handles[key]
+            entry["users"] -= 1
+            if entry["users"] > 0:
+                logger.debug(f"Released {key}, still used by {entry['users']} slots")
+                return
+
+            del self._handles[key]
+            logger.info(f"Closing shared handle for {key}")
+            if closer is not None:
+                closer(entry["handle"])
+
+    # Return the value of fetch(), computing it at most once per ttl seconds across all slots
+    def cached(self, key, ttl: float, fetch) -> object:
+        with self._key_lock(("cached", key)):
+            if key in self._cache:
+                timestamp, value = self._cache[key]
+                if time.monotonic() - timestamp < ttl:
+                    return value
+
+            value = fetch()
+            self._cache[key] = (time.monotonic(), value)
+            return value
+
+
+broker = HardwareBroker()
@@ -0,0 +1,433 @@
+"""Archives of test output, made in the background
+
+Cleanup queues each finished test here, and the next board's test can start while it
+is compressed. Queued jobs are kept in a file, so ones cut short by a restart are
+redone when the queue next starts. A test can also be archived while it runs, each
+file as it is closed (see StreamingArchive), leaving cleanup only the trailer to write.
+
+Archives are either .tar.gz, or a tar stream in a blosc2 frame (.tar.b2frame)
+compressed with zstd across threads. To unpack one of those:
+
+    python -m flows.assembled_electrical.archiver data/<dut>.tar.b2frame <out_dir>
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import time
+
+import blosc2
+import pyinotify
+
+logger = logging.getLogger("Cleanup")
+
+# Raw data only: logs and analysis (eg. plots) are left out
+def filter_no_logs(info: tarfile.TarInfo) -> tarfile.TarInfo:
+    if info.name.endswith(".raw") or info.name.endswith(".log") or info.name.endswith(".png"):
+        return None
+    return info
+
+extensions = { "gzip": ".tar.gz", "blosc2": ".tar.b2frame" }
+
+def archive_path(data_dir: str, test_id: str, codec: str = "gzip") -> str:
+    return os.path.join(data_dir, f"{ test_id }{ extensions[codec] }")
+
+# File-like writer of a blosc2 frame, compressing whole chunks across threads as they fill
+class Blosc2Writer(io.RawIOBase):
+    def __init__(self, path: str, level: int = 5, threads: int = None, chunk_size: int = 8 * 1024 * 1024) -> None:
+        super().__init__()
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._schunk = blosc2.SChunk(chunksize=chunk_size, urlpath=path, contiguous=True, mode="w", cparams={
+            "codec": blosc2.Codec.ZSTD,
+            "clevel": level,
+            "nthreads": threads if threads is not None else os.cpu_count(),
+            "typesize": 1,
+        })
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            self._schunk.append_data(bytes(self._buffer[:self._chunk_size]))
+            del self._buffer[:self._chunk_size]
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed and self._schunk is not None:
+            if len(self._buffer) > 0:
+                self._schunk.append_data(bytes(self._buffer))
+            self._buffer = bytearray()
+            self._schunk = None
+        super().close()
+
+# Reader of a blosc2 frame written by Blosc2Writer, one chunk at a time
+class Blosc2Reader(io.RawIOBase):
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self._schunk = blosc2.open(path)
+        self._chunk = 0
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while len(self._buffer) == 0 and self._chunk < self._schunk.nchunks:
+            self._buffer = self._schunk.decompress_chunk(self._chunk)
+            self._chunk += 1
+        count = min(len(target), len(self._buffer))
+        target[:count] = self._buffer[:count]
+        self._buffer = self._buffer[count:]
+        return count
+
+# A tar stream to path with codec, and the blosc2 writer under it to close after it, if any
+def open_tar(path: str, codec: str, level: int, threads: int) -> tuple[tarfile.TarFile, Blosc2Writer]:
+    if codec == "blosc2":
+        writer = Blosc2Writer(path, level, threads)
+        return tarfile.open(fileobj=writer, mode="w|"), writer
+    return tarfile.open(path, "w:gz", compresslevel=level), None
+
+# Compresses all test data to an archive in data_dir, named after the test
+# This excludes analysis (eg. plots) and only includes raw data
+# progress is called with the bytes read so far and the total, as each file is added
+def archive_test(data_dir: str, test_id: str, delete_uncompressed: False, codec: str = "gzip",
+                 level: int = 6, threads: int = None, progress=None) -> str:
+    logger.info(f"Archiving { test_id }")
+    path = archive_path(data_dir, test_id, codec)
+
+    # Check if we've done this before
+    if os.path.exists(path):
+        logger.warning(f"File { path } already exists! Skipping...")
+        return path
+
+    test_dir = os.path.join(data_dir, test_id)
+    files = sorted(os.listdir(test_dir)) if os.path.exists(test_dir) else []
+    sizes = { file: os.path.getsize(os.path.join(test_dir, file)) for file in files if os.path.isfile(os.path.join(test_dir, file)) }
+    total = sum(sizes.values())
+    done = 0
+
+    # Written beside the archive and moved over it, so an archive that exists is complete
+    tar, writer = open_tar(path + ".partial", codec, level, threads)
+    with tar:
+        logger.debug(f"Writing final output")
+
+        # Add Files
+        for file in files:
+            logger.debug(f"Writing { file }")
+            tar.add(os.path.join(test_dir, file), file, filter=filter_no_logs)
+            done += sizes[file] if file in sizes else 0
+            if progress is not None:
+                progress(done, total)
+    if writer is not None:
+        writer.close()
+    os.replace(path + ".partial", path)
+
+    if delete_uncompressed:
+        logger.info("Removing uncompressed data")
+        shutil.rmtree(test_dir)
+    return path
+
+# Calls back with the path of each file closed after writing, or moved in
+class ClosedFileHandler(pyinotify.ProcessEvent):
+    def my_init(self, callback=None) -> None:
+        self._callback = callback
+
+    def process_IN_CLOSE_WRITE(self, event) -> None:
+        self._callback(event.pathname)
+
+    def process_IN_MOVED_TO(self, event) -> None:
+        self._callback(event.pathname)
+
+# Archive of a test written while it runs. inotify reports each file of the test's
+# directory as it is closed, and it goes into the archive then, so finishing only adds
+# what was missed (files never closed, or written before watching) and the trailer
+# A file written again after it was added is added again, and the later copy wins on extraction
+class StreamingArchive:
+    # added is called with the bytes added so far, after each file
+    def __init__(self, data_dir: str, test_id: str, codec: str = "gzip", level: int = 6, threads: int = None, added=None) -> None:
+        self.data_dir = data_dir
+        self.test_id = test_id
+        self.path = archive_path(data_dir, test_id, codec)
+        self.bytes_added = 0
+        # Why a file couldn't be added, after which the archive can't be trusted
+        self.broken = None
+        self._codec = codec
+        self._level = level
+        self._threads = threads
+        self._test_dir = os.path.join(data_dir, test_id)
+        self._lock = threading.Lock()
+        self._added = {}
+        self._added_callback = added
+
+        if not os.path.exists(self._test_dir):
+            os.makedirs(self._test_dir)
+        self._tar, self._writer = open_tar(self.path + ".partial", codec, level, threads)
+
+        self._watches = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(self._watches, ClosedFileHandler(callback=self.add))
+        self._notifier.daemon = True
+        self._notifier.start()
+        # Directories made later are watched too, which needs IN_CREATE
+        self._watches.add_watch(self._test_dir, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE,
+                                rec=True, auto_add=True)
+        logger.info(f"Streaming archive of {test_id} to {self.path}")
+
+    # Add a file of the test's directory, unless it's unchanged since it was added
+    def add(self, path: str) -> None:
+        with self._lock:
+            if self._tar is None or self.broken is not None or not os.path.isfile(path):
+                return
+            name = os.path.relpath(path, self._test_dir)
+            stat = os.stat(path)
+            if name in self._added and self._added[name] == (stat.st_mtime_ns, stat.st_size):
+                return
+
+            logger.debug(f"Writing { name }")
+            try:
+                self._tar.add(path, name, filter=filter_no_logs)
+            except Exception as e:
+                logger.critical(f"Could not add {name} to the archive of {self.test_id}, it will be archived from scratch: {e}")
+                self.broken = f"{name}: {e}"
+                return
+            self._added[name] = (stat.st_mtime_ns, stat.st_size)
+            self.bytes_added += stat.st_size
+            if self._added_callback is not None:
+                self._added_callback(self.bytes_added)
+
+    def _stop(self) -> None:
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+    # Add anything missed, write the trailer and move the archive into place
+    # progress is called with the bytes checked so far and the total
+    # If a file couldn't be added, the test is archived from scratch instead
+    def finish(self, delete_uncompressed: bool, progress=None) -> str:
+        self._stop()
+        if self.broken is None:
+            self._finish_files(progress)
+        if self.broken is not None:
+            logger.warning(f"Streamed archive of {self.test_id} is incomplete ({self.broken}), archiving it from scratch")
+            self.abort()
+            return archive_test(self.data_dir, self.test_id, delete_uncompressed, self._codec, self._level, self._threads, progress)
+
+        with self._lock:
+            self._tar.close()
+            if self._writer is not None:
+                self._writer.close()
+            self._tar = None
+        os.replace(self.path + ".partial", self.path)
+        logger.info(f"Finished archive of {self.test_id}, {len(self._added)} files")
+
+        if delete_uncompressed:
+            logger.info("Removing uncompressed data")
+            shutil.rmtree(self._test_dir)
+        return self.path
+
+    # Add every file of the test's directory, catching any the watches missed
+    def _finish_files(self, progress) -> None:
+        paths = []
+        for directory, _, files in os.walk(self._test_dir):
+            paths += [os.path.join(directory, file) for file in sorted(files)]
+        sizes = [os.path.getsize(path) for path in paths]
+        done = 0
+        for path, size in zip(paths, sizes):
+            self.add(path)
+            done += size
+            if progress is not None:
+                progress(done, sum(sizes))
+
+    # Stop without an archive, eg. to archive the test from scratch instead
+    def abort(self) -> None:
+        self._stop()
+        with self._lock:
+            if self._tar is not None:
+                # A broken archive may not close cleanly, and is thrown away anyway
+                try:
+                    self._tar.close()
+                    if self._writer is not None:
+                        self._writer.close()
+                except Exception as e:
+                    logger.warning(f"Could not close the archive of {self.test_id}: {e}")
+                self._tar = None
+        if os.path.exists(self.path + ".partial"):
+            os.remove(self.path + ".partial")
+
+def extract(path: str, out_dir: str) -> None:
+    if path.endswith(extensions["blosc2"]):
+        with tarfile.open(fileobj=Blosc2Reader(path), mode="r|") as tar:
+            tar.extractall(out_dir)
+    else:
+        with tarfile.open(path) as tar:
+            tar.extractall(out_dir)
+
+# Archives made one at a time on a background thread, oldest first
+# Jobs waiting or running are written to state_path, and picked up again on restart
+# archived is called with the path of each archive once made, eg. to upload it
+# With a blob_store, each test's artifacts are stored in it first, as archives leave out plots
+class ArchiveQueue:
+    def __init__(self, state_path: str, codec: str = "blosc2", level: int = 5, threads: int = None,
+                 archived=None, blob_store: object = None) -> None:
+        if codec not in extensions:
+            logger.critical(f"Unknown archive codec {codec}, using gzip")
+            codec = "gzip"
+        self._state_path = state_path
+        self._codec = codec
+        self._level = level
+        self._threads = threads
+        self._archived = archived
+        self._blob_store = blob_store
+        self._lock = threading.Condition()
+        self._jobs = []
+        self._status = {}
+        self._streams = {}
+        self.version = 0
+
+        if os.path.exists(state_path):
+            with open(state_path) as fin:
+                self._jobs = json.load(fin)
+        for job in self._jobs:
+            logger.info(f"Resuming archive of {job['test_id']}")
+            self._set_status(job["test_id"], { "state": "Queued" })
+
+        self._thread = threading.Thread(target=self.run, name="archive-queue", daemon=True)
+        self._thread.start()
+
+    def _save(self) -> None:
+        directory = os.path.dirname(self._state_path)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self._state_path + ".tmp", "w") as fout:
+            json.dump(self._jobs, fout)
+        os.replace(self._state_path + ".tmp", self._state_path)
+
+    def _set_status(self, test_id: str, status: dict) -> None:
+        self._status[test_id] = { **self._status.get(test_id, {}), **status }
+        self.version += 1
+
+    # Start archiving a test's output as it is written, in the queue's format
+    # Enqueueing the test later finishes this archive instead of making one from scratch
+    # A stream already running for the test (eg. from a test that was restarted) is aborted
+    def start_stream(self, data_dir: str, test_id: str) -> StreamingArchive:
+        with self._lock:
+            previous = self._streams.pop(test_id, None)
+            self._set_status(test_id, { "state": "Streaming", "done": 0 })
+        if previous is not None:
+            logger.warning(f"Replacing the running archive stream of {test_id}")
+            previous.abort()
+        stream = StreamingArchive(data_dir, test_id, self._codec, self._level, self._threads,
+                                  lambda done: self._update(test_id, { "done": done }))
+        with self._lock:
+            self._streams[test_id] = stream
+        return stream
+
+    # Queue a test's output to be archived, returning at once
+    # After a restart, a streamed test is archived from scratch, as its stream is gone
+    # Without archive, only the test's artifacts are stored (with a blob_store)
+    def enqueue(self, data_dir: str, test_id: str, delete_uncompressed: bool, archive: bool = True) -> None:
+        with self._lock:
+            if any(job["test_id"] == test_id for job in self._jobs):
+                logger.warning(f"Archive of {test_id} is already queued")
+                return
+            self._jobs.append({ "data_dir": data_dir, "test_id": test_id, "delete_uncompressed": delete_uncompressed,
+                                "archive": archive })
+            self._save()
+            self._set_status(test_id, { "state": "Queued" })
+            self._lock.notify()
+
+    def run(self) -> None:
+        while True:
+            with self._lock:
+                while len(self._jobs) == 0:
+                    self._lock.wait()
+                job = self._jobs[0]
+
+                stream = self._streams.pop(job["test_id"], None)
+
+            test_id = job["test_id"]
+            path = archive_path(job["data_dir"], test_id, self._codec)
+            started = time.time()
+            progress = lambda done, total: self._update(test_id, { "done": done, "total": total })
+            try:
+                if self._blob_store is not None:
+                    self._update(test_id, { "state": "Storing Artifacts" })
+                    self._blob_store.store_test(job["data_dir"], test_id)
+                # Jobs from before archive was an option are archived
+                if "archive" in job and not job["archive"]:
+                    if stream is not None:
+                        stream.abort()
+                    self._update(test_id, { "state": "Stored", "seconds": time.time() - started })
+                else:
+                    self._update(test_id, { "state": "Archiving", "done": 0, "total": 0 })
+                    if stream is not None:
+                        stream.finish(job["delete_uncompressed"], progress)
+                    else:
+                        # Left over from a run that was cut short
+                        if os.path.exists(path + ".partial"):
+                            os.remove(path + ".partial")
+                        archive_test(job["data_dir"], test_id, job["delete_uncompressed"], self._codec, self._level, self._threads, progress)
+                    self._update(test_id, { "state": "Done", "size": os.path.getsize(path), "seconds": time.time() - started })
+                    logger.info(f"Archived {test_id} to {path} in {time.time() - started:.1f}s")
+                    if self._archived is not None:
+                        self._archived(path)
+            except Exception as e:
+                logger.critical(f"Could not archive {test_id}: {e}")
+                self._update(test_id, { "state": "Failed", "error": str(e) })
+
+            with self._lock:
+                self._jobs.remove(job)
+                self._save()
+
+    def _update(self, test_id: str, status: dict) -> None:
+        with self._lock:
+            self._set_status(test_id, status)
+
+    # Status of each test archived or queued since the queue started, oldest first
+    def status(self) -> dict:
+        with self._lock:
+            return { test_id: dict(status) for test_id, status in self._status.items() }
+
+    # Wait until every queued job is done, or timeout seconds pass
+    def join(self, timeout: float = None) -> bool:
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                if len(self._jobs) == 0:
+                    return True
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.1)
+
+# One queue per state file, shared by every station in the process
+loaded = {}
+loaded_lock = threading.Lock()
+
+# archived and blob_store only apply to the call that makes the queue
+def get_archive_queue(state_path: str, settings: dict = None, archived=None, blob_store: object = None) -> ArchiveQueue:
+    settings = settings if settings is not None else {}
+    with loaded_lock:
+        if state_path not in loaded:
+            loaded[state_path] = ArchiveQueue(state_path,
+                settings["codec"] if "codec" in settings else "blosc2",
+                settings["level"] if "level" in settings else 5,
+                settings["threads"] if "threads" in settings else None,
+                archived, blob_store)
+        return loaded[state_path]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Unpack a test archive")
+    parser.add_argument("archive")
+    parser.add_argument("out_dir")
+    args = parser.parse_args()
+    extract(args.archive, args.out_dir)
+
+if __name__ == "__main__":
+    main()
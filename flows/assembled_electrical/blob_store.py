@@ -0,0 +1,186 @@
+"""Content-addressed store of test artifacts: plots, configs and text dumps
+
+Each artifact is kept once, under the hash of its contents, however many tests made it,
+and found by its hash in O(1) from its path alone. Each test gets a manifest of its
+artifacts' paths and hashes, kept in the store and beside the test's output (so it is
+archived with it). PNGs are hashed by their pixels, so plots that differ only in their
+metadata (eg. a creation time) are stored once, as the first of them seen.
+
+From the repository root:
+
+    python -m flows.assembled_electrical.blob_store --store data/blobs restore <dut> <out_dir>
+    python -m flows.assembled_electrical.blob_store --store data/blobs stats
+"""
+
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+from PIL import Image
+
+logger = logging.getLogger("Cleanup")
+
+artifact_extensions = [".png", ".yaml", ".yml", ".txt", ".json", ".csv"]
+
+# Files of the test's output that aren't artifacts of it
+skipped_files = ["artifacts.json", "output.msgpack", "journal.ndjson", "log.log"]
+
+def file_hash(path: str, block_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Hash of a PNG's mode, size and pixels, ignoring how it was encoded and its metadata
+# Palette images, and images with a transparent colour, are hashed by the colours they
+# show, as their pixels alone are palette indices or leave out which one is transparent
+# Falls back to the file's bytes if it can't be decoded
+def pixel_hash(path: str) -> str:
+    try:
+        with Image.open(path) as opened:
+            image = opened
+            if image.mode in ("P", "PA") or "transparency" in image.info:
+                image = image.convert("RGBA")
+            digest = hashlib.sha256(f"pixels:{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+            digest.update(image.tobytes())
+            return digest.hexdigest()
+    except Exception as e:
+        logger.warning(f"Could not read {path} as an image, hashing its bytes: {e}")
+        return file_hash(path)
+
+def content_hash(path: str) -> str:
+    return pixel_hash(path) if path.lower().endswith(".png") else file_hash(path)
+
+class BlobStore:
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "manifests"), exist_ok=True)
+
+    # Blobs are fanned out over two levels of directories by the start of their hash
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest[2:4], digest)
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.blob_path(digest))
+
+    # Store a file, returning its hash and whether it was new to the store
+    def put(self, path: str) -> tuple[str, bool]:
+        digest = content_hash(path)
+        target = self.blob_path(digest)
+        if os.path.exists(target):
+            return digest, False
+
+        # Copied beside the blob and moved over it, so a blob that exists is whole
+        # even with several stations storing the same file at once
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temporary = f"{target}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(path, temporary)
+        os.replace(temporary, target)
+        return digest, True
+
+    def manifest_path(self, test_id: str) -> str:
+        return os.path.join(self.root, "manifests", f"{test_id}.json")
+
+    # Store every artifact of a test's output, and write its manifest
+    def store_test(self, data_dir: str, test_id: str) -> dict:
+        test_dir = os.path.join(data_dir, test_id)
+        if not os.path.exists(test_dir):
+            logger.warning(f"No output of {test_id} to store artifacts from")
+            return None
+        files = {}
+        stored_bytes = 0
+        new_bytes = 0
+        for directory, _, names in os.walk(test_dir):
+            for name in sorted(names):
+                path = os.path.join(directory, name)
+                relative = os.path.relpath(path, test_dir)
+                if relative in skipped_files or os.path.splitext(name)[1].lower() not in artifact_extensions:
+                    continue
+
+                digest, new = self.put(path)
+                size = os.path.getsize(path)
+                files[relative] = { "hash": digest, "size": size }
+                stored_bytes += size
+                new_bytes += size if new else 0
+
+        manifest = {
+            "test_id": test_id,
+            "time": datetime.datetime.now().isoformat(),
+            "files": files,
+            "bytes": stored_bytes,
+            "new_bytes": new_bytes,
+        }
+        with open(self.manifest_path(test_id) + ".tmp", "w") as fout:
+            json.dump(manifest, fout, indent=2)
+        os.replace(self.manifest_path(test_id) + ".tmp", self.manifest_path(test_id))
+        with open(os.path.join(test_dir, "artifacts.json"), "w") as fout:
+            json.dump(manifest, fout, indent=2)
+
+        logger.info(f"Stored {len(files)} artifacts of {test_id}, {new_bytes} of {stored_bytes} bytes new to the store")
+        return manifest
+
+    def load_manifest(self, test_id: str) -> dict:
+        with open(self.manifest_path(test_id)) as fin:
+            return json.load(fin)
+
+    # Put a test's artifacts back where they were, under out_dir
+    def restore(self, test_id: str, out_dir: str) -> int:
+        manifest = self.load_manifest(test_id)
+        for relative, entry in manifest["files"].items():
+            target = os.path.join(out_dir, relative)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(self.blob_path(entry["hash"]), target)
+        return len(manifest["files"])
+
+    # Bytes referenced by every manifest, and bytes actually stored
+    def stats(self) -> dict:
+        referenced = 0
+        manifests = glob.glob(os.path.join(self.root, "manifests", "*.json"))
+        for path in manifests:
+            with open(path) as fin:
+                referenced += json.load(fin)["bytes"]
+        blobs = glob.glob(os.path.join(self.root, "objects", "*", "*", "*"))
+        stored = sum(os.path.getsize(path) for path in blobs)
+        return { "tests": len(manifests), "blobs": len(blobs), "referenced_bytes": referenced, "stored_bytes": stored }
+
+# One store per directory, shared by every station in the process
+loaded = {}
+loaded_lock = threading.Lock()
+
+def get_blob_store(root: str) -> BlobStore:
+    with loaded_lock:
+        if root not in loaded:
+            loaded[root] = BlobStore(root)
+        return loaded[root]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Restore and inspect stored test artifacts")
+    parser.add_argument("--store", default="data/blobs", help="Store directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    restore = commands.add_parser("restore", help="Copy a test's artifacts out of the store")
+    restore.add_argument("test_id")
+    restore.add_argument("out_dir")
+    commands.add_parser("stats", help="How much the store saves")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    store = BlobStore(args.store)
+
+    if args.command == "restore":
+        print(f"Restored {store.restore(args.test_id, args.out_dir)} files")
+    else:
+        stats = store.stats()
+        print(f"{stats['tests']} tests, {stats['blobs']} blobs: {stats['referenced_bytes']} bytes referenced, {stats['stored_bytes']} stored")
+
+if __name__ == "__main__":
+    main()
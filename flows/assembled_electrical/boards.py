@@ -1,3 +1,5 @@
+# A board may set 'reference', the directory of its reference arrays relative to this file
+# Without one, references/<board type> is used. See custom_steps/reference.py
 boards = {
     # Low Density
     'ld-full': {
@@ -0,0 +1,85 @@
+import logging
+import re
+
+import numpy as np
+
+logger = logging.getLogger("tests")
+
+# Results of one ROC half are keyed like "3:1:NOISE"
+half_key = re.compile(r"^(\d+):(\d+):(.+)$")
+
+# Columnar form of the per-ROC/per-half results of a test
+# "halves" is a structured array of shape (rocs, 2) with one field per scalar result,
+# NaN where a half didn't report it. "channels" holds one (rocs, 2, channels) array
+# per result that is a list of per-channel values
+def to_arrays(returned_data: dict) -> dict:
+    scalars = {}
+    channels = {}
+    rocs = 0
+    for key, value in returned_data.items():
+        match = half_key.match(str(key))
+        if match is None:
+            continue
+        roc, half, field = int(match.group(1)), int(match.group(2)), match.group(3)
+        rocs = max(rocs, roc + 1)
+
+        if isinstance(value, (list, tuple, np.ndarray)):
+            channels.setdefault(field, {})[(roc, half)] = value
+        elif isinstance(value, (bool, int, float, np.number)):
+            scalars.setdefault(field, {})[(roc, half)] = value
+
+    # Counts stay integers when every half has one, anything else is a float with NaN for gaps
+    def field_type(values):
+        integral = all(isinstance(value, (bool, int, np.integer)) for value in values.values())
+        return np.int64 if integral and len(values) == rocs * 2 else np.float64
+
+    dtype = [(field, field_type(scalars[field])) for field in sorted(scalars)]
+    halves = np.zeros((rocs, 2), dtype=dtype)
+    for field, _ in dtype:
+        if halves.dtype[field] == np.float64:
+            halves[field] = np.nan
+    for field, values in scalars.items():
+        for (roc, half), value in values.items():
+            halves[field][roc, half] = value
+
+    channel_arrays = {}
+    for field, values in channels.items():
+        width = max(len(value) for value in values.values())
+        array = np.full((rocs, 2, width), np.nan)
+        for (roc, half), value in values.items():
+            array[roc, half, :len(value)] = value
+        channel_arrays[field] = array
+
+    return { "halves": halves, "channels": channel_arrays }
+
+# The test data key the arrays of a test are stored under
+# Underscored, so they stay out of output.json, which keeps the flat keys
+def arrays_key(prefix: str) -> str:
+    return f"_ARRAYS:{prefix}"
+
+def field_or_nan(halves: np.ndarray, field: str) -> np.ndarray:
+    if halves.dtype.names is not None and field in halves.dtype.names:
+        return halves[field]
+    return np.full(halves.shape, np.nan)
+
+# Table rows of "roc:half" followed by the given fields, for every half
+def half_rows(halves: np.ndarray, fields: list[str]) -> list[list]:
+    columns = [field_or_nan(halves, field).ravel().tolist() for field in fields]
+    ids = [f"{roc}:{half}" for roc in range(halves.shape[0]) for half in range(halves.shape[1])]
+    return [list(row) for row in zip(ids, *columns)]
+
+# Totals and worst halves of a pedestal run
+def summarize_pedestal_run(halves: np.ndarray) -> dict:
+    dead = field_or_nan(halves, "NUMBER_CHANNELS_NOISE_AT0")
+    noisy = field_or_nan(halves, "NUMBER_CHANNELS_NOISE_MORE2")
+    noise = field_or_nan(halves, "NOISE")
+
+    worst = np.unravel_index(np.nanargmax(noise), noise.shape) if not np.all(np.isnan(noise)) else None
+    return {
+        "dead": int(np.nansum(dead)),
+        "noisy": int(np.nansum(noisy)),
+        "halves_with_dead": int(np.count_nonzero(dead > 0)),
+        "halves_with_noisy": int(np.count_nonzero(noisy > 0)),
+        "noisiest": f"{worst[0]}:{worst[1]}" if worst is not None else None,
+        "max_noise": float(np.nanmax(noise)) if worst is not None else None,
+    }
@@ -1,46 +1,33 @@
+import datetime
 import logging
-import tarfile
-import shutil
 import os
-import json
+import threading
 
 import log_utils
+import serialization
+
+from ..results_db import ResultsDB, test_record
+from ..fleet_stats import get_fleet_stats
+from ..archiver import archive_test, get_archive_queue
+from ..uploader import get_uploader
+from ..blob_store import get_blob_store
 
 logger = logging.getLogger("Cleanup")
 
-# Compression Util
-def filter_no_logs(info: tarfile.TarInfo) -> tarfile.TarInfo:
-    if info.name.endswith(".raw") or info.name.endswith(".log") or info.name.endswith(".png"):
+# Full Cleanup of all tests
+# Start archiving the test's output as the tests write it, finished by cleanup
+def start_archive(out_dir: str, archive_settings: dict, data: object) -> object:
+    if archive_settings is None:
+        logger.warning("No archive section in the config, the test will be archived by cleanup instead")
         return None
-    return info
-
-# Compresses all test data to a tar.gz
-# This excludes analysis (eg. plots) and only includes raw data
-def archive_test(data_dir: str, test_id: str, delete_uncompressed: False) -> None:
-    logger.info(f"Archiving { test_id }")
-    archive_path = os.path.join(data_dir, f"{ test_id }.tar.gz")
-    
-    # Check if we've done this before
-    if os.path.exists(archive_path):
-        logger.warning(f"File { archive_path } already exists! Skipping...")
-        return
-    
-    # Create archive
-    with tarfile.open(archive_path, "w:gz") as tar:
-        logger.debug(f"Writing final output")
-
-        # Add Files
-        if os.path.exists(os.path.join(data_dir, test_id)):
-            for file in os.listdir(os.path.join(data_dir, test_id)):
-                logger.debug(f"Writing { file }")
-                tar.add(os.path.join(data_dir, test_id, file), file, filter=filter_no_logs)
-    
-    if delete_uncompressed:
-        logger.info("Removing uncompressed data")
-        shutil.rmtree(os.path.join(data_dir, test_id))
+    return get_archive_queue(archive_settings["queue"], archive_settings).start_stream(out_dir, data["dut"])
 
-# Full Cleanup of all tests
-def cleanup(out_dir: str, archive: bool, data: object) -> None:
+# Artifacts are stored and archives made in the background: by the queue with archive_settings
+# (the archive section of the config), else on a thread of their own
+# With upload_settings (the upload section), the test's record and archive are queued for upload
+# With blob_store, the test's artifacts are kept there, by the archive queue when there is one
+def cleanup(out_dir: str, archive: bool, archive_settings: dict, upload_settings: dict, blob_store: str,
+            results_db: str, fleet_stats: str, data: object) -> None:
     dut = data["dut"]
     logger.debug(f"Using dut {dut}")
 
@@ -48,23 +35,83 @@ def cleanup(out_dir: str, archive: bool, data: object) -> None:
     if not os.path.exists(os.path.join(out_dir, dut)):
         os.mkdir(os.path.join(out_dir, dut))
 
-    # Write output json
-    filtered_data = {}
+    # Every step's results are already in the journal: leave it as one record, and
+    # write the output (with every step's debug record) from it, as msgpack (see serialization.py)
+    # Without a journal, or anything it's missing, the output comes from memory
+    in_memory = {}
     for key in data:
         if key.startswith("_"):
             continue
-        filtered_data[key] = data[key]
+        in_memory[key] = data[key]
+
+    filtered_data = in_memory
+    if "_journal" in data:
+        try:
+            filtered_data = serialization.from_json(data["_journal"].compact())
+            missing = [key for key in in_memory if key not in filtered_data]
+            if len(missing) > 0:
+                logger.warning(f"The journal is missing {missing}, taking them from memory")
+                filtered_data.update({ key: in_memory[key] for key in missing })
+        except Exception as e:
+            logger.critical(f"Could not compact the journal {data['_journal'].path}, writing the output from memory: {e}")
+            filtered_data = in_memory
 
-    data_text = json.dumps(filtered_data, indent=2)
+    output_path = os.path.join(out_dir, dut, "output.msgpack")
+    serialization.dump({ "data": filtered_data, "debug": data["_debug"] if "_debug" in data else {} }, output_path)
 
-    with open(os.path.join(out_dir, dut, "output.json"), "w") as file:
-        file.write(data_text)
+    # Add to the results database
+    if results_db is not None:
+        try:
+            db = ResultsDB(results_db)
+            db.insert(filtered_data, data["_board"] if "_board" in data else None, output_path)
+            db.close()
+        except Exception as e:
+            logger.critical(f"Could not add the test to the results database {results_db}: {e}")
+
+    # Queue the test's results to be uploaded, returning at once
+    if upload_settings is not None:
+        try:
+            get_uploader(upload_settings).enqueue_record(test_record(filtered_data, data["_board"] if "_board" in data else None,
+                                                                     datetime.datetime.now().isoformat()))
+        except Exception as e:
+            logger.critical(f"Could not queue the test's results for upload: {e}")
+
+    # Add to the statistics of its board type
+    if fleet_stats is not None and "_board" in data:
+        try:
+            get_fleet_stats(fleet_stats).update(data["_board"], filtered_data)
+        except Exception as e:
+            logger.critical(f"Could not add the test to the fleet statistics {fleet_stats}: {e}")
 
     logger.critical("This will the the final log for this test - further ones will be wiped")
     with open(os.path.join(out_dir, dut, "log.log"), "w") as file:
-        file.write("\n".join(log_utils.logs))
+        file.write("\n".join(log_utils.get_logs(data["_slot"] if "_slot" in data else None)))
+
+    # Store artifacts and archive in the background, so neither counts against the step's timeout
+    # A streamed archive is finished by the queue, with nothing but what's left to add
+    if not archive and "_archive" in data and data["_archive"] is not None:
+        data["_archive"].abort()
+    if archive_settings is not None:
+        if archive or blob_store is not None:
+            logger.info("Queueing test to be archived" if archive else "Queueing test's artifacts to be stored")
+            get_archive_queue(archive_settings["queue"], archive_settings).enqueue(out_dir, dut, True, archive)
+    elif archive or blob_store is not None:
+        threading.Thread(target=store_and_archive, args=(out_dir, dut, archive, upload_settings, blob_store),
+                         name=f"archive-{dut}", daemon=True).start()
+
+# Without an archive queue: store the test's artifacts, then archive it, on a thread of its own
+def store_and_archive(out_dir: str, dut: str, archive: bool, upload_settings: dict, blob_store: str) -> None:
+    if blob_store is not None:
+        try:
+            get_blob_store(blob_store).store_test(out_dir, dut)
+        except Exception as e:
+            logger.critical(f"Could not store the test's artifacts in {blob_store}: {e}")
 
-    # Archive Data
     if archive:
         logger.info("Archiving tests")
-        archive_test(out_dir, dut, True)
+        try:
+            path = archive_test(out_dir, dut, True)
+            if upload_settings is not None:
+                get_uploader(upload_settings).enqueue_file(path)
+        except Exception as e:
+            logger.critical(f"Could not archive {dut}: {e}")
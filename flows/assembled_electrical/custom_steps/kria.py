@@ -1,3 +1,4 @@
+import os
 import time
 import logging
 import traceback
@@ -5,29 +6,56 @@ import traceback
 import paramiko
 
 from objects import TestFinishedBehavior
+from .kria_session import KriaSession
+from .kria_agent_client import KriaAgentClient
 
 logger = logging.getLogger("kria")
 
 pins = [52, 53, 57]
+services = ["daq-server", "i2c-server"]
 
 # Try and connect to the Kria every X s.
-def wait_for_kria(address: str, delay: int, data: object) -> None:
+# The control agent (remote/kria_agent.py) is used when it answers on agent_port,
+# with SSH kept as the fallback; either one alone is enough
+# The agent's shared secret, if it has one, is taken from KRIA_AGENT_SECRET
+def wait_for_kria(address: str, agent_port: int, delay: int, data: object) -> None:
     while True:
         logger.debug(f"Attempting to connect to the kria at {address}")
+        agent = None
         try:
-            client = paramiko.client.SSHClient()
-            client.load_system_host_keys()
-            client.connect(address, username="root") # TODO This is insecure - why!
-            logger.info("Connected to Kria")
-            
+            if agent_port is not None:
+                agent = KriaAgentClient(address, agent_port, secret=os.environ.get("KRIA_AGENT_SECRET"))
+                if agent.ping():
+                    logger.info("Connected to Kria agent")
+                else:
+                    logger.info("Kria agent not answering, using SSH")
+                    agent.close()
+                    agent = None
+
+            client = None
+            try:
+                client = paramiko.client.SSHClient()
+                client.load_system_host_keys()
+                client.connect(address, username="root") # TODO This is insecure - why!
+                logger.info("Connected to Kria")
+            except Exception:
+                if agent is None:
+                    raise
+                logger.warning(f"SSH to the kria failed, continuing with the agent only\n{traceback.format_exc()}")
+                client = None
+
+            session = KriaSession(client, agent)
+
             # Enable Pin States
-            for pin in pins:
-                client.exec_command(f"echo {str(pin)} > /sys/class/gpio/export")
-                client.exec_command(f"echo \"out\" > /sys/class/gpio/gpio{str(pin)}/direction")
+            session.gpio_export(pins)
+
+            session.monitor_services(services)
 
-            return client
+            return session
         except Exception as e:
             logger.warning(f"Exception when connecting to kria: {e}\n{traceback.format_exc()}")
+            if agent is not None:
+                agent.close()
 
         time.sleep(delay)
 
@@ -35,29 +63,24 @@ def wait_for_kria(address: str, delay: int, data: object) -> None:
 def enable_kria(data: object) -> None:
     logger.debug(f"Attempting to power on the the kria")
 
-    client = data["_kria"]
-    for pin in pins:
-        client.exec_command(f"echo 1 > /sys/class/gpio/gpio{str(pin)}/value")
+    session = data["_kria"]
+    session.gpio_set(pins, 1)
 
 # Power off the Kria
 def disable_kria(data: object) -> None:
     logger.debug(f"Attempting to power off the the kria")
 
-    client = data["_kria"]
-    for pin in pins:
-        client.exec_command(f"echo 0 > /sys/class/gpio/gpio{str(pin)}/value")
-    client.close()
+    session = data["_kria"]
+    session.gpio_set(pins, 0)
+    session.close()
 
 # Load firmware onto the board
 def load_firmware(data: object) -> None:
     logger.debug(f"Attempting to load firmware for the kria")
-    client = data["_kria"]
+    session = data["_kria"]
 
     # TODO
-    stdin, stdout, stderr = client.exec_command("fw-loader load hexaboard-hd-tester-v2p0-trophy-v3")
-
-    stdout = stdout.read().decode()
-    stderr = stderr.read().decode()
+    stdout, stderr = session.load_firmware("hexaboard-hd-tester-v2p0-trophy-v3")
 
     logger.debug(f"Response gotten: stdout: {stdout}\n\nstderr: {stderr}")
     time.sleep(5)
@@ -74,45 +97,34 @@ def load_firmware_validator(in_data: None, out_data: None) -> None:
         return True
 
 # Restart Services
+# Each service is restarted once the previous one is back, which the service
+# monitor reports as soon as systemd does. Every delay seconds without that, the
+# service's state is asked for directly, in case the monitor missed the restart
 def restart_services(delay: int, data: object) -> None:
     logger.debug(f"Attempting to restart on the kria")
-    client = data["_kria"]
-
-    restart_response = client.exec_command("service daq-server restart")[1].read().decode()
-    logger.debug(f"Restarted daq with response {restart_response}")
-    time.sleep(3)
-    
-    restart_response = client.exec_command("service i2c-server restart")[1].read().decode()
-    logger.debug(f"Restarted i2c with response {restart_response}")
-
-    # Wait for daq alive
-    while True:
-        logger.debug(f"Querying DAQ Server status on the kria")
-        stdin, stdout, stderr = client.exec_command("service daq-server status")
-        response = stdout.read().decode()
-
-        logger.debug(f"Resposne gotten: {response}")
-
-        if "active (running)" not in response:
-            logger.debug("DAQ not online")
-        else:
-            logger.debug("DAQ online")
-            break
-
-        time.sleep(delay)
-
-    # Wait for i2c alive
-    while True:
-        logger.debug(f"Querying I2C Server status on the kria")
-        stdin, stdout, stderr = client.exec_command("service i2c-server status")
-        response = stdout.read().decode()
-
-        logger.debug(f"Resposne gotten: {response}")
-
-        if "active (running)" not in response:
-            logger.debug("I2C not online")
-        else:
-            logger.debug("I2C online")
-            break
-
-        time.sleep(delay)
\ No newline at end of file
+    session = data["_kria"]
+    monitor = session.get_monitor()
+
+    for service in services:
+        sequence = monitor.sequence() if monitor is not None else 0
+
+        restart_response = session.restart_service(service)
+        logger.debug(f"Restarted {service} with response {restart_response}")
+
+        while True:
+            if monitor is not None and monitor.is_connected():
+                if monitor.wait_active(service, sequence, delay):
+                    break
+                logger.debug(f"{service} not online, currently {monitor.states().get(service)}")
+
+            # No change seen (or no stream to wait on), so ask
+            logger.debug(f"Querying {service} status on the kria")
+            response = session.service_status([service])[service]
+            logger.debug(f"Resposne gotten: {response}")
+            if "active (running)" in response:
+                break
+            logger.debug(f"{service} not online")
+            if monitor is None or not monitor.is_connected():
+                time.sleep(delay)
+
+        logger.debug(f"{service} online")
@@ -0,0 +1,93 @@
+import json
+import logging
+import threading
+
+import zmq
+
+logger = logging.getLogger("kria")
+
+class KriaAgentError(Exception):
+    pass
+
+# The request never reached the agent, so it's safe to do some other way
+class KriaAgentUnreachable(ConnectionError):
+    pass
+
+# Client for remote/kria_agent.py, one zmq round trip per request
+# Each lane has its own socket, and the agent its own worker for each lane, so a slow
+# request (eg. a firmware load) on one doesn't hold up the others
+class KriaAgentClient:
+    # Seconds to wait for the reply to each op, by default the client's timeout
+    timeouts = { "fw_load": 120, "service_restart": 60 }
+
+    def __init__(self, address: str, port: int, timeout: float = 2, secret: str = None) -> None:
+        self._endpoint = f"tcp://{address}:{port}"
+        self._timeout = timeout
+        self._secret = secret
+        self._context = zmq.Context.instance()
+        self._locks = {}
+        self._sockets = {}
+        self._locks_lock = threading.Lock()
+
+    def _lock(self, lane: str) -> threading.Lock:
+        with self._locks_lock:
+            if lane not in self._locks:
+                self._locks[lane] = threading.Lock()
+            return self._locks[lane]
+
+    def _connect(self, lane: str) -> None:
+        socket = self._context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        # Only queue requests to a connected agent, so a send that times out was never sent
+        socket.setsockopt(zmq.IMMEDIATE, 1)
+        socket.setsockopt(zmq.SNDTIMEO, int(self._timeout * 1000))
+        socket.connect(self._endpoint)
+        self._sockets[lane] = socket
+
+    # Send one request and return its result, raising KriaAgentError if the agent failed it,
+    # KriaAgentUnreachable if it never got it, and TimeoutError if it got it but didn't answer
+    # in time (in which case it may or may not have carried it out)
+    def request(self, op: str, lane: str = "control", timeout: float = None, **args) -> object:
+        if timeout is None:
+            timeout = self.timeouts[op] if op in self.timeouts else self._timeout
+        message = {"op": op, "lane": lane, **args}
+        if self._secret is not None:
+            message["secret"] = self._secret
+
+        with self._lock(lane):
+            if lane not in self._sockets:
+                self._connect(lane)
+            socket = self._sockets[lane]
+
+            try:
+                socket.send(json.dumps(message).encode())
+            except zmq.Again:
+                self._sockets.pop(lane).close()
+                raise KriaAgentUnreachable(f"Kria agent at {self._endpoint} is not connected")
+
+            try:
+                socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+                reply = json.loads(socket.recv())
+            except zmq.Again:
+                # A REQ socket without its reply can't send again, start over
+                self._sockets.pop(lane).close()
+                raise TimeoutError(f"Kria agent at {self._endpoint} did not answer {op} within {timeout}s")
+
+        if not reply["ok"]:
+            raise KriaAgentError(reply["error"])
+        return reply["result"]
+
+    def ping(self) -> bool:
+        try:
+            self.request("ping")
+            return True
+        except Exception:
+            return False
+
+    def close(self) -> None:
+        with self._locks_lock:
+            lanes = list(self._locks.items())
+        for lane, lock in lanes:
+            with lock:
+                if lane in self._sockets:
+                    self._sockets.pop(lane).close()
@@ -0,0 +1,183 @@
+import logging
+import threading
+import uuid
+
+import paramiko
+
+from .kria_agent_client import KriaAgentClient
+from .service_monitor import ServiceMonitor
+
+logger = logging.getLogger("kria")
+
+# A persistent shell on the Kria, over one SSH channel
+# Commands are written to the shell's stdin, each followed by a marker
+# carrying its exit code, so several commands cost one round trip
+class ShellChannel:
+    def __init__(self, client: paramiko.client.SSHClient) -> None:
+        self._stdin, self._stdout, self._stderr = client.exec_command("sh")
+
+    def is_active(self) -> bool:
+        return not self._stdout.channel.closed
+
+    # Run commands in order, returning (exit code, stdout, stderr) for each
+    def run(self, commands: list[str], timeout: float) -> list[tuple[int, str, str]]:
+        self._stdout.channel.settimeout(timeout)
+        marker = uuid.uuid4().hex
+
+        # Commands don't get the shell's stdin, as that carries the script
+        # The markers start on a new line, which is removed again when parsing
+        script = ""
+        for index in range(len(commands)):
+            script += f"{{\n{commands[index]}\n}} < /dev/null\n"
+            script += f"printf '\\n{marker}:{index}:%d\\n' $?\n"
+            script += f"printf '\\n{marker}:{index}:\\n' >&2\n"
+        self._stdin.write(script)
+        self._stdin.flush()
+
+        results = []
+        for index in range(len(commands)):
+            stdout, code = self._read_until(self._stdout, f"{marker}:{index}:")
+            stderr, _ = self._read_until(self._stderr, f"{marker}:{index}:")
+            results.append((int(code), stdout, stderr))
+        return results
+
+    # Read lines up to the marker, returning the text before it and the rest of its line
+    def _read_until(self, stream, marker: str) -> tuple[str, str]:
+        lines = []
+        while True:
+            line = stream.readline()
+            if isinstance(line, bytes):
+                line = line.decode()
+            if line == "":
+                raise IOError("Kria shell closed")
+            if line.startswith(marker):
+                text = "".join(lines)
+                return text[:-1] if text.endswith("\n") else text, line[len(marker):].strip()
+            lines.append(line)
+
+    def close(self) -> None:
+        self._stdin.close()
+        self._stdout.channel.close()
+
+# All control of one Kria goes through this session
+# Operations go to the Kria's control agent (remote/kria_agent.py) when there is one,
+# and fall back to shell commands over SSH when there isn't or it fails. Operations
+# that can't safely be done twice (loading firmware, restarting a service) only fall
+# back when the agent never got the request, never on a timeout or an error from it
+# Each SSH lane is its own persistent shell, serialized by a lock, so step threads
+# (the "control" lane) and the watcher (the "status" lane) never wait on each other
+class KriaSession:
+    lanes = ["control", "status"]
+
+    def __init__(self, client: paramiko.client.SSHClient | None, agent: KriaAgentClient | None = None) -> None:
+        self._client = client
+        self._agent = agent
+        self._monitor = None
+        self._channels = {}
+        self._locks = { lane: threading.Lock() for lane in self.lanes }
+
+    def get_client(self) -> paramiko.client.SSHClient:
+        return self._client
+
+    def get_agent(self) -> KriaAgentClient | None:
+        return self._agent
+
+    # Follow the state of services from here on, see get_monitor
+    def monitor_services(self, services: list[str]) -> ServiceMonitor:
+        if self._monitor is None:
+            self._monitor = ServiceMonitor(self, services)
+        return self._monitor
+
+    def get_monitor(self) -> ServiceMonitor | None:
+        return self._monitor
+
+    def get_transport(self) -> paramiko.Transport:
+        return self._client.get_transport() if self._client is not None else None
+
+    def is_active(self) -> bool:
+        if self._client is None:
+            return self._agent.ping()
+        return self.get_transport() is not None and self.get_transport().is_active()
+
+    # Run op on the agent, or call fallback if that isn't possible
+    # Unless op is idempotent, only a request the agent never got is tried again over SSH
+    def _with_agent(self, op: str, args: dict, fallback, idempotent: bool = True, lane: str = "control", timeout: float = None):
+        if self._agent is not None:
+            try:
+                return self._agent.request(op, lane, timeout, **args)
+            except Exception as e:
+                if self._client is None or not (idempotent or isinstance(e, ConnectionError)):
+                    raise
+                logger.warning(f"Kria agent failed {op}, falling back to SSH: {e}")
+        return fallback()
+
+    def gpio_export(self, pins: list[int]) -> None:
+        commands = []
+        for pin in pins:
+            commands.append(f"echo {str(pin)} > /sys/class/gpio/export")
+            commands.append(f"echo \"out\" > /sys/class/gpio/gpio{str(pin)}/direction")
+        self._with_agent("gpio_export", {"pins": pins, "direction": "out"}, lambda: self.run(commands))
+
+    def gpio_set(self, pins: list[int], value: int) -> None:
+        commands = [f"echo {value} > /sys/class/gpio/gpio{str(pin)}/value" for pin in pins]
+        self._with_agent("gpio_set", {"pins": pins, "value": value}, lambda: self.run(commands))
+
+    # Returns (stdout, stderr) of the firmware loader
+    def load_firmware(self, name: str) -> tuple[str, str]:
+        def fallback():
+            code, stdout, stderr = self.run_one(f"fw-loader load {name}")
+            return {"stdout": stdout, "stderr": stderr, "code": code}
+        result = self._with_agent("fw_load", {"name": name}, fallback, idempotent=False)
+        return (result["stdout"], result["stderr"])
+
+    # The agent answers with the service's state after the restart, which the monitor is told
+    def restart_service(self, service: str) -> str:
+        result = self._with_agent("service_restart", {"service": service}, lambda: self.run_one(f"service {service} restart")[1],
+                                  idempotent=False)
+        if isinstance(result, dict):
+            if self._monitor is not None:
+                self._monitor.restarted(service, result["active"], result["sub"])
+            return f"{result['active']} ({result['sub']})"
+        return result
+
+    # Returns each service's state as systemd shows it, eg. "active (running)"
+    def service_status(self, services: list[str], lane: str = "control", timeout: float = 30) -> dict:
+        def fallback():
+            results = self.run([f"systemctl show -p ActiveState -p SubState {service}" for service in services], lane, timeout)
+            states = {}
+            for service, result in zip(services, results):
+                fields = dict(line.split("=", 1) for line in result[1].splitlines() if "=" in line)
+                states[service] = {"active": fields.get("ActiveState", "unknown"), "sub": fields.get("SubState", "unknown")}
+            return states
+
+        states = self._with_agent("service_status", {"services": services}, fallback, lane=lane, timeout=timeout)
+        return { service: f"{state['active']} ({state['sub']})" for service, state in states.items() }
+
+    # Run commands in one round trip, returning (exit code, stdout, stderr) for each
+    def run(self, commands: list[str], lane: str = "control", timeout: float = 30) -> list[tuple[int, str, str]]:
+        with self._locks[lane]:
+            if lane not in self._channels or not self._channels[lane].is_active():
+                logger.debug(f"Opening Kria shell for lane {lane}")
+                self._channels[lane] = ShellChannel(self._client)
+
+            try:
+                return self._channels[lane].run(commands, timeout)
+            except Exception:
+                # The shell's output can't be trusted to line up any more
+                self._channels.pop(lane).close()
+                raise
+
+    def run_one(self, command: str, lane: str = "control", timeout: float = 30) -> tuple[int, str, str]:
+        return self.run([command], lane, timeout)[0]
+
+    def close(self) -> None:
+        if self._monitor is not None:
+            self._monitor.stop()
+        for lane in self.lanes:
+            with self._locks[lane]:
+                if lane in self._channels:
+                    self._channels.pop(lane).close()
+        if self._agent is not None:
+            self._agent.close()
+        if self._client is not None:
+            self._client.close()
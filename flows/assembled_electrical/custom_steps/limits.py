@@ -0,0 +1,134 @@
+import logging
+
+import numpy as np
+
+from objects import TestFinishedBehavior
+from .arrays import arrays_key
+
+logger = logging.getLogger("tests")
+
+# The limits of one test for one board type, from the limits section of flow.yaml
+# The board type's own entries replace those under default, field by field
+def limits_for(limits: dict, board: str, test: str) -> dict:
+    if limits is None:
+        return None
+
+    merged = {}
+    for source in ["default", board]:
+        if source not in limits or limits[source] is None or test not in limits[source]:
+            continue
+        for key, value in limits[source][test].items():
+            if isinstance(value, dict):
+                merged[key] = { **merged.get(key, {}), **value }
+            else:
+                merged[key] = value
+    return merged if len(merged) > 0 else None
+
+# Mask of values within bounds, which may have min and max. Missing (NaN) values pass
+def within(values: np.ndarray, bounds: dict) -> np.ndarray:
+    mask = np.isnan(values) if values.dtype.kind == "f" else np.zeros(values.shape, dtype=bool)
+    passing = np.ones(values.shape, dtype=bool)
+    if "min" in bounds:
+        passing &= values >= bounds["min"]
+    if "max" in bounds:
+        passing &= values <= bounds["max"]
+    return mask | passing
+
+# Check every channel, half and ROC of a test's arrays against its limits in one pass per field
+# Returns the pass masks, shaped like the arrays, and the fields each failure was on
+# Each half's bad channels are those failing the channel bounds, plus the half fields
+# listed in channel_counts (eg. its count of dead channels). A half with some, but no more
+# than allowed_failed_channels, is marginal; past that it fails
+def evaluate(arrays: dict, limits: dict) -> dict:
+    halves = arrays["halves"]
+    channel_mask = None
+    half_mask = np.ones(halves.shape, dtype=bool)
+    failed_fields = {}
+
+    def has_field(field, kind):
+        if halves.dtype.names is None or field not in halves.dtype.names:
+            logger.debug(f"No {field} in results, skipping its {kind}")
+            return False
+        return True
+
+    for field, bounds in (limits.get("half") or {}).items():
+        if not has_field(field, "limits"):
+            continue
+        passing = within(halves[field], bounds)
+        half_mask &= passing
+        failed_fields[field] = int(np.count_nonzero(~passing))
+
+    # ROC bounds are on the total of a field over the ROC's halves, and fail both of them
+    for field, bounds in (limits.get("roc") or {}).items():
+        if not has_field(field, "limits"):
+            continue
+        passing = within(np.nansum(halves[field], axis=1), bounds)
+        half_mask &= passing[:, None]
+        failed_fields[f"{field} per ROC"] = int(np.count_nonzero(~passing))
+
+    for field, bounds in (limits.get("channel") or {}).items():
+        if field not in arrays["channels"]:
+            logger.debug(f"No per-channel {field} in results, skipping its limits")
+            continue
+        passing = within(arrays["channels"][field], bounds)
+        channel_mask = passing if channel_mask is None else channel_mask & passing
+        failed_fields[field] = int(np.count_nonzero(~passing))
+
+    bad_channels = np.zeros(halves.shape, dtype=np.int64)
+    if channel_mask is not None:
+        bad_channels += np.count_nonzero(~channel_mask, axis=2)
+    for field in limits.get("channel_counts") or []:
+        if not has_field(field, "channel count"):
+            continue
+        counts = np.nan_to_num(halves[field]).astype(np.int64)
+        bad_channels += counts
+        failed_fields[field] = int(counts.sum())
+
+    allowed_channels = limits["allowed_failed_channels"] if "allowed_failed_channels" in limits else 0
+    half_mask &= bad_channels <= allowed_channels
+    marginal_mask = half_mask & (bad_channels > 0)
+
+    return {
+        "half_mask": half_mask,
+        "marginal_mask": marginal_mask,
+        "channel_mask": channel_mask,
+        "failed_halves": int(np.count_nonzero(~half_mask)),
+        "marginal_halves": int(np.count_nonzero(marginal_mask)),
+        "failed_channels": int(bad_channels.sum()),
+        "failed_fields": { field: count for field, count in failed_fields.items() if count > 0 },
+    }
+
+# The output action for an evaluation: green with nothing failing, gold with only marginal
+# halves or up to allowed_failures halves failing, red past that
+def limits_action(result: dict, limits: dict) -> object:
+    failed = result["failed_halves"]
+    marginal = result["marginal_halves"]
+    if failed == 0 and marginal == 0:
+        return True
+
+    def halves(mask):
+        where = np.argwhere(mask)
+        return ", ".join(f"{roc}:{half}" for roc, half in where[:4]) + (", ..." if len(where) > 4 else "")
+
+    fields = ", ".join(f"{field} ({count})" for field, count in result["failed_fields"].items())
+    parts = []
+    if failed > 0:
+        parts.append(f"{failed} halves out of limits ({halves(~result['half_mask'])})")
+    if marginal > 0:
+        parts.append(f"{marginal} halves with bad channels ({halves(result['marginal_mask'])})")
+    message = ", ".join(parts) + f": {fields}"
+
+    allowed = limits["allowed_failures"] if "allowed_failures" in limits else 0
+    return {
+        "color": "gold" if failed <= allowed else "red",
+        "message": message,
+        "behavior": TestFinishedBehavior.NEXT_STEP
+    }
+
+# Validator for a test step with limits in flow.yaml, passing when it has none
+def check_limits(limits: dict, test: str, input_data: object, data: object) -> object:
+    test_limits = limits_for(limits, input_data["_board"] if "_board" in input_data else None, test)
+    if test_limits is None or arrays_key(test) not in data:
+        return True
+
+    return limits_action(evaluate(data[arrays_key(test)], test_limits), test_limits)
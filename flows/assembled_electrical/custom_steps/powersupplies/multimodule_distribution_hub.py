@@ -2,54 +2,151 @@ import time
 import paramiko
 import logging
 import json
+import os
+import queue
+import subprocess
+import sys
 import threading
 import traceback
 
+from broker import broker
+
 logger = logging.getLogger("powersupply")
 
-module = "1"
+# Address to use the stand-in server from remote/, with no hardware or SSH
+local_address = "local"
+
+# A persistent connection to mm_tester_tray_simple.py --server
+# The server keeps the I2C handles open between requests
+# Requests and responses are one JSON object per line. Responses are read by a thread
+# of their own, so a hung server times a request out instead of blocking forever, and
+# the server's stderr is logged as it comes so it can never fill up and stall it
+class HubServer:
+    def __init__(self, stdin, stdout, stderr=None, process=None, timeout: float = 10) -> None:
+        self._stdin = stdin
+        self._process = process
+        self._timeout = timeout
+        self._responses = queue.Queue()
+        self._broken = None
+
+        threading.Thread(target=self._read, args=(stdout, self._responses.put), name="hub-stdout", daemon=True).start()
+        if stderr is not None:
+            threading.Thread(target=self._read, args=(stderr, self._log), name="hub-stderr", daemon=True).start()
+
+    # Pass each line of stream to handle, then "" once it closes
+    def _read(self, stream, handle) -> None:
+        try:
+            for line in iter(stream.readline, ""):
+                if isinstance(line, bytes):
+                    line = line.decode()
+                if line == "":
+                    break
+                handle(line)
+        except Exception as e:
+            logger.warning(f"Stopped reading from the power hub server: {e}")
+        handle("")
+
+    def _log(self, line: str) -> None:
+        if line.strip() != "":
+            logger.warning(f"Power hub server: {line.rstrip()}")
+
+    def request(self, command: str, module: int = None) -> object:
+        if self._broken is not None:
+            raise IOError(f"Power hub server is unusable: {self._broken}")
+        self._stdin.write(json.dumps({"command": command, "module": module}) + "\n")
+        self._stdin.flush()
+
+        try:
+            line = self._responses.get(timeout=self._timeout)
+        except queue.Empty:
+            # A late response would be taken as the next request's, so give up on the server
+            self._broken = f"no response to {command} within {self._timeout}s"
+            raise TimeoutError(f"Power hub server did not respond to {command} within {self._timeout}s")
+        if line == "":
+            self._broken = "connection closed"
+            raise IOError("Power hub server closed the connection")
+
+        response = json.loads(line)
+        if not response["ok"]:
+            raise RuntimeError(f"Power hub server returned error: {response['error']}")
+        return response
+
+    def close(self) -> None:
+        self._stdin.close()
+        if self._process is not None:
+            self._process.wait(5)
+
+# Start the server on the hub's controller over SSH
+def connect(address: str) -> object:
+    if address == local_address:
+        logger.warning("Using the stand-in power hub server, no hardware will be powered")
+        remote_dir = os.path.join(os.path.dirname(__file__), "..", "..", "..", "..", "remote")
+        process = subprocess.Popen([sys.executable, "mm_tester_tray_simple.py", "--server", "--fake"],
+            cwd=remote_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        return {'client': None, 'lock': threading.Lock(), 'server': HubServer(process.stdin, process.stdout, process.stderr, process)}
+
+    client = paramiko.client.SSHClient()
+    client.load_system_host_keys()
+    client.connect(address, username="powercontrol")
+    logger.info("Connected to power supply")
+
+    stdin, stdout, stderr = client.exec_command("cd ~/Desktop; ./venv/bin/python mm_tester_tray_simple.py --server")
+    server = HubServer(stdin, stdout, stderr)
+    server.request("ping")
+    logger.info("Started power hub server")
+
+    return {'client': client, 'lock': threading.Lock(), 'server': server}
+
+def close(hub: object) -> None:
+    hub["server"].close()
+    if hub["client"] is not None:
+        hub["client"].close()
 
 # Try and connect to the supply every X s.
-def wait_for_power_supply(address: str, delay: int, data: object):
+# The connection is shared by all slots on the same hub, one module each
+def wait_for_power_supply(address: str, module: int, delay: int, data: object):
     while True:
         logger.debug(f"Attempting to connect to the power supply at {address}")
         try:
-            client = paramiko.client.SSHClient()
-            client.load_system_host_keys()
-            client.connect(address, username="powercontrol")
-            logger.info("Connected to power supply")
-            
+            key = ("multimodule_distribution_hub", address)
+            hub = broker.acquire(key, lambda: connect(address))
+
             # Disable Power
-            client.exec_command(f"cd ~/Desktop; ./venv/bin/python mm_tester_tray_simple.py --module {module} --off")
+            try:
+                with hub["lock"]:
+                    hub["server"].request("off", module)
+            except Exception:
+                broker.release(key, close)
+                raise
 
-            return {'client': client, 'lock': threading.Lock()}
+            return {'server': hub['server'], 'lock': hub['lock'], 'address': address, 'module': module}
         except Exception as e:
             logger.warning(f"Exception when connecting to kria: {e}\n{traceback.format_exc()}")
 
         time.sleep(delay)
 
 def enable_power_supply(data):
+    module = data["_power_supply"]["module"]
     data["_power_supply"]["lock"].acquire()
-    data["_power_supply"]["client"].exec_command(f"cd ~/Desktop; ./venv/bin/python mm_tester_tray_simple.py --module {module} --on")
+    data["_power_supply"]["server"].request("on", module)
     data["_power_supply"]["lock"].release()
 
 def check_power(data):
+    module = data["_power_supply"]["module"]
     data["_power_supply"]["lock"].acquire()
-    stdin, stdout, stderr = data["_power_supply"]["client"].exec_command(f"cd ~/Desktop; ./venv/bin/python mm_tester_tray_simple.py --module {module} --status")
-
-    stdout = stdout.read().decode()
-    stderr = stderr.read().decode()
-    data["_power_supply"]["lock"].release()
+    try:
+        returned_data = data["_power_supply"]["server"].request("status", module)["data"]
+    finally:
+        data["_power_supply"]["lock"].release()
 
-    logger.debug(f"Response gotten: stdout: {stdout}\n\nstderr: {stderr}")
-    returned_data = json.loads(stdout)
+    logger.debug(f"Response gotten: {returned_data}")
 
     result = {
         "voltage": returned_data[f"IN_VOLTAGE"],
         "state": returned_data[f"MODULE_{module}_STATE"],
         "state_analog": returned_data[f"MODULE_{module}_ANALOG_STATE"],
         "state_digital": returned_data[f"MODULE_{module}_DIGITAL_STATE"],
-        "current": returned_data[f"MODULE_{module}_ANALOG_CURRENT"] + returned_data["MODULE_1_DIGITAL_CURRENT"],
+        "current": returned_data[f"MODULE_{module}_ANALOG_CURRENT"] + returned_data[f"MODULE_{module}_DIGITAL_CURRENT"],
         "current_digital": returned_data[f"MODULE_{module}_DIGITAL_CURRENT"],
         "current_analog": returned_data[f"MODULE_{module}_ANALOG_CURRENT"]
     }
@@ -58,8 +155,11 @@ def check_power(data):
     return result
 
 def disable_power_supply(data):
-    logger.info("Disabling Channel 1")
+    module = data["_power_supply"]["module"]
+    logger.info(f"Disabling Module {module}")
     data["_power_supply"]["lock"].acquire()
-    data["_power_supply"]["client"].exec_command(f"cd ~/Desktop; ./venv/bin/python mm_tester_tray_simple.py --module {module} --off")
-    data["_power_supply"]["client"].close()
-    data["_power_supply"]["lock"].release()
\ No newline at end of file
+    data["_power_supply"]["server"].request("off", module)
+    data["_power_supply"]["lock"].release()
+
+    # The last slot using the hub closes the connection
+    broker.release(("multimodule_distribution_hub", data["_power_supply"]["address"]), close)
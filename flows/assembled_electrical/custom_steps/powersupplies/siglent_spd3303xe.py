@@ -5,57 +5,68 @@ import logging
 import threading
 import traceback
 
+from broker import broker
+
 logger = logging.getLogger("powersupply")
 
+# Connect to the supply and put it in a known state
+# The connection is shared by all slots on the same supply, one channel each
+def connect(address: str) -> object:
+    rm = pyvisa.ResourceManager()
+
+    # Connect
+    logger.debug(f"Connecting to {address}")
+    ps = rm.open_resource(address)
+    ps.write_termination = "\n"
+    ps.read_termination = "\n"
+
+    # Turn Off
+    logger.debug("Disabling all tracks")
+    ps.write("OUTPut:TRACK 0")
+    ps.write("OUTPut CH1,OFF")
+    ps.write("OUTPut CH2,OFF")
+    ps.write("OUTPut CH3,OFF")
+
+    # Set Initial Values
+    logger.debug("Setting up initial voltage/current limits")
+    ps.write("CH1:VOLTage 1.5")
+    ps.write("CH2:VOLTage 1.5")
+    ps.write("CH1:CURRent 3.23")
+    ps.write("CH2:CURRent 3.23")
+
+    return {"supply": ps, "lock": threading.Lock()}
+
 # Try and connect to the supply every X s.
-def wait_for_power_supply(address: str, delay: int, data: object):
+def wait_for_power_supply(address: str, channel: int, delay: int, data: object):
     logger.info(f"Waiting on Power Supply at address {address} and delay {delay}")
-    rm = pyvisa.ResourceManager()
     while True:
         try:
-            # Connect
-            logger.debug(f"Connecting to {address}")
-            ps = rm.open_resource(address)
-            ps.write_termination = "\n"
-            ps.read_termination = "\n"
-
-            # Turn Off
-            logger.debug("Disabling all tracks")
-            ps.write("OUTPut:TRACK 0")
-            ps.write("OUTPut CH1,OFF")
-            ps.write("OUTPut CH2,OFF")
-            ps.write("OUTPut CH3,OFF")
-
-            # Set Initial Values
-            logger.debug("Setting up initial voltage/current limits")
-            ps.write("CH1:VOLTage 1.5")
-            ps.write("CH2:VOLTage 1.5")
-            ps.write("CH1:CURRent 3.23")
-            ps.write("CH2:CURRent 3.23")
-
-            return {"supply": ps, "lock": threading.Lock()}
+            supply = broker.acquire(("siglent_spd3303xe", address), lambda: connect(address))
+            return {"supply": supply["supply"], "lock": supply["lock"], "address": address, "channel": channel}
         except Exception as e:
             logger.debug(f"Failed to connect to power supply: {e}\n{traceback.format_exc()}")
 
         time.sleep(delay)
 
 def enable_power_supply(data):
-    logger.info("Enabling Channel 1, Aqiring Lock")
+    channel = data["_power_supply"]["channel"]
+    logger.info(f"Enabling Channel {channel}, Aqiring Lock")
 
     data["_power_supply"]["lock"].acquire()
     logger.debug("Lock acquired")
 
-    data["_power_supply"]["supply"].write("OUTPut CH1,ON")
+    data["_power_supply"]["supply"].write(f"OUTPut CH{channel},ON")
 
     data["_power_supply"]["lock"].release()
     logger.debug("Lock Released")
 
 def check_power(data):
+    channel = data["_power_supply"]["channel"]
     data["_power_supply"]["lock"].acquire()
-    
+
     result = {
-        "voltage": float(data["_power_supply"]["supply"].query("MEASure:VOLTage? CH1")),
-        "current": float(data["_power_supply"]["supply"].query("MEASure:CURRent? CH1"))
+        "voltage": float(data["_power_supply"]["supply"].query(f"MEASure:VOLTage? CH{channel}")),
+        "current": float(data["_power_supply"]["supply"].query(f"MEASure:CURRent? CH{channel}"))
     }
 
     data["_power_supply"]["lock"].release()
@@ -64,12 +75,16 @@ def check_power(data):
     return result
 
 def disable_power_supply(data):
-    logger.info("Disabling Channel 1, Aquiring Lock")
+    channel = data["_power_supply"]["channel"]
+    logger.info(f"Disabling Channel {channel}, Aquiring Lock")
 
     data["_power_supply"]["lock"].acquire()
     logger.debug("Lock acquired")
 
-    data["_power_supply"]["supply"].write("OUTPut CH1,OFF")
+    data["_power_supply"]["supply"].write(f"OUTPut CH{channel},OFF")
 
     data["_power_supply"]["lock"].release()
-    logger.debug("Lock Released")
\ No newline at end of file
+    logger.debug("Lock Released")
+
+    # The last slot using the supply closes the connection
+    broker.release(("siglent_spd3303xe", data["_power_supply"]["address"]), lambda supply: supply["supply"].close())
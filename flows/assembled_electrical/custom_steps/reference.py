@@ -0,0 +1,103 @@
+import functools
+import logging
+import os
+
+import numpy as np
+
+from objects import TestFinishedBehavior
+from .. import boards
+from .arrays import arrays_key
+
+logger = logging.getLogger("tests")
+
+# References live next to boards.py, in references/<board type>, unless the board
+# sets its own 'reference' directory. Each compared field has <field>.mean.npy and
+# <field>.std.npy, shaped like the field's array: (rocs, 2) or (rocs, 2, channels)
+def reference_dir(board: str) -> str:
+    base = os.path.dirname(boards.__file__)
+    if board in boards.boards and "reference" in boards.boards[board]:
+        return os.path.join(base, boards.boards[board]["reference"])
+    return os.path.join(base, "references", board)
+
+# Memory mapped, so a reference costs nothing until its pages are read
+@functools.lru_cache(maxsize=64)
+def load_reference_array(path: str) -> np.ndarray:
+    return np.load(path, mmap_mode="r")
+
+def load_reference(board: str, field: str) -> tuple[np.ndarray, np.ndarray]:
+    directory = reference_dir(board)
+    mean_path = os.path.join(directory, f"{field}.mean.npy")
+    std_path = os.path.join(directory, f"{field}.std.npy")
+    if not os.path.exists(mean_path) or not os.path.exists(std_path):
+        return None
+    return load_reference_array(mean_path), load_reference_array(std_path)
+
+# Write a reference for a field from the arrays of known-good boards, stacked on axis 0
+def save_reference(board: str, field: str, samples: np.ndarray) -> None:
+    directory = reference_dir(board)
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, f"{field}.mean.npy"), np.nanmean(samples, axis=0))
+    np.save(os.path.join(directory, f"{field}.std.npy"), np.nanstd(samples, axis=0))
+
+# The value of field from a test's arrays, per channel if there is such a field, else per half
+def field_values(arrays: dict, field: str) -> np.ndarray:
+    if field in arrays["channels"]:
+        return arrays["channels"][field]
+    halves = arrays["halves"]
+    if halves.dtype.names is not None and field in halves.dtype.names:
+        return halves[field].astype(np.float64)
+    return None
+
+# Compare fields of a test's results against the reference for the board's type
+# Values more than z_threshold standard deviations from the reference mean are outliers
+def compare_to_reference(test: str, fields: list[str], z_threshold: float, data: object) -> dict:
+    board = data["_board"]
+    out_data = { "_explode": True, "REFERENCE:BOARD": board, "REFERENCE:OUTLIERS": 0 }
+    if arrays_key(test) not in data:
+        logger.warning(f"No {test} results to compare to a reference")
+        out_data["REFERENCE:AVAILABLE"] = False
+        return out_data
+
+    arrays = data[arrays_key(test)]
+    compared = []
+    deviations = {}
+    for field in fields:
+        reference = load_reference(board, field)
+        values = field_values(arrays, field)
+        if reference is None or values is None:
+            logger.info(f"No reference or results for {field} on {board}, not comparing it")
+            continue
+        mean, std = reference
+        if mean.shape != values.shape:
+            logger.warning(f"Reference for {field} on {board} has shape {mean.shape}, results have {values.shape}")
+            continue
+
+        deviation = values - mean
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = np.where(std > 0, deviation / std, np.nan)
+        outliers = np.abs(z) > z_threshold
+
+        positions = [":".join(str(int(i)) for i in index) for index in np.argwhere(outliers)]
+        out_data[f"REFERENCE:{field}:MEAN_DEVIATION"] = float(np.nanmean(deviation))
+        out_data[f"REFERENCE:{field}:MAX_ABS_Z"] = float(np.nanmax(np.abs(z))) if not np.all(np.isnan(z)) else None
+        out_data[f"REFERENCE:{field}:OUTLIERS"] = len(positions)
+        out_data[f"REFERENCE:{field}:OUTLIER_POSITIONS"] = positions
+        out_data["REFERENCE:OUTLIERS"] += len(positions)
+        deviations[field] = { "deviation": deviation, "z": z, "outliers": outliers }
+        compared.append(field)
+
+    out_data["REFERENCE:AVAILABLE"] = len(compared) > 0
+    out_data["REFERENCE:FIELDS"] = compared
+    out_data[arrays_key("REFERENCE")] = deviations
+    return out_data
+
+def check_reference(input_data: object, data: object) -> object:
+    if not data["REFERENCE:AVAILABLE"]:
+        return "No Reference"
+    if data["REFERENCE:OUTLIERS"] > 0:
+        return {
+            "color": "gold",
+            "message": f"{data['REFERENCE:OUTLIERS']} outliers from reference",
+            "behavior": TestFinishedBehavior.NEXT_STEP
+        }
+    return True
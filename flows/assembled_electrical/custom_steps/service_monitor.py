@@ -0,0 +1,138 @@
+import json
+import logging
+import threading
+import time
+import traceback
+
+logger = logging.getLogger("kria")
+
+# systemd's journal message IDs for unit state changes, and the state each one leaves the unit in
+message_states = {
+    "7d4958e842da4a758f6c1cdc7b36dcc5": ("activating", "start"),    # Starting
+    "39f53479d3a045ac8e11786248231fbf": ("active", "running"),      # Started
+    "de5b426a63be47a7b6ac3eb1ed3d0cc5": ("deactivating", "stop"),   # Stopping
+    "9d1aaa27d60140bd96365438aad20286": ("inactive", "dead"),       # Stopped
+    "be02cf6855d2428ba40df7e9d022f03d": ("failed", "failed"),       # Failed
+}
+
+# Follows the state of systemd services on the Kria from one long-lived stream,
+# instead of polling `service X status`
+# The journal is followed first, then the current state is read, all over one channel,
+# so no change between the two is missed. Every change gets a sequence number
+class ServiceMonitor:
+    def __init__(self, session, services: list[str], retry: float = 2, poll_interval: float = 1) -> None:
+        self._session = session
+        self._services = services
+        self._retry = retry
+        self._poll_interval = poll_interval
+
+        self._condition = threading.Condition()
+        self._states = {}
+        self._sequence = 0
+        self._connected = False
+        self._stopped = False
+        self._stream = None
+
+        self._thread = threading.Thread(target=self._run, name="service-monitor", daemon=True)
+        self._thread.start()
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    # The sequence number of the latest change
+    def sequence(self) -> int:
+        with self._condition:
+            return self._sequence
+
+    # Latest known state of each service, eg. "active (running)"
+    def states(self) -> dict:
+        with self._condition:
+            return { service: f"{state['active']} ({state['sub']})" for service, state in self._states.items() }
+
+    # Wait for service to become active by a change after sequence
+    # Returns False if that didn't happen within timeout
+    def wait_active(self, service: str, sequence: int, timeout: float = None) -> bool:
+        def became_active():
+            if service not in self._states:
+                return False
+            state = self._states[service]
+            return state["sequence"] > sequence and state["active"] == "active"
+
+        with self._condition:
+            return self._condition.wait_for(became_active, timeout)
+
+    # The state of service straight after restarting it, counted as a change even if it's
+    # the state last seen, as a restart that finished between polls looks like no change
+    def restarted(self, service: str, active: str, sub: str) -> None:
+        self._update(service, active, sub, True)
+
+    def stop(self) -> None:
+        self._stopped = True
+        if self._stream is not None:
+            self._stream.channel.close()
+
+    def _update(self, service: str, active: str, sub: str, force: bool = False) -> None:
+        with self._condition:
+            if not force and service in self._states and self._states[service]["active"] == active and self._states[service]["sub"] == sub:
+                return
+            self._sequence += 1
+            self._states[service] = { "active": active, "sub": sub, "sequence": self._sequence, "time": time.time() }
+            self._condition.notify_all()
+        logger.debug(f"Kria service {service} is now {active} ({sub})")
+
+    def _run(self) -> None:
+        while not self._stopped:
+            try:
+                if self._session.get_client() is not None:
+                    self._follow_journal()
+                else:
+                    # Without SSH there is no stream, so ask the agent instead
+                    self._poll_agent()
+            except Exception as e:
+                if not self._stopped:
+                    logger.warning(f"Kria service monitor lost its stream: {e}\n{traceback.format_exc()}")
+            self._connected = False
+            if not self._stopped:
+                time.sleep(self._retry)
+
+    def _follow_journal(self) -> None:
+        units = " ".join(f"-u {service}" for service in self._services)
+        command = f"journalctl -f -n 0 -o json {units} & sleep 0.5; "
+        command += f"systemctl show -p Id -p ActiveState -p SubState {' '.join(self._services)}; wait"
+
+        _, self._stream, _ = self._session.get_client().exec_command(command)
+        self._connected = True
+
+        shown = {}
+        for line in iter(self._stream.readline, ""):
+            line = line.strip()
+            if line.startswith("{"):
+                self._parse_event(json.loads(line))
+            elif "=" in line:
+                # systemctl show prints one block of Key=Value lines per unit
+                key, value = line.split("=", 1)
+                shown[key] = value
+                if "Id" in shown and "ActiveState" in shown and "SubState" in shown:
+                    self._update(shown["Id"].removesuffix(".service"), shown["ActiveState"], shown["SubState"])
+                    shown = {}
+
+        raise IOError("Journal stream closed")
+
+    def _parse_event(self, event: dict) -> None:
+        if "MESSAGE_ID" not in event or event["MESSAGE_ID"] not in message_states or "UNIT" not in event:
+            return
+
+        active, sub = message_states[event["MESSAGE_ID"]]
+        # A start job that didn't finish leaves the unit failed, not running
+        if active == "active" and "JOB_RESULT" in event and event["JOB_RESULT"] != "done":
+            active, sub = "failed", event["JOB_RESULT"]
+        self._update(event["UNIT"].removesuffix(".service"), active, sub)
+
+    def _poll_agent(self) -> None:
+        agent = self._session.get_agent()
+        while not self._stopped:
+            states = agent.request("service_status", "status", services=self._services)
+            self._connected = True
+            for service, state in states.items():
+                self._update(service, state["active"], state["sub"])
+            time.sleep(self._poll_interval)
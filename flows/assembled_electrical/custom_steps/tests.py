@@ -8,6 +8,8 @@ import uuid
 
 from objects import TestFinishedBehavior
 from .. import boards
+from .arrays import to_arrays, arrays_key, summarize_pedestal_run
+from .limits import check_limits
 from hexactrl_script import zmq_controler as zmqctrl
 from hexactrl_script import i2c_checker
 from hexactrl_script import pedestal_run
@@ -160,9 +162,11 @@ def do_pedestal_run(output_dir: str, data: object) -> None:
     out_data = { "_explode": True }
     for key in returned_data:
         out_data[f"PEDESTAL_RUN:{key}"] = returned_data[key]
+    out_data[arrays_key("PEDESTAL_RUN")] = to_arrays(returned_data)
     return out_data
     
-def check_pedestal_run(input_data: object, data: object) -> object:
+# Corruption and failures reported by the run come first, then the limits in flow.yaml
+def check_pedestal_run(limits: dict, input_data: object, data: object) -> object:
     if data["PEDESTAL_RUN:CORRUPTION"] == "FAIL":
         return {
             "color": "red",
@@ -170,19 +174,23 @@ def check_pedestal_run(input_data: object, data: object) -> object:
             "behavior": TestFinishedBehavior.SKIP_TO_CLEANUP
         }
     elif "PEDESTAL_RUN:TEST_SUCCESS" in data and data["PEDESTAL_RUN:TEST_SUCCESS"] == "FAIL":
+        message = "Failed"
+        if arrays_key("PEDESTAL_RUN") in data:
+            summary = summarize_pedestal_run(data[arrays_key("PEDESTAL_RUN")]["halves"])
+            message = f"Failed: {summary['dead']} Dead, {summary['noisy']} Noisy"
         return {
             "color": "red",
-            "message": "Failed",
+            "message": message,
             "behavior": TestFinishedBehavior.NEXT_STEP
         }
-    elif "PEDESTAL_RUN:TEST_SUCCESS" in data and data["PEDESTAL_RUN:TEST_SUCCESS"] != "FAIL":
+    elif "PEDESTAL_RUN:TEST_SUCCESS" in data and data["PEDESTAL_RUN:TEST_SUCCESS"] != "PASS":
         return {
             "color": "red",
             "message": f"Unknown Status {data['PEDESTAL_RUN:TEST_SUCCESS']}",
             "behavior": TestFinishedBehavior.NEXT_STEP
         }
     else:
-        return True
+        return check_limits(limits, "PEDESTAL_RUN", input_data, data)
     
 # Do a Pedestal Scan
 def do_pedestal_scan(output_dir: str, data: object) -> None:
@@ -201,6 +209,7 @@ def do_pedestal_scan(output_dir: str, data: object) -> None:
 
     for key in returned_data:
         out_data[f"TRIM_INV:{key}"] = returned_data[key]
+    out_data[arrays_key("TRIM_INV")] = to_arrays(returned_data)
         
     logger.info(f"Pedestal Scan Complete, returned {returned_data}")
     logger.debug(f"Pedestal Scan Complete, wrote to stdout/stderr {output.getvalue()}")
@@ -224,6 +233,7 @@ def do_vrefinv(output_dir: str, data: object) -> None:
 
     for key in returned_data:
         out_data[f"INV_VREF:{key}"] = returned_data[key]
+    out_data[arrays_key("INV_VREF")] = to_arrays(returned_data)
         
     logger.info(f"VRefInv Scan Complete, produced output {returned_data}")
     logger.debug(f"VRefInv Scan Complete, wrote to stdout/stderr {output.getvalue()}")
@@ -249,6 +259,7 @@ def do_vrefnoinv(output_dir: str, data: object) -> None:
 
     for key in returned_data:
         out_data[f"NOINV_VREF:{key}"] = returned_data[key]
+    out_data[arrays_key("NOINV_VREF")] = to_arrays(returned_data)
         
     logger.debug(f"VRefNoInv Scan Complete, produced output {returned_data}")
     logger.debug(f"VRefNoInv Scan Complete, wrote to stdout/stderr {output.getvalue()}")
@@ -0,0 +1,202 @@
+import bisect
+import json
+import logging
+import math
+import os
+import re
+import threading
+
+logger = logging.getLogger("results")
+
+# Running mean and variance (Welford's method), with the extremes
+class RunningStats:
+    def __init__(self, count: int = 0, mean: float = 0.0, m2: float = 0.0, minimum: float = None, maximum: float = None) -> None:
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def std(self) -> float:
+        return math.sqrt(self.variance())
+
+    def to_dict(self) -> dict:
+        return { "count": self.count, "mean": self.mean, "m2": self.m2, "min": self.minimum, "max": self.maximum }
+
+    @staticmethod
+    def from_dict(values: dict) -> "RunningStats":
+        return RunningStats(values["count"], values["mean"], values["m2"], values["min"], values["max"])
+
+# Approximate distribution of a stream of values, as a merging t-digest
+# Values are kept as centroids of (mean, weight), small near the tails and larger in
+# the middle, so quantiles stay accurate at the ends. Centroids are merged under the
+# arcsine scale function, each spanning at most one unit of
+# k(q) = compression / (2 pi) * asin(2q - 1), which keeps at most ~compression of them
+class TDigest:
+    def __init__(self, compression: int = 100, centroids: list = None) -> None:
+        self.compression = compression
+        self.centroids = centroids if centroids is not None else []
+        self.buffer = []
+
+    def add(self, value: float) -> None:
+        self.buffer.append(value)
+        if len(self.buffer) >= self.compression:
+            self.compress()
+
+    def compress(self) -> None:
+        if len(self.buffer) == 0:
+            return
+        points = sorted(self.centroids + [[value, 1] for value in self.buffer])
+        self.buffer = []
+
+        total = sum(weight for _, weight in points)
+        merged = [list(points[0])]
+        cumulative = 0
+        limit = total * self._quantile_limit(0)
+        for mean, weight in points[1:]:
+            current = merged[-1]
+            proposed = current[1] + weight
+            if cumulative + proposed <= limit:
+                current[0] += (mean - current[0]) * weight / proposed
+                current[1] = proposed
+            else:
+                cumulative += current[1]
+                limit = total * self._quantile_limit(cumulative / total)
+                merged.append([mean, weight])
+        self.centroids = merged
+
+    # The furthest quantile a centroid starting at quantile may reach: one unit of k on
+    def _quantile_limit(self, quantile: float) -> float:
+        k = self.compression / (2 * math.pi) * math.asin(2 * quantile - 1) + 1
+        return 1.0 if k >= self.compression / 4 else (math.sin(2 * math.pi * k / self.compression) + 1) / 2
+
+    # Fraction of values at or below value, interpolating between centroids
+    # minimum and maximum are the extremes seen, which anchor the ends
+    def cdf(self, value: float, minimum: float, maximum: float) -> float:
+        self.compress()
+        if len(self.centroids) == 0:
+            return None
+        if value < minimum:
+            return 0.0
+        if value >= maximum:
+            return 1.0
+
+        total = sum(weight for _, weight in self.centroids)
+        positions = [minimum]
+        ranks = [0.0]
+        cumulative = 0
+        for mean, weight in self.centroids:
+            positions.append(mean)
+            ranks.append(cumulative + weight / 2)
+            cumulative += weight
+        positions.append(maximum)
+        ranks.append(total)
+
+        index = bisect.bisect_right(positions, value)
+        low, high = positions[index - 1], positions[index]
+        fraction = (value - low) / (high - low) if high > low else 1.0
+        return (ranks[index - 1] + fraction * (ranks[index] - ranks[index - 1])) / total
+
+    def to_list(self) -> list:
+        self.compress()
+        return [[round(mean, 9), weight] for mean, weight in self.centroids]
+
+# The metrics compared across the fleet, as patterns of test data keys
+fleet_metrics = [
+    re.compile(r"^POWER:(DEFAULT|CONFIGURED)$"),
+    re.compile(r"^PEDESTAL_RUN:\d+:\d+:NOISE$"),
+    re.compile(r"^TRIM_INV:\d+:\d+:SLOPE_AVG$"),
+    re.compile(r"^(INV|NOINV)_VREF:\d+:\d+:SLOPE$"),
+]
+
+def is_fleet_metric(key: str) -> bool:
+    return any(pattern.match(key) for pattern in fleet_metrics)
+
+# Statistics of every fleet metric, per board type, kept in one JSON file
+# Each finished test adds its values to the running statistics and digests, and the
+# whole file is rewritten, which stays small: each digest is at most ~compression centroids
+class FleetStats:
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.version = 0
+
+        if os.path.exists(path):
+            with open(path) as fin:
+                for board, metrics in json.load(fin).items():
+                    self._stats[board] = {
+                        metric: (RunningStats.from_dict(entry["running"]), TDigest(centroids=entry["digest"]))
+                        for metric, entry in metrics.items()
+                    }
+
+    # Add the fleet metrics of a finished test
+    def update(self, board: str, data: object) -> None:
+        with self._lock:
+            metrics = self._stats.setdefault(board, {})
+            for key in data:
+                if not isinstance(key, str) or not is_fleet_metric(key):
+                    continue
+                value = data[key]
+                if not isinstance(value, (int, float)) or isinstance(value, bool) or math.isnan(value):
+                    continue
+
+                if key not in metrics:
+                    metrics[key] = (RunningStats(), TDigest())
+                running, digest = metrics[key]
+                running.add(value)
+                digest.add(value)
+            self.version += 1
+            self.save()
+
+    def save(self) -> None:
+        contents = {
+            board: { metric: { "running": running.to_dict(), "digest": digest.to_list() } for metric, (running, digest) in metrics.items() }
+            for board, metrics in self._stats.items()
+        }
+
+        directory = os.path.dirname(self._path)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self._path + ".tmp", "w") as fout:
+            json.dump(contents, fout, separators=(",", ":"))
+        os.replace(self._path + ".tmp", self._path)
+
+    # Percentile (0-100) of value among the board type's earlier values of metric
+    # None until enough boards have been seen to say
+    def percentile(self, board: str, metric: str, value: float, minimum_count: int = 5) -> float:
+        with self._lock:
+            if board not in self._stats or metric not in self._stats[board]:
+                return None
+            running, digest = self._stats[board][metric]
+            if running.count < minimum_count:
+                return None
+            return 100 * digest.cdf(value, running.minimum, running.maximum)
+
+    def summary(self, board: str, metric: str) -> dict:
+        with self._lock:
+            if board not in self._stats or metric not in self._stats[board]:
+                return None
+            running = self._stats[board][metric][0]
+            return { "count": running.count, "mean": running.mean, "std": running.std(), "min": running.minimum, "max": running.maximum }
+
+# One FleetStats per file, shared by every station in the process
+loaded = {}
+loaded_lock = threading.Lock()
+
+def get_fleet_stats(path: str) -> FleetStats:
+    with loaded_lock:
+        if path not in loaded:
+            loaded[path] = FleetStats(path)
+        return loaded[path]
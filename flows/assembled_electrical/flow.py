@@ -7,8 +7,13 @@ from .custom_steps.powersupplies import multimodule_distribution_hub, siglent_sp
 from .custom_steps.kria import *
 from .custom_steps.scanner import *
 from .custom_steps.tests import *
-from .custom_steps.cleanup import cleanup
+from .custom_steps.reference import compare_to_reference, check_reference
+from .custom_steps.cleanup import cleanup, start_archive
 from .watcher import Watcher
+from .fleet_stats import get_fleet_stats
+from .archiver import get_archive_queue
+from .uploader import get_uploader
+from .blob_store import get_blob_store
 
 from functools import partial
 
@@ -17,13 +22,28 @@ import os
 
 import yaml
 
+config_path = "flows/assembled_electrical/flow.yaml"
+
+# Stations to run side by side in one process. Each entry has a name,
+# plus keys overriding the shared config. Empty for a single station
+def load_stations() -> list[dict]:
+    with open(config_path) as fin:
+        stations = yaml.safe_load(fin).get("stations")
+    return stations if stations else []
+
 # Required for unpack
+# Overrides replace keys of the config section, eg. for one station of several
 class AssembledHexaboardFlow(TestFlow):
-    def __init__(self):
-        with open("flows/assembled_electrical/flow.yaml") as fin:
+    def __init__(self, overrides: dict = None):
+        with open(config_path) as fin:
             self._config = yaml.safe_load(fin)
 
-        os.environ["PATH"] = os.environ["PATH"] + ":" + os.path.abspath(os.path.join(self._config["config"]["hexactrl_sw_dir"], "bin"))
+        if overrides is not None:
+            self._config["config"].update(overrides)
+
+        bin_dir = os.path.abspath(os.path.join(self._config["config"]["hexactrl_sw_dir"], "bin"))
+        if bin_dir not in os.environ["PATH"].split(":"):
+            os.environ["PATH"] = os.environ["PATH"] + ":" + bin_dir
         
         config = self._config["config"]
         self.power_supply = None
@@ -35,9 +55,17 @@ class AssembledHexaboardFlow(TestFlow):
             logger.critical(f"Unknown power supply {config['power_supply']}")
 
 
-        self._setup_steps = load_steps(self._config["initialization"], config, self.power_supply)
-        self._runtime_steps = load_steps(self._config["runtime"], config, self.power_supply)
-        self._shutdown_steps = load_steps(self._config["shutdown"], config, self.power_supply)
+        # Started now, so uploads and archives a restart cut short carry on before the first test ends
+        uploader = get_uploader(config["upload"]) if "upload" in config else None
+        blob_store = get_blob_store(config["blob_store"]) if "blob_store" in config else None
+        if "archive" in config:
+            get_archive_queue(config["archive"]["queue"], config["archive"],
+                              uploader.enqueue_file if uploader is not None else None, blob_store)
+
+        limits = self._config["limits"] if "limits" in self._config else None
+        self._setup_steps = load_steps(self._config["initialization"], config, self.power_supply, limits)
+        self._runtime_steps = load_steps(self._config["runtime"], config, self.power_supply, limits)
+        self._shutdown_steps = load_steps(self._config["shutdown"], config, self.power_supply, limits)
 
 
     def get_steps(self, stage: TestStage) -> list[TestStep]:
@@ -49,9 +77,19 @@ class AssembledHexaboardFlow(TestFlow):
             return self._shutdown_steps
     
     def get_watcher(self, fetch_data) -> QWidget:
-        return Watcher(fetch_data, self.power_supply)
-
-def load_steps(steps: object, config: object, power_supply: object) -> list[TestStep]:
+        config = self._config["config"]
+        fleet_stats = get_fleet_stats(config["fleet_stats"]) if "fleet_stats" in config else None
+        archive_queue = get_archive_queue(config["archive"]["queue"], config["archive"]) if "archive" in config else None
+        uploader = get_uploader(config["upload"]) if "upload" in config else None
+        return Watcher(fetch_data, self.power_supply, self._config.get("watcher"), fleet_stats, archive_queue, uploader)
+
+    # Each test journals its results beside its other output, once its DUT is known
+    def get_journal_path(self, data) -> str:
+        if "dut" not in data:
+            return None
+        return os.path.join(self._config["config"]["output_dir"], data["dut"], "journal.ndjson")
+
+def load_steps(steps: object, config: object, power_supply: object, limits: dict = None) -> list[TestStep]:
     loaded_steps = []
     for step in steps:
         skip_optional = config["skip_optional"] if "skip_optional" in config else False
@@ -62,7 +100,7 @@ def load_steps(steps: object, config: object, power_supply: object) -> list[Test
         if "enabled" in step and not step["enabled"]:
             continue
 
-        loaded_steps.append(load_step(step, config, power_supply))
+        loaded_steps.append(load_step(step, config, power_supply, limits))
 
     return loaded_steps
 
@@ -76,7 +114,7 @@ def fetch_images(out_dir, pattern, data):
     return glob.glob(os.path.join(out_dir, data["dut"], pattern))
 
 # Load a step from YAML
-def load_step(step: object, config: object, power_supply: object) -> TestStep:
+def load_step(step: object, config: object, power_supply: object, limits: dict = None) -> TestStep:
     try:
         if step["type"] == "display":
             return DisplayStep(step["name"], step["text"], step["image"] if "image" in step else None)
@@ -113,11 +151,11 @@ def load_step(step: object, config: object, power_supply: object) -> TestStep:
 
         # Custom Steps
         if step["type"] == "select_user":
-            return SelectStep(step["name"], step["text"], config["users"])
+            return SelectStep(step["name"], step["text"], config["users"], step["data_field"] if "data_field" in step else None)
         
         # Kria
         elif step["type"] == "kria_wait":
-            return easy_dynamic_thread(partial(wait_for_kria, kria_address, step["delay"]))
+            return easy_dynamic_thread(partial(wait_for_kria, kria_address, config.get("kria_agent_port"), step["delay"]))
         elif step["type"] == "kria_enable":
             return easy_dynamic_thread(enable_kria)
         elif step["type"] == "kria_load_firmware":
@@ -129,7 +167,7 @@ def load_step(step: object, config: object, power_supply: object) -> TestStep:
 
         # Power Supply
         elif step["type"] == "power_supply_wait":
-            return easy_dynamic_thread(partial(power_supply.wait_for_power_supply, config["power_supply_address"], step["delay"]))
+            return easy_dynamic_thread(partial(power_supply.wait_for_power_supply, config["power_supply_address"], config["power_supply_channel"], step["delay"]))
         elif step["type"] == "power_supply_enable":
             return easy_dynamic_thread(power_supply.enable_power_supply)
         elif step["type"] == "power_supply_disable":
@@ -163,18 +201,30 @@ def load_step(step: object, config: object, power_supply: object) -> TestStep:
         elif step["type"] == "tests_initialize_sockets":
             return easy_dynamic_thread(do_initialize_sockets)
         elif step["type"] == "tests_pedestal_run":
-            return easy_dynamic_thread_with_files(partial(do_pedestal_run, output_dir), check_pedestal_run)
+            return easy_dynamic_thread_with_files(partial(do_pedestal_run, output_dir), partial(check_pedestal_run, limits))
+        elif step["type"] == "tests_reference_compare":
+            test = step["test"] if "test" in step else "PEDESTAL_RUN"
+            fields = step["fields"] if "fields" in step else ["NOISE", "PEDESTAL"]
+            z_threshold = step["z_threshold"] if "z_threshold" in step else 5
+            return easy_dynamic_thread_with_validator(partial(compare_to_reference, test, fields, z_threshold), check_reference)
         elif step["type"] == "tests_pedestal_scan":
-            return easy_dynamic_thread_with_files(partial(do_pedestal_scan, output_dir), None)
+            return easy_dynamic_thread_with_files(partial(do_pedestal_scan, output_dir), partial(check_limits, limits, "TRIM_INV"))
         elif step["type"] == "tests_vrefinv":
-            return easy_dynamic_thread_with_files(partial(do_vrefinv, output_dir), None)
+            return easy_dynamic_thread_with_files(partial(do_vrefinv, output_dir), partial(check_limits, limits, "INV_VREF"))
         elif step["type"] == "tests_vrefnoinv":
-            return easy_dynamic_thread_with_files(partial(do_vrefnoinv, output_dir), None)
+            return easy_dynamic_thread_with_files(partial(do_vrefnoinv, output_dir), partial(check_limits, limits, "NOINV_VREF"))
         
-        # Cleanup
+        # Archiving, Cleanup
+        elif step["type"] == "archive_start":
+            return easy_dynamic_thread(partial(start_archive, config["output_dir"], config["archive"] if "archive" in config else None))
         elif step["type"] == "cleanup":
             archive = True if "archive" not in step else step["archive"]
-            return easy_dynamic_thread(partial(cleanup, config["output_dir"], archive))
+            archive_settings = config["archive"] if "archive" in config else None
+            upload_settings = config["upload"] if "upload" in config else None
+            blob_store = config["blob_store"] if "blob_store" in config else None
+            results_db = config["results_db"] if "results_db" in config else None
+            fleet_stats = config["fleet_stats"] if "fleet_stats" in config else None
+            return easy_dynamic_thread(partial(cleanup, config["output_dir"], archive, archive_settings, upload_settings, blob_store, results_db, fleet_stats))
 
     except Exception as e:
         raise ValueError("Invalid step", step, e)
@@ -0,0 +1,281 @@
+"""Indexed store of test results, one row per tested board
+
+Cleanup adds every finished test. Earlier output.msgpack (or older output.json)
+files can be imported with backfill. From the repository root:
+
+    python -m flows.assembled_electrical.results_db --db data/results.sqlite backfill data
+    python -m flows.assembled_electrical.results_db --db data/results.sqlite query \\
+        --board ld-full --since 2026-10-12 --key I2C_CHECKER:DEFAULT --value FAILURE --count
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from collections.abc import Mapping
+
+import argparse
+import datetime
+import enum
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+import serialization
+
+from .boards import boards
+
+logger = logging.getLogger("results")
+
+schema = """
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    dut TEXT UNIQUE NOT NULL,
+    barcode TEXT,
+    board TEXT,
+    user TEXT,
+    started TEXT,
+    finished TEXT,
+    output_path TEXT
+);
+CREATE TABLE IF NOT EXISTS rocs (
+    test_id INTEGER NOT NULL REFERENCES tests(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    roc_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    test_id INTEGER NOT NULL REFERENCES tests(id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    number REAL,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS tests_barcode ON tests(barcode);
+CREATE INDEX IF NOT EXISTS tests_board ON tests(board, started);
+CREATE INDEX IF NOT EXISTS tests_user ON tests(user, started);
+CREATE INDEX IF NOT EXISTS tests_started ON tests(started);
+CREATE INDEX IF NOT EXISTS tests_finished ON tests(finished);
+CREATE INDEX IF NOT EXISTS rocs_roc_id ON rocs(roc_id);
+CREATE INDEX IF NOT EXISTS rocs_test ON rocs(test_id);
+CREATE INDEX IF NOT EXISTS results_key_text ON results(key, text);
+CREATE INDEX IF NOT EXISTS results_key_number ON results(key, number);
+CREATE INDEX IF NOT EXISTS results_test ON results(test_id);
+"""
+
+# A DUT is named "<barcode>-<time the board was verified>"
+dut_pattern = re.compile(r"^(.*)-(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(?:\.\d+)?)$")
+roc_pattern = re.compile(r"^ROC(\d+)$")
+
+def parse_dut(dut: str) -> tuple[str, str]:
+    match = dut_pattern.match(dut)
+    if match is None:
+        return dut, None
+    return match.group(1), datetime.datetime.fromisoformat(match.group(2)).isoformat()
+
+# The board type whose search key is in the barcode, as the board verification step finds it
+def board_from_barcode(barcode: str) -> str:
+    for key, board in boards.items():
+        if "search_key" in board and board["search_key"] in barcode:
+            return key
+    return None
+
+# One test's row, its ROCs and its results, from the non-underscored test data
+def test_record(data: Mapping, board: str = None, finished: str = None, output_path: str = None) -> dict:
+    barcode, started = parse_dut(data["dut"])
+    rocs = []
+    results = []
+    for key in data:
+        if key.startswith("_"):
+            continue
+        value = data[key]
+        if isinstance(value, np.generic):
+            value = value.item()
+        elif isinstance(value, (enum.Enum, serialization.EnumValue)):
+            value = value.name
+
+        match = roc_pattern.match(key)
+        if match is not None:
+            rocs.append((int(match.group(1)), str(value)))
+
+        if isinstance(value, bool):
+            results.append((key, float(value), str(value)))
+        elif isinstance(value, (int, float)):
+            results.append((key, float(value), None))
+        elif isinstance(value, str):
+            results.append((key, None, value))
+        else:
+            results.append((key, None, json.dumps(value, default=serialization.json_default)))
+
+    return {
+        "dut": data["dut"],
+        "barcode": barcode,
+        "board": board if board is not None else board_from_barcode(barcode),
+        "user": data["USER"] if "USER" in data else None,
+        "started": started,
+        "finished": finished,
+        "output_path": output_path,
+        "rocs": rocs,
+        "results": results,
+    }
+
+# Read one output.msgpack or output.json into a record, in a worker process during backfill
+def load_output(path: str) -> dict:
+    try:
+        if path.endswith(".msgpack"):
+            data = serialization.load(path)["data"]
+        else:
+            with open(path) as fin:
+                data = json.load(fin)
+        finished = datetime.datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+        return test_record(data, finished=finished, output_path=path)
+    except Exception as e:
+        logger.warning(f"Could not read {path}: {e}")
+        return None
+
+class ResultsDB:
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        # Several stations may write at once
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA foreign_keys=ON")
+        self._connection.executescript(schema)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    # Add records, replacing any earlier record of the same DUT
+    def insert_records(self, records: list[dict]) -> int:
+        with self._lock, self._connection:
+            for record in records:
+                self._connection.execute("DELETE FROM tests WHERE dut = ?", (record["dut"],))
+                cursor = self._connection.execute(
+                    "INSERT INTO tests (dut, barcode, board, user, started, finished, output_path) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (record["dut"], record["barcode"], record["board"], record["user"], record["started"], record["finished"], record["output_path"]))
+                test_id = cursor.lastrowid
+                self._connection.executemany("INSERT INTO rocs (test_id, position, roc_id) VALUES (?, ?, ?)",
+                                             [(test_id, position, roc_id) for position, roc_id in record["rocs"]])
+                self._connection.executemany("INSERT INTO results (test_id, key, number, text) VALUES (?, ?, ?, ?)",
+                                             [(test_id, key, number, text) for key, number, text in record["results"]])
+        return len(records)
+
+    # Add a test from its test data, as cleanup does
+    def insert(self, data: Mapping, board: str = None, output_path: str = None) -> None:
+        self.insert_records([test_record(data, board, datetime.datetime.now().isoformat(), output_path)])
+
+    def _where(self, board, user, barcode, roc, since, until, key, value) -> tuple[str, list]:
+        clauses = []
+        parameters = []
+        if board is not None:
+            clauses.append("tests.board = ?")
+            parameters.append(board)
+        if user is not None:
+            clauses.append("tests.user = ?")
+            parameters.append(user)
+        if barcode is not None:
+            clauses.append("tests.barcode = ?")
+            parameters.append(barcode)
+        if roc is not None:
+            clauses.append("tests.id IN (SELECT test_id FROM rocs WHERE roc_id = ?)")
+            parameters.append(roc)
+        if since is not None:
+            clauses.append("tests.started >= ?")
+            parameters.append(since)
+        if until is not None:
+            clauses.append("tests.started < ?")
+            parameters.append(until)
+        if key is not None and value is None:
+            clauses.append("tests.id IN (SELECT test_id FROM results WHERE key = ?)")
+            parameters.append(key)
+        elif key is not None:
+            clauses.append("tests.id IN (SELECT test_id FROM results WHERE key = ? AND (text = ? OR number = ?))")
+            parameters += [key, str(value), value]
+        return (" WHERE " + " AND ".join(clauses)) if len(clauses) > 0 else "", parameters
+
+    # Tests matching every given filter, newest first. since and until are ISO times
+    # key alone matches tests with that result, key and value those where it equals value
+    def query(self, board: str = None, user: str = None, barcode: str = None, roc: str = None,
+              since: str = None, until: str = None, key: str = None, value=None, limit: int = None) -> list[dict]:
+        where, parameters = self._where(board, user, barcode, roc, since, until, key, value)
+        sql = f"SELECT * FROM tests{where} ORDER BY started DESC"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self._lock:
+            return [dict(row) for row in self._connection.execute(sql, parameters)]
+
+    def count(self, board: str = None, user: str = None, barcode: str = None, roc: str = None,
+              since: str = None, until: str = None, key: str = None, value=None) -> int:
+        where, parameters = self._where(board, user, barcode, roc, since, until, key, value)
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM tests{where}", parameters).fetchone()[0]
+
+    # Every result of one test, as {key: value}
+    def results(self, dut: str) -> dict:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key, number, text FROM results JOIN tests ON tests.id = results.test_id WHERE tests.dut = ?", (dut,))
+            return { row["key"]: row["text"] if row["text"] is not None else row["number"] for row in rows }
+
+    # Import every test's output under out_dir, parsed across a pool of processes
+    # Tests with both prefer output.msgpack
+    def backfill(self, out_dir: str, workers: int = None, batch: int = 500) -> int:
+        paths = []
+        for test_dir in glob.glob(os.path.join(out_dir, "*")):
+            for name in ["output.msgpack", "output.json"]:
+                if os.path.exists(os.path.join(test_dir, name)):
+                    paths.append(os.path.join(test_dir, name))
+                    break
+        logger.info(f"Backfilling {len(paths)} tests from {out_dir}")
+
+        imported = 0
+        records = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for record in pool.map(load_output, paths, chunksize=64):
+                if record is None:
+                    continue
+                records.append(record)
+                if len(records) >= batch:
+                    imported += self.insert_records(records)
+                    records = []
+        imported += self.insert_records(records)
+        logger.info(f"Backfilled {imported} tests")
+        return imported
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Query and fill the test results database")
+    parser.add_argument("--db", default="data/results.sqlite", help="Database file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backfill = commands.add_parser("backfill", help="Import test outputs from an output directory")
+    backfill.add_argument("out_dir")
+    backfill.add_argument("--workers", type=int, default=None, help="Processes parsing files")
+
+    query = commands.add_parser("query", help="List or count matching tests")
+    for option in ["board", "user", "barcode", "roc", "since", "until", "key", "value"]:
+        query.add_argument(f"--{option}")
+    query.add_argument("--limit", type=int)
+    query.add_argument("--count", action="store_true", help="Only print how many tests match")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    db = ResultsDB(args.db)
+
+    if args.command == "backfill":
+        db.backfill(args.out_dir, args.workers)
+    elif args.count:
+        print(db.count(args.board, args.user, args.barcode, args.roc, args.since, args.until, args.key, args.value))
+    else:
+        for row in db.query(args.board, args.user, args.barcode, args.roc, args.since, args.until, args.key, args.value, args.limit):
+            print(f"{row['started']}  {row['board']}  {row['barcode']}  {row['user']}  {row['dut']}")
+
+    db.close()
+
+if __name__ == "__main__":
+    main()
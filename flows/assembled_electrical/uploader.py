@@ -0,0 +1,250 @@
+"""Uploads of test results and archives, from a queue kept on disk
+
+Cleanup queues each finished test's result record, and the archive queue each archive
+once made. Background threads send them to the upload endpoint: records in batches,
+files in chunks that resume where the server left off. Anything that fails is retried
+with backoff, and the queue (an SQLite file) outlives restarts, so nothing queued is
+lost to a network outage. Everything is keyed by the SHA-256 of its contents, so the
+same contents are only sent once: queueing them again does nothing, even long after
+they were sent, unless queued with force=True (eg. after the server lost them).
+
+The endpoint answers:
+
+    POST  /records          {"records": [{"hash", "record"}]}, storing each once
+    HEAD  /blobs/<sha256>   Upload-Offset: bytes received, Upload-Complete: 1 once whole
+    PATCH /blobs/<sha256>   a chunk at Upload-Offset, of a file of Upload-Length bytes,
+                            answering Upload-Offset, and Upload-Complete: 1 once whole
+
+remote/upload_server.py is a stand-in for it.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import serialization
+
+logger = logging.getLogger("upload")
+
+schema = """
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    hash TEXT UNIQUE NOT NULL,
+    path TEXT,
+    payload TEXT,
+    size INTEGER,
+    sent INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    created TEXT
+);
+CREATE INDEX IF NOT EXISTS uploads_ready ON uploads(state, kind, next_attempt);
+"""
+
+def file_hash(path: str, block_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class Uploader:
+    def __init__(self, queue_path: str, endpoint: str, batch_size: int = 50, chunk_size: int = 4 * 1024 * 1024,
+                 concurrency: int = 2, max_backoff: float = 300, timeout: float = 30) -> None:
+        directory = os.path.dirname(queue_path)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._endpoint = endpoint.rstrip("/")
+        self._batch_size = batch_size
+        self._chunk_size = chunk_size
+        self._max_backoff = max_backoff
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.last_error = None
+
+        self._connection = sqlite3.connect(queue_path, check_same_thread=False, timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(schema)
+        # Cut short by a restart, so sent again (files from where the server got to)
+        with self._connection:
+            self._connection.execute("UPDATE uploads SET state = 'pending' WHERE state = 'sending'")
+
+        self._threads = [threading.Thread(target=self.run, name=f"uploader-{i}", daemon=True) for i in range(concurrency)]
+        for thread in self._threads:
+            thread.start()
+
+    # With force, contents already queued are sent again from scratch, unless being sent now
+    def _add(self, kind: str, hash: str, path: str, payload: str, size: int, force: bool = False) -> bool:
+        conflict = "DO UPDATE SET path = excluded.path, payload = excluded.payload, size = excluded.size, sent = 0, " \
+                   "state = 'pending', attempts = 0, next_attempt = 0, error = NULL WHERE state != 'sending'" if force else "DO NOTHING"
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO uploads (kind, hash, path, payload, size, created) VALUES (?, ?, ?, ?, ?, ?) "
+                f"ON CONFLICT(hash) {conflict}",
+                (kind, hash, path, payload, size, datetime.datetime.now().isoformat()))
+        if cursor.rowcount == 0:
+            logger.info(f"Already queued {kind} {hash[:12]}, not queueing it again")
+            return False
+        self._wake.set()
+        return True
+
+    # Queue a file (eg. an archive) to be uploaded. Its contents must not change after
+    def enqueue_file(self, path: str, force: bool = False) -> bool:
+        return self._add("file", file_hash(path), os.path.abspath(path), None, os.path.getsize(path), force)
+
+    # Queue a result record, anything serialization.json_default can write
+    def enqueue_record(self, record: object, force: bool = False) -> bool:
+        payload = json.dumps(record, default=serialization.json_default, sort_keys=True)
+        return self._add("record", hashlib.sha256(payload.encode()).hexdigest(), None, payload, len(payload), force)
+
+    # The oldest ready work: a batch of records, else one file
+    def _claim(self) -> tuple[str, list[sqlite3.Row]]:
+        with self._lock, self._connection:
+            now = time.time()
+            for kind, limit in [("record", self._batch_size), ("file", 1)]:
+                rows = self._connection.execute(
+                    "SELECT * FROM uploads WHERE state = 'pending' AND kind = ? AND next_attempt <= ? ORDER BY id LIMIT ?",
+                    (kind, now, limit)).fetchall()
+                if len(rows) > 0:
+                    self._connection.executemany("UPDATE uploads SET state = 'sending' WHERE id = ?", [(row["id"],) for row in rows])
+                    return kind, rows
+        return None, []
+
+    def _set(self, rows: list, **fields) -> None:
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self._lock, self._connection:
+            self._connection.executemany(f"UPDATE uploads SET {assignments} WHERE id = ?",
+                                         [(*fields.values(), row["id"]) for row in rows])
+
+    # Back off exponentially, with jitter so stations don't retry in step
+    def _failed(self, rows: list, error: Exception) -> None:
+        with self._lock:
+            self.last_error = str(error)
+        attempts = max(row["attempts"] for row in rows) + 1
+        delay = min(self._max_backoff, 2 ** attempts) * random.uniform(0.5, 1)
+        logger.warning(f"Upload of {len(rows)} {rows[0]['kind']}(s) failed (attempt {attempts}), retrying in {delay:.0f}s: {error}")
+        self._set(rows, state="pending", attempts=attempts, next_attempt=time.time() + delay, error=str(error))
+
+    def run(self) -> None:
+        while True:
+            kind, rows = self._claim()
+            if kind is None:
+                self._wake.wait(1)
+                self._wake.clear()
+                continue
+
+            try:
+                sent = self.send_records(rows) if kind == "record" else self.send_file(rows[0])
+            except Exception as e:
+                self._failed(rows, e)
+                continue
+            if sent:
+                self._set(rows, state="done", error=None)
+                with self._lock:
+                    self.last_error = None
+
+    def _request(self, method: str, path: str, body: bytes = None, headers: dict = None) -> object:
+        request = urllib.request.Request(self._endpoint + path, data=body, headers=headers or {}, method=method)
+        return urllib.request.urlopen(request, timeout=self._timeout)
+
+    def send_records(self, rows: list) -> bool:
+        body = json.dumps({ "records": [{ "hash": row["hash"], "record": json.loads(row["payload"]) } for row in rows] })
+        with self._request("POST", "/records", body.encode(), { "Content-Type": "application/json" }) as response:
+            response.read()
+        logger.info(f"Uploaded {len(rows)} records")
+        return True
+
+    # Send a file in chunks, from however much of it the server already has
+    # False if the file is gone, which retrying can't fix: it's kept as missing for someone to look at
+    def send_file(self, row: sqlite3.Row) -> bool:
+        if not os.path.exists(row["path"]):
+            logger.critical(f"Queued upload {row['path']} no longer exists")
+            self._set([row], state="missing", error="File no longer exists")
+            return False
+
+        with self._request("HEAD", f"/blobs/{row['hash']}") as response:
+            offset = int(response.headers.get("Upload-Offset", 0))
+            if response.headers.get("Upload-Complete") == "1":
+                logger.info(f"Server already has {row['path']}")
+                return True
+
+        # Files are only done once the server says it has checked them, so the last PATCH is
+        # empty when the server already has every byte (eg. an empty file, or a server that
+        # stopped before checking). A PATCH that gets no further is an error, to back off
+        with open(row["path"], "rb") as fin:
+            while True:
+                fin.seek(offset)
+                chunk = fin.read(min(self._chunk_size, row["size"] - offset))
+                headers = {
+                    "Upload-Offset": str(offset),
+                    "Upload-Length": str(row["size"]),
+                    "Upload-Name": os.path.basename(row["path"]),
+                    "Content-Type": "application/offset+octet-stream",
+                }
+                try:
+                    with self._request("PATCH", f"/blobs/{row['hash']}", chunk, headers) as response:
+                        received = int(response.headers["Upload-Offset"])
+                        complete = response.headers.get("Upload-Complete") == "1"
+                except urllib.error.HTTPError as e:
+                    # The server has a different amount than we thought, so carry on from there
+                    if e.code != 409:
+                        raise
+                    received = int(e.headers["Upload-Offset"])
+                    complete = False
+
+                if complete:
+                    break
+                if received == offset or received > row["size"]:
+                    raise IOError(f"Server is stuck at {received} of {row['size']} bytes of {row['path']}")
+                offset = received
+                self._set([row], sent=offset)
+        logger.info(f"Uploaded {row['path']}")
+        return True
+
+    # How many uploads are in each state, and the latest error while any are failing
+    def status(self) -> dict:
+        with self._lock:
+            counts = { row["state"]: row["count"] for row in
+                       self._connection.execute("SELECT state, COUNT(*) AS count FROM uploads GROUP BY state") }
+            waiting = self._connection.execute(
+                "SELECT COALESCE(SUM(size - sent), 0) FROM uploads WHERE state IN ('pending', 'sending')").fetchone()[0]
+            error = self.last_error
+        return { "counts": counts, "waiting_bytes": waiting, "error": error }
+
+    # Wait until nothing is left to send, or timeout seconds pass
+    def join(self, timeout: float = None) -> bool:
+        deadline = time.time() + timeout if timeout is not None else None
+        while deadline is None or time.time() < deadline:
+            counts = self.status()["counts"]
+            if counts.get("pending", 0) + counts.get("sending", 0) == 0:
+                return True
+            time.sleep(0.1)
+        return False
+
+# One uploader per queue file, shared by every station in the process
+loaded = {}
+loaded_lock = threading.Lock()
+
+def get_uploader(settings: dict) -> Uploader:
+    with loaded_lock:
+        if settings["queue"] not in loaded:
+            loaded[settings["queue"]] = Uploader(settings["queue"], settings["endpoint"],
+                settings["batch_size"] if "batch_size" in settings else 50,
+                settings["chunk_size"] if "chunk_size" in settings else 4 * 1024 * 1024,
+                settings["concurrency"] if "concurrency" in settings else 2,
+                settings["max_backoff"] if "max_backoff" in settings else 300)
+        return loaded[settings["queue"]]
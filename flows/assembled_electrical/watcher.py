@@ -1,12 +1,17 @@
-from PyQt6.QtCore import QThread, pyqtSignal
-from PyQt6.QtWidgets import QWidget, QFormLayout, QLabel, QTabWidget, QVBoxLayout
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex
+from PyQt6.QtWidgets import QWidget, QFormLayout, QLabel, QTabWidget, QTableView, QVBoxLayout
 from PyQt6.QtGui import QFontDatabase
 
+from functools import partial
+
 import logging
+import math
 import os
-import time
-import traceback
 
+from broker import broker
+from watcher_service import Probe, WatcherService
+
+from .custom_steps.arrays import arrays_key, half_rows
 from hexactrl_script import i2c_checker
 
 logger = logging.getLogger("watcher")
@@ -23,6 +28,9 @@ labels_standalone = [
     "Pedestal Run Corruption",
     "Pedestal Run Dead Channels",
     "Pedestal Run Noisy Channels",
+    "Reference Comparison",
+    "Archive",
+    "Upload",
 ]
 
 labels_in_tabs = [
@@ -42,193 +50,311 @@ def check_status(status):
     else:
         return "blue"
 
-def pedestal_run_validator(key, _, data):
-    noisy = int(data[key + "NUMBER_CHANNELS_NOISE_MORE2"])
-    dead = int(data[key + "NUMBER_CHANNELS_NOISE_AT0"])
-
-    color = "green"
-    if noisy > 0 and noisy < 2:
-        color = "gold"
-    elif dead > 0 and dead < 2:
-        color = "gold"
-    elif noisy > 2 or dead > 2:
-        color = "red"
-
-    return [f"{noisy} Noisy, {dead} Dead", color]
+# Check Local DAQ
+def probe_daq_client(data: object) -> dict:
+    # The local daq-client is shared by every slot, so poll it once for all
+    daq_status = broker.cached("daq-client status", 1, lambda: os.popen("systemctl status daq-client").read())
+    daq_status = daq_status.split("Active: ")[1].split(" since")[0]
+    logger.debug(f"Recieved daq-client status {daq_status}")
+
+    return { "DAQ Client": [daq_status, "green" if daq_status == "active (running)" else "red"] }
+
+# Check Kria Services
+def probe_kria(data: object) -> dict:
+    session = data["_kria"]
+    if not session.is_active():
+        return { "Kria": ["Crashed, Not Active", "red"] }
+
+    # The latest state the monitor was told about, when it's following the Kria
+    # Otherwise both in one round trip, on the session's status lane so steps aren't held up
+    monitor = session.get_monitor()
+    states = monitor.states() if monitor is not None and monitor.is_connected() else {}
+    if "daq-server" not in states or "i2c-server" not in states:
+        states = session.service_status(["daq-server", "i2c-server"], lane="status", timeout=1)
+
+    daq_response = states["daq-server"]
+    logger.debug(f"Recieved daq-server status {daq_response}")
+
+    i2c_response = states["i2c-server"]
+    logger.debug(f"Recieved i2c-server status {i2c_response}")
+
+    text = f"I2C: {i2c_response}\nDAQ: {daq_response}"
+    color = "green" if i2c_response == "active (running)" and daq_response == "active (running)" else "red"
+    return { "Kria": [text, color] }
+
+# Check Power Supply
+def probe_power_supply(power_supply: object, data: object) -> dict:
+    result = power_supply.check_power(data)
+    output = []
+    if "state" in result:
+        output += [result["state"]]
+
+    output += [f"{result['voltage']:.3f}V"]
+
+    if "current_digital" in result:
+        output += [f"{result['current_digital']:.3f}A Digital"]
+        output += [f"{result['current_analog']:.3f}A Analog"]
+    else:
+        output += [f"{result['current']:.3f}V"]
+    return { "Power Supply": [", ".join(output), "green"] }
+
+def format_size(size: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+# The background archive queue: its latest job, and how many are waiting
+# Shared by every station, so the same on each
+class ArchiveProbe:
+    def __init__(self, archive_queue: object) -> None:
+        self._queue = archive_queue
+        self._last = None
+
+    def __call__(self, data: object) -> dict:
+        if self._last is not None and self._last[0] == self._queue.version:
+            return self._last[1]
+        version = self._queue.version
+        jobs = self._queue.status()
+
+        if len(jobs) == 0:
+            status = { "Archive": ["Idle", "green"] }
+        else:
+            test_id, job = list(jobs.items())[-1]
+            running = [(name, job) for name, job in jobs.items() if job["state"] == "Archiving"]
+            if len(running) > 0:
+                test_id, job = running[0]
+            waiting = len([job for job in jobs.values() if job["state"] == "Queued"])
+
+            if job["state"] == "Archiving":
+                fraction = job["done"] / job["total"] if "total" in job and job["total"] > 0 else 0
+                text = f"{test_id}: {fraction * 100:.0f}% of {format_size(job['total'] if 'total' in job else 0)}"
+                color = "blue"
+            elif job["state"] == "Streaming":
+                text = f"{test_id}: Streaming, {format_size(job['done'])} so far"
+                color = "blue"
+            elif job["state"] == "Done":
+                text = f"{test_id}: Done, {format_size(job['size'])} in {job['seconds']:.1f}s"
+                color = "green"
+            elif job["state"] == "Stored":
+                text = f"{test_id}: Artifacts stored in {job['seconds']:.1f}s"
+                color = "green"
+            elif job["state"] == "Failed":
+                text = f"{test_id}: Failed, {job['error']}"
+                color = "red"
+            else:
+                text = f"{test_id}: Queued"
+                color = "blue"
+            if waiting > 0:
+                text += f" ({waiting} waiting)"
+            status = { "Archive": [text, color] }
+
+        self._last = (version, status)
+        return status
+
+# Uploads waiting to be sent, and why they're failing if they are
+def probe_upload(uploader: object, data: object) -> dict:
+    status = uploader.status()
+    waiting = status["counts"].get("pending", 0) + status["counts"].get("sending", 0)
+    text = f"{waiting} waiting ({format_size(status['waiting_bytes'])})" if waiting > 0 else "Up to date"
+    if status["counts"].get("missing", 0) > 0:
+        text += f", {status['counts']['missing']} missing"
+    if status["error"] is not None:
+        return { "Upload": [f"{text}, retrying: {status['error']}", "gold"] }
+    return { "Upload": [text, "green" if waiting == 0 else "blue"] }
+
+# Percentile of a value among earlier boards of the same type, or None without one
+def percentile(fleet: object, data: object, metric: str, value: object) -> float:
+    if fleet is None or "_board" not in data or not isinstance(value, (int, float)) or math.isnan(value):
+        return None
+    return fleet.percentile(data["_board"], metric, value)
+
+# A value, followed by its percentile among earlier boards of the same type when known
+def ranked_text(fleet: object, data: object, key: str) -> str:
+    rank = percentile(fleet, data, key, data[key])
+    return str(data[key]) if rank is None else f"{data[key]} (p{rank:.0f})"
+
+# Rows of the data tables, one per ROC half, from the arrays the tests store
+# Ranked fields get a column with their percentile among earlier boards of the same type
+def half_table(prefix: str, columns: list[tuple[str, str]], ranked: list[str], data: object, fleet: object) -> dict:
+    if arrays_key(prefix) not in data:
+        return None
+    halves = data[arrays_key(prefix)]["halves"]
+    fields = [field for _, field in columns]
+    rows = half_rows(halves, fields)
+
+    headers = ["ID"] + [header for header, _ in columns]
+    if fleet is not None and "_board" in data:
+        headers += [f"{header} %ile" for header, field in columns if field in ranked]
+        for row in rows:
+            for field in [field for _, field in columns if field in ranked]:
+                rank = percentile(fleet, data, f"{prefix}:{row[0]}:{field}", row[1 + fields.index(field)])
+                row.append(f"p{rank:.0f}" if rank is not None else "-")
+
+    return { "columns": headers, "rows": rows }
+
+vref_columns = [("SLOPE", "SLOPE"), ("OFFSET", "OFFSET"), ("BEST_VALUE", "BEST_VALUE")]
+
+# Each table, the key prefixes it's built from, and how to build it
+tables = [
+    ("Pedestal Run Data", [arrays_key("PEDESTAL_RUN")], partial(half_table, "PEDESTAL_RUN",
+        [("Noise", "NOISE"), ("Dead", "NUMBER_CHANNELS_NOISE_AT0"), ("Noisy", "NUMBER_CHANNELS_NOISE_MORE2")], ["NOISE"])),
+    ("Pedestal Scan Data", [arrays_key("TRIM_INV")], partial(half_table, "TRIM_INV", [("AVG", "SLOPE_AVG"), ("RMS", "SLOPE_RMS")], ["SLOPE_AVG"])),
+    ("vrefinv Data", [arrays_key("INV_VREF")], partial(half_table, "INV_VREF", vref_columns, ["SLOPE"])),
+    ("vrefnoinv Data", [arrays_key("NOINV_VREF")], partial(half_table, "NOINV_VREF", vref_columns, ["SLOPE"])),
+]
 
-class WatcherThread(QThread):
-    output = pyqtSignal(object)
-    def __init__(self, data, power_supply):
+# Values the steps have put in the test data
+# Tables are only rebuilt when a key under one of their prefixes, or the fleet statistics, changed
+# and nothing at all is done while neither the snapshot's version nor the statistics change
+class DataProbe:
+    def __init__(self, fleet: object = None) -> None:
+        self._fleet = fleet
+        self._tables = {}
+        self._last = None
+
+    def __call__(self, data: object) -> dict:
+        versioned = hasattr(data, "version")
+        fleet_version = self._fleet.version if self._fleet is not None else None
+        if versioned and self._last is not None and self._last[0] == (data.test_id, data.version(), fleet_version):
+            return self._last[1]
+
+        status = probe_data(data, self._fleet)
+
+        for name, prefixes, build in tables:
+            versions = (data.test_id, tuple(data.version(prefix) for prefix in prefixes), fleet_version) if versioned else None
+            if versions is None or name not in self._tables or self._tables[name][0] != versions:
+                self._tables[name] = (versions, build(data, self._fleet))
+
+            table = self._tables[name][1]
+            if table is not None:
+                status[name] = table
+
+        if versioned:
+            self._last = ((data.test_id, data.version(), fleet_version), status)
+        return status
+
+def probe_data(data: object, fleet: object = None) -> dict:
+    status = {}
+
+    # Power
+    if "POWER:CONFIGURED" in data:
+        # Color TBD
+        # This will only be shown if default hasn't been ran
+        status["Power (Default)"] = ["Not Ran!", "red"]
+
+        status["Power (Configured)"] = [ranked_text(fleet, data, "POWER:CONFIGURED"), "green"]
+    if "POWER:DEFAULT" in data:
+        # Color TBD
+        status["Power (Default)"] = [ranked_text(fleet, data, "POWER:DEFAULT"), "green"]
+
+
+    # I2C Checker
+    if "I2C_CHECKER:CONFIGURED" in data:
+        # This will only be shown if default hasn't been ran
+        status["I2C Checker (Default)"] = ["Not Ran!", "red"]
+
+        value = data["I2C_CHECKER:CONFIGURED"]
+        status["I2C Checker (Configured)"] = [value, check_status(value)]
+
+    if "I2C_CHECKER:DEFAULT" in data:
+        value = data["I2C_CHECKER:DEFAULT"]
+        status["I2C Checker (Default)"] = [value, check_status(value)]
+
+    # Pedestal Run
+    if "PEDESTAL_RUN:TEST_SUCCESS" in data:
+        value = data["PEDESTAL_RUN:TEST_SUCCESS"]
+        status["Pedestal Run Success"] = [value, check_status(value)]
+
+        value = data["PEDESTAL_RUN:CORRUPTION"]
+        status["Pedestal Run Corruption"] = [value, check_status(value)]
+
+        # 0 -> green, 1 -> yellow, 2+ -> red
+        match_color = lambda num: "red" if num >= 2 else ("green" if num == 0 else "gold")
+        
+        value = data["PEDESTAL_RUN:NUMBER_CHANNELS_NOISE_AT0"]
+        status["Pedestal Run Dead Channels"] = [value, match_color(value)]
+
+        value = data["PEDESTAL_RUN:NUMBER_CHANNELS_NOISE_MORE2"]
+        status["Pedestal Run Noisy Channels"] = [value, match_color(value)]
+
+    # Reference Comparison
+    if "REFERENCE:AVAILABLE" in data:
+        if not data["REFERENCE:AVAILABLE"]:
+            status["Reference Comparison"] = [f"No reference for {data['REFERENCE:BOARD']}", "blue"]
+        else:
+            worst = [f"{field} |z| {data[f'REFERENCE:{field}:MAX_ABS_Z']:.1f}" for field in data["REFERENCE:FIELDS"]
+                     if data[f"REFERENCE:{field}:MAX_ABS_Z"] is not None]
+            outliers = data["REFERENCE:OUTLIERS"]
+            status["Reference Comparison"] = [f"{outliers} Outliers, " + ", ".join(worst), "green" if outliers == 0 else "gold"]
+
+    return status
+
+# One of the data tables, updated in place
+# Only cells whose values changed are signalled, so views repaint just those
+class WatcherTableModel(QAbstractTableModel):
+    def __init__(self) -> None:
         super().__init__()
-        self.data = data
-        self.power_supply = power_supply
-
-    def run(self):
-        try:
-            status = {}
-            
-            # Check Local DAQ
-            try:
-                daq_status = os.popen("systemctl status daq-client").read()
-                daq_status = daq_status.split("Active: ")[1].split(" since")[0]
-                logger.debug(f"Recieved daq-client status {daq_status}")
-
-                status["DAQ Client"] = [daq_status, "green" if daq_status == "active (running)" else "red"]
-            except Exception as exception:
-                logger.critical(f"DAQ Client Status Failed: {exception}")
-                status["DAQ Client"] = ["Error!", "red"]
-                
-            # Check Kria Services
-            try:
-                if "_kria" not in self.data:
-                    status["Kria"] = ["Not Initialized", "gold"]
-                elif self.data["_kria"].get_transport() is None or not self.data["_kria"].get_transport().is_active():
-                    status["Kria"] = ["Crashed, Not Active", "red"]
-                else:
-                    client = self.data["_kria"]
-                    daq_text = client.exec_command("service daq-server status", timeout=1)[1].read().decode()
-                    daq_response = daq_text.split("Active: ")[1].split(" since")[0]
-                    logger.debug(f"Recieved daq-server status {daq_response}")
-
-                    i2c_text = client.exec_command("service i2c-server status", timeout=1)[1].read().decode()
-                    i2c_response = i2c_text.split("Active: ")[1].split(" since")[0]
-                    logger.debug(f"Recieved i2c-server status {i2c_response}")
-
-                    text = f"I2C: {i2c_response}\nDAQ: {daq_response}"
-                    color = "green" if i2c_response == "active (running)" and daq_response == "active (running)" else "red"
-                    status["Kria"] = [text, color]
-            except Exception as exception:
-                logger.critical(f"Request timed out: {exception}\n{traceback.format_exc()}")
-                status["Kria"] = ["SSH Timed Out", "red"]
-
-            # Check Power Supply
-            try:
-                if "_power_supply" in self.data:
-                    result = self.power_supply.check_power(self.data)
-                    output = []
-                    if "state" in result:
-                        output += [result["state"]]
-                    
-                    output += [f"{result['voltage']:.3f}V"]
-
-                    if "current_digital" in result:
-                        output += [f"{result['current_digital']:.3f}A Digital"]
-                        output += [f"{result['current_analog']:.3f}A Analog"]
-                    else:
-                        output += [f"{result['current']:.3f}V"]
-                    current = result["current"]
-                    status["Power Supply"] = [", ".join(output), "green"]
-                else:
-                    status["Power Supply"] = ["Not Initialized", "gold"]
-            except Exception as e:
-                status["Power Supply"] = ["Crashed", "red"]
-                logger.critical(f"Power Supply failed with {e}\n{traceback.format_exc()}")
-
-            # Data Values
-
-            # Power
-            if "POWER:CONFIGURED" in self.data:
-                # Color TBD
-                # This will only be shown if default hasn't been ran
-                status["Power (Default)"] = ["Not Ran!", "red"]
-
-                status["Power (Configured)"] = [str(self.data["POWER:CONFIGURED"]), "green"]
-            if "POWER:DEFAULT" in self.data:
-                # Color TBD
-                status["Power (Default)"] = [str(self.data["POWER:DEFAULT"]), "green"]
-
-
-            # I2C Checker
-            if "I2C_CHECKER:CONFIGURED" in self.data:
-                # This will only be shown if default hasn't been ran
-                status["I2C Checker (Default)"] = ["Not Ran!", "red"]
-
-                value = self.data["I2C_CHECKER:CONFIGURED"]
-                status["I2C Checker (Configured)"] = [value, check_status(value)]
-
-            if "I2C_CHECKER:DEFAULT" in self.data:
-                value = self.data["I2C_CHECKER:DEFAULT"]
-                status["I2C Checker (Default)"] = [value, check_status(value)]
-
-            # Pedestal Run
-            if "PEDESTAL_RUN:TEST_SUCCESS" in self.data:
-                value = self.data["PEDESTAL_RUN:TEST_SUCCESS"]
-                status["Pedestal Run Success"] = [value, check_status(value)]
-
-                value = self.data["PEDESTAL_RUN:CORRUPTION"]
-                status["Pedestal Run Corruption"] = [value, check_status(value)]
-
-                # 0 -> green, 1 -> yellow, 2+ -> red
-                match_color = lambda num: "red" if num >= 2 else ("green" if num == 0 else "gold")
-                
-                value = self.data["PEDESTAL_RUN:NUMBER_CHANNELS_NOISE_AT0"]
-                status["Pedestal Run Dead Channels"] = [value, match_color(value)]
-
-                value = self.data["PEDESTAL_RUN:NUMBER_CHANNELS_NOISE_MORE2"]
-                status["Pedestal Run Noisy Channels"] = [value, match_color(value)]
-
-                value = "ID  | Noise   | Dead | Noisy\n"
-                i = 0
-                while True:
-                    if f"PEDESTAL_RUN:{i}:0:NOISE" not in self.data:
-                        break
-                    value += f"{i}:0 | {self.data[f'PEDESTAL_RUN:{i}:0:NOISE']:.5f} | {self.data[f'PEDESTAL_RUN:{i}:0:NUMBER_CHANNELS_NOISE_AT0']}    | {self.data[f'PEDESTAL_RUN:{i}:0:NUMBER_CHANNELS_NOISE_MORE2']}\n"
-                    value += f"{i}:1 | {self.data[f'PEDESTAL_RUN:{i}:1:NOISE']:.5f} | {self.data[f'PEDESTAL_RUN:{i}:1:NUMBER_CHANNELS_NOISE_AT0']}    | {self.data[f'PEDESTAL_RUN:{i}:1:NUMBER_CHANNELS_NOISE_MORE2']}\n"
-                    i += 1
-
-                status["Pedestal Run Data"] = [value, "blue"]
-
-            # Pedestal Scan
-            if "TRIM_INV:0:0:SLOPE_AVG" in self.data:
-                value = "ID  | AVG     | RMS\n"
-                i = 0
-                while True:
-                    if f"TRIM_INV:{i}:0:SLOPE_AVG" not in self.data:
-                        break
-                    value += f"{i}:0 | {self.data[f'TRIM_INV:{i}:0:SLOPE_AVG']:.5f} | {self.data[f'TRIM_INV:{i}:0:SLOPE_RMS']:.5f}\n"
-                    value += f"{i}:1 | {self.data[f'TRIM_INV:{i}:1:SLOPE_AVG']:.5f} | {self.data[f'TRIM_INV:{i}:1:SLOPE_RMS']:.5f}\n"
-                    i += 1
-
-                status["Pedestal Scan Data"] = [value, "blue"]
-
-            # vrefinv
-            if "INV_VREF:0:0:SLOPE" in self.data:
-                value = "ID  | SLOPE    | OFFSET    | BEST_VALUE\n"
-                i = 0
-                while True:
-                    if f"INV_VREF:{i}:0:SLOPE" not in self.data:
-                        break
-                    value += f"{i}:0 | {self.data[f'INV_VREF:{i}:0:SLOPE']:.5f} | {self.data[f'INV_VREF:{i}:0:OFFSET']:.5f} | {self.data[f'INV_VREF:{i}:0:BEST_VALUE']}\n"
-                    value += f"{i}:1 | {self.data[f'INV_VREF:{i}:1:SLOPE']:.5f} | {self.data[f'INV_VREF:{i}:1:OFFSET']:.5f} | {self.data[f'INV_VREF:{i}:0:BEST_VALUE']}\n"
-                    i += 1
-
-                status["vrefinv Data"] = [value, "blue"]
-
-            # vrefnoinv
-            if "NOINV_VREF:0:0:SLOPE" in self.data:
-                value = "ID  | SLOPE    | OFFSET    | BEST_VALUE\n"
-                i = 0
-                while True:
-                    if f"NOINV_VREF:{i}:0:SLOPE" not in self.data:
-                        break
-                    value += f"{i}:0 | {self.data[f'NOINV_VREF:{i}:0:SLOPE']:.5f} | {self.data[f'NOINV_VREF:{i}:0:OFFSET']:.5f} | {self.data[f'NOINV_VREF:{i}:0:BEST_VALUE']}\n"
-                    value += f"{i}:1 | {self.data[f'NOINV_VREF:{i}:1:SLOPE']:.5f} | {self.data[f'NOINV_VREF:{i}:1:OFFSET']:.5f} | {self.data[f'INV_VREF:{i}:0:BEST_VALUE']}\n"
-                    i += 1
-
-                status["vrefnoinv Data"] = [value, "blue"]
-
-            self.output.emit(status)
-        except Exception as e:
-            logger.critical(f"Exception in watcher: {e}\n{traceback.format_exc()}")
-            
-        time.sleep(0.1)
+        self._columns = []
+        self._rows = []
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._columns)
+
+    def data(self, index: QModelIndex, role: int = Qt.ItemDataRole.DisplayRole) -> object:
+        if role != Qt.ItemDataRole.DisplayRole or not index.isValid():
+            return None
+        value = self._rows[index.row()][index.column()]
+        return f"{value:.5f}" if isinstance(value, float) else str(value)
+
+    def headerData(self, section: int, orientation: Qt.Orientation, role: int = Qt.ItemDataRole.DisplayRole) -> object:
+        if role != Qt.ItemDataRole.DisplayRole or orientation != Qt.Orientation.Horizontal:
+            return None
+        return self._columns[section]
+
+    # Replace the table's contents with table, a dict of columns and rows, or None to empty it
+    def set_table(self, table: dict) -> None:
+        columns = table["columns"] if table is not None else []
+        rows = table["rows"] if table is not None else []
+
+        if columns != self._columns:
+            self.beginResetModel()
+            self._columns = columns
+            self._rows = rows
+            self.endResetModel()
+            return
+
+        # Rows past the end of either table are added or removed
+        if len(rows) < len(self._rows):
+            self.beginRemoveRows(QModelIndex(), len(rows), len(self._rows) - 1)
+            self._rows = self._rows[:len(rows)]
+            self.endRemoveRows()
+        elif len(rows) > len(self._rows):
+            self.beginInsertRows(QModelIndex(), len(self._rows), len(rows) - 1)
+            self._rows = self._rows + rows[len(self._rows):]
+            self.endInsertRows()
+
+        # Then the changed cells of each row, as one span per row
+        for row in range(len(rows)):
+            changed = [column for column in range(len(columns)) if rows[row][column] != self._rows[row][column]]
+            self._rows[row] = rows[row]
+            if len(changed) > 0:
+                self.dataChanged.emit(self.index(row, changed[0]), self.index(row, changed[-1]))
 
 class Watcher(QWidget):
-    def __init__(self, fetch_data, power_supply) -> None:
+    def __init__(self, fetch_data, power_supply, config: dict = None, fleet_stats: object = None,
+                 archive_queue: object = None, uploader: object = None) -> None:
         super().__init__()
 
         self.fetch_data = fetch_data
         self.power_supply = power_supply
+        self.fleet_stats = fleet_stats
+        self.archive_queue = archive_queue
+        self.uploader = uploader
+        self.config = config if config is not None else {}
         
         layout = QVBoxLayout()
 
@@ -249,10 +375,14 @@ class Watcher(QWidget):
 
         # Bulk Data
         tabs = QTabWidget()
+        self.table_models = {}
         for text in labels_in_tabs:
-            self.text_fields[text] = QLabel("Uninitialized")
-            self.text_fields[text].setFont(QFontDatabase.systemFont(QFontDatabase.SystemFont.FixedFont))
-            tabs.addTab(self.text_fields[text], text)
+            self.table_models[text] = WatcherTableModel()
+            view = QTableView()
+            view.setModel(self.table_models[text])
+            view.setFont(QFontDatabase.systemFont(QFontDatabase.SystemFont.FixedFont))
+            view.verticalHeader().hide()
+            tabs.addTab(view, text)
         
         form_layout.addRow(tabs)
 
@@ -264,35 +394,61 @@ class Watcher(QWidget):
         self.setLayout(layout)
 
         # Start Loop
-        self.run_update()
-
+        self.start_service()
+
+    # Schedules come from the watcher section of flow.yaml
+    def probe_settings(self, name: str, interval: float, timeout: float) -> dict:
+        settings = self.config[name] if name in self.config else {}
+        return {
+            "interval": settings["interval"] if "interval" in settings else interval,
+            "timeout": settings["timeout"] if "timeout" in settings else timeout,
+            "max_backoff": self.config["max_backoff"] if "max_backoff" in self.config else 30,
+        }
+
+    def start_service(self) -> None:
+        probes = [
+            Probe("daq_client", probe_daq_client,
+                  error={ "DAQ Client": ["Error!", "red"] },
+                  **self.probe_settings("daq_client", 5, 5)),
+            Probe("kria", probe_kria,
+                  active=lambda data: "_kria" in data,
+                  idle={ "Kria": ["Not Initialized", "gold"] },
+                  error={ "Kria": ["Timed Out", "red"] },
+                  **self.probe_settings("kria", 2, 3)),
+            # Only polled while a supply is connected
+            Probe("power_supply", partial(probe_power_supply, self.power_supply),
+                  active=lambda data: "_power_supply" in data,
+                  idle={ "Power Supply": ["Not Initialized", "gold"] },
+                  error={ "Power Supply": ["Crashed", "red"] },
+                  **self.probe_settings("power_supply", 0.5, 2)),
+            Probe("data", DataProbe(self.fleet_stats), **self.probe_settings("data", 0.5, None)),
+        ]
+        if self.archive_queue is not None:
+            probes.append(Probe("archive", ArchiveProbe(self.archive_queue), **self.probe_settings("archive", 1, None)))
+        if self.uploader is not None:
+            probes.append(Probe("upload", partial(probe_upload, self.uploader), **self.probe_settings("upload", 2, None)))
+
+        self._service = WatcherService(self.fetch_data, probes)
+        self._service.output.connect(self.update_text_fields)
+        self._service.start()
+
+    # Only the entries that changed come in, None meaning the entry no longer has a value
     def update_text_fields(self, status: object) -> None:
-        for key in labels:
+        for key, data in status.items():
+            if key in self.table_models:
+                self.table_models[key].set_table(data)
+                continue
+            if key not in self.text_fields:
+                continue
             field = self.text_fields[key]
-            if key not in status:
+            if data is None:
                 logger.debug(f"Key not in status: {key}")
                 field.setText("Uninitialized")
                 field.setStyleSheet("")
                 continue
 
-            data = status[key]
-
             if isinstance(data, list):
                 field.setText(str(data[0]))
                 field.setStyleSheet(f"color: {data[1]};")
             else:
                 field.setText(data)
-
-    def run_update(self) -> None:
-        logger.debug("Running update.")
-    
-        if hasattr(self, "_thread"):
-            self._thread.deleteLater()
-
-        self._thread = WatcherThread(self.fetch_data(), self.power_supply)
-        # Parse Data
-        self._thread.output.connect(self.update_text_fields)
-
-        # Restart
-        self._thread.finished.connect(self.run_update)
-        self._thread.start()
\ No newline at end of file
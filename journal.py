@@ -0,0 +1,113 @@
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from serialization import json_default
+
+logger = logging.getLogger("journal")
+
+# Append-only record of one test, one JSON object per line
+# Records are flushed as they are written and fsynced at most every sync_interval
+# seconds, so a crash loses at most that much. A torn last line is skipped on reading
+class Journal:
+    def __init__(self, path: str, sync_interval: float = 1.0) -> None:
+        self.path = path
+        self._sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._last_sync = 0
+
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._file = open(path, "a")
+
+    def append(self, record: dict) -> None:
+        line = json.dumps(record, default=json_default) + "\n"
+        with self._lock:
+            if self._file is None:
+                logger.warning(f"Journal {self.path} is closed, dropping a {record.get('type')} record")
+                return
+            self._file.write(line)
+            self._file.flush()
+            if time.time() - self._last_sync >= self._sync_interval:
+                self._sync()
+
+    def _sync(self) -> None:
+        os.fsync(self._file.fileno())
+        self._last_sync = time.time()
+
+    def sync(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+
+    # Replace the journal with one snapshot record of everything in it
+    # Written beside it and moved over, so either the old or the new journal survives a crash
+    def compact(self) -> dict:
+        with self._lock:
+            self._sync()
+            data, steps = replay(read_journal(self.path))
+
+            with open(self.path + ".tmp", "w") as fout:
+                fout.write(json.dumps({ "type": "snapshot", "time": now(), "data": data, "steps": steps }, default=json_default) + "\n")
+                fout.flush()
+                os.fsync(fout.fileno())
+
+            self._file.close()
+            os.replace(self.path + ".tmp", self.path)
+            self._file = open(self.path, "a")
+            return data
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+def now() -> str:
+    return datetime.datetime.now().isoformat()
+
+def read_journal(path: str) -> list[dict]:
+    records = []
+    with open(path) as fin:
+        for number, line in enumerate(fin):
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping unreadable line {number + 1} of {path}, probably cut off by a crash")
+    return records
+
+# The test data and step timings a journal's records add up to
+def replay(records: list[dict]) -> tuple[dict, list[dict]]:
+    data = {}
+    steps = []
+    for record in records:
+        if record["type"] == "snapshot":
+            data = dict(record["data"])
+            steps = list(record["steps"])
+        elif record["type"] in ("step", "crash"):
+            if "data" in record:
+                data.update(record["data"])
+            steps.append({ key: value for key, value in record.items() if key != "data" })
+    return data, steps
+
+# The output.json of a test, from its journal
+def rebuild(path: str) -> dict:
+    return replay(read_journal(path))[0]
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python journal.py <journal> [output.json]")
+        sys.exit(1)
+
+    output = rebuild(sys.argv[1])
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "w") as fout:
+            json.dump(output, fout, indent=2, default=str)
+    else:
+        json.dump(output, sys.stdout, indent=2, default=str)
@@ -1,4 +1,5 @@
 import logging
+import threading
 
 # Code from https://stackoverflow.com/questions/384076/how-can-i-color-python-logging-output
 # This formatter is for pretty logs
@@ -23,13 +24,49 @@ class Formatter(logging.Formatter):
     
 
 # Saves logs to a variable until said variable is wiped
-logs = []
+# There is one buffer per test slot. Records are tagged with the slot
+# of the thread that emitted them; untagged records go to every slot
+logs = {}
+_context = threading.local()
+
 class VariableHandler(logging.Handler):
     def __init__(self):
         super().__init__(logging.DEBUG)
 
     def emit(self, record):
-        logs.append(format(record))
+        line = format(record)
+        slot = get_slot()
+        if slot is not None and slot in logs:
+            logs[slot].append(line)
+        else:
+            for buffer in logs.values():
+                buffer.append(line)
+
+# Tag all further logs from the current thread with a slot
+def set_slot(slot: str | None) -> None:
+    _context.slot = slot
+
+def get_slot() -> str | None:
+    return getattr(_context, "slot", None)
+
+# Tag logs with a slot for the duration of a with block
+class slot_context:
+    def __init__(self, slot: str | None) -> None:
+        self._slot = slot
+
+    def __enter__(self):
+        self._previous = get_slot()
+        set_slot(self._slot)
+
+    def __exit__(self, *args):
+        set_slot(self._previous)
+
+# Wipe (or create) the buffer for a slot
+def clear_logs(slot: str | None = None) -> None:
+    logs[slot] = []
+
+def get_logs(slot: str | None = None) -> list[str]:
+    return logs.get(slot, [])
 
 # Initialize logging config
 def setup_logging():
@@ -60,4 +60,9 @@ class TestFlow(ABC):
 
     @abstractmethod
     def get_watcher(self, fetch_data) -> QWidget:
-        pass
\ No newline at end of file
+        pass
+
+    # Where to journal the results of the test with data, see journal.py
+    # None to not journal it (yet), eg. until the DUT is known
+    def get_journal_path(self, data) -> str:
+        return None
\ No newline at end of file
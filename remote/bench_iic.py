@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+"""Throughput and latency of iic operations against the simulated devices in iic_sim
+
+Runs on any Linux box, no trophy or /dev/i2c-* node needed:
+
+    python bench_iic.py --latency 0.0002 --count 200
+"""
+
+import argparse
+import time
+
+import iic
+import iic_sim
+import mm_tester_tray_simple
+
+
+def measure(name, operation, count, bus):
+    transactions = bus.transactions
+    latencies = []
+    start = time.time()
+    for i in range(count):
+        begin = time.time()
+        operation(i)
+        latencies.append(time.time() - begin)
+    elapsed = time.time() - start
+
+    latencies.sort()
+    print("%-32s %9.1f ops/s  mean %8.3f ms  p95 %8.3f ms  %6.1f bus transactions/op" % (
+        name, count / elapsed, 1000 * elapsed / count,
+        1000 * latencies[int(0.95 * (count - 1))], (bus.transactions - transactions) / float(count)))
+
+
+def bench_lpgbt(args, cached):
+    bus = iic_sim.trophy_bus(args.latency, args.transaction_time)
+    lpgbt = iic.iic()
+    lpgbt.connect(dev=bus, addr=0x70)
+    if cached:
+        lpgbt.enable_cache()
+    suffix = " (cached)" if cached else ""
+
+    measure("write_lpgbt" + suffix, lambda i: lpgbt.write_lpgbt(0x020 + i % 16, i & 0xFF), args.count, bus)
+    measure("read_lpgbt" + suffix, lambda i: lpgbt.read_lpgbt(0x020 + i % 16), args.count, bus)
+    measure("read_lpgbt_block 256" + suffix, lambda i: lpgbt.read_lpgbt_block(0x000, 256), args.count, bus)
+    measure("write_lpgbt B" + suffix, lambda i: lpgbt.write_lpgbt(0x020 + i % 16, i & 0xFF, lpgbt='B'), args.count, bus)
+    measure("read_lpgbt B" + suffix, lambda i: lpgbt.read_lpgbt(0x020 + i % 16, lpgbt='B'), args.count, bus)
+    measure("write_vtrx" + suffix, lambda i: lpgbt.write_vtrx(0x10, i & 0xFF), args.count, bus)
+    measure("read_vtrx" + suffix, lambda i: lpgbt.read_vtrx(0x10), args.count, bus)
+
+    stats = lpgbt.stats.summary()
+    print("  I2C master polls: %.1f mean, %d max; %d timeouts" % (stats["mean_polls"], stats["max_polls"], stats["timeouts"]))
+    if cached:
+        print("  cache: %s" % lpgbt.cache_stats())
+
+
+def bench_power_hub(args):
+    hub = iic_sim.power_hub_sim(args.latency, args.conversion_time)
+    pmanager = mm_tester_tray_simple.mm_power_man(hub.bus)
+    pmanager.set_enabled(enabled=True)
+
+    count = max(1, args.count // 20)
+    measure("power hub status", lambda i: mm_tester_tray_simple.status(pmanager, range(1, 4)), count, hub.bus)
+    measure("power hub status, oversample 4", lambda i: mm_tester_tray_simple.status(pmanager, range(1, 4), 4), count, hub.bus)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark iic operations against simulated devices")
+    parser.add_argument('--count', type=int, default=200, help='Repetitions of each operation')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every bus transaction')
+    parser.add_argument('--transaction-time', type=float, default=0.0, help='Seconds each lpGBT I2C master command takes')
+    parser.add_argument('--conversion-time', type=float, default=0.01, help='Seconds each power hub ADC conversion takes')
+    args = parser.parse_args()
+
+    bench_lpgbt(args, False)
+    bench_lpgbt(args, True)
+    bench_power_hub(args)
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+
+"""Stand-in for the uhal package, for running iic in IC mode without an FPGA
+
+Models the backend IC engine in front of an lpGBT register file, and counts
+dispatches (network round trips) so IC access patterns can be benchmarked
+offline:
+
+    import fake_uhal, iic
+    bus = iic.iic(mode="IC", uhal_module=fake_uhal)
+    bus.connect()
+    bus.write_lpgbt(0x0f8, 0x71)
+    print(bus.hw.round_trips)
+"""
+
+import time
+
+
+class LogLevel:
+    WARNING = "WARNING"
+
+
+def setLogLevelTo(level):
+    pass
+
+
+class ValWord:
+    """A value read from the device, only valid after dispatch"""
+
+    def __init__(self):
+        self._value = None
+
+    def value(self):
+        if self._value is None:
+            raise RuntimeError("ValWord read before dispatch")
+        return self._value
+
+    def __int__(self):
+        return self.value()
+
+    __index__ = __int__
+
+    def __bool__(self):
+        return self.value() != 0
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        return self.value() == int(other)
+
+    def __repr__(self):
+        return "ValWord(%s)" % self._value
+
+
+class Node:
+    def __init__(self, hw, path):
+        self._hw = hw
+        self._path = path
+
+    def getNode(self, path):
+        return Node(self._hw, self._path + "." + path)
+
+    def getNodes(self):
+        prefix = self._path + "."
+        return [path[len(prefix):] for path in self._hw.node_paths() if path.startswith(prefix)]
+
+    def write(self, value):
+        self._hw.queue.append(("write", self._path, int(value)))
+
+    def read(self):
+        word = ValWord()
+        self._hw.queue.append(("read", self._path, word))
+        return word
+
+
+class FakeHwInterface:
+    """The FPGA backend, with an lpGBT behind its IC engine
+
+    occupancy adds the IC_RX_OCCUPANCY register found in newer firmware.
+    latency is the time each dispatch takes, in seconds.
+    A frame started is only sent once the dispatch ends, so loading the TX FIFO or
+    starting another frame in the same dispatch raises, as it would corrupt the frame.
+    """
+
+    def __init__(self, registers=None, occupancy=True, latency=0.0):
+        self.registers = registers if registers is not None else {}
+        self.occupancy = occupancy
+        self.latency = latency
+        self.round_trips = 0
+        self.queue = []
+        self.ctrl = {}
+        self.tx_fifo = []
+        self.rx_fifo = []
+        self.tx_busy = False
+
+    def node_paths(self):
+        paths = ["frontend.CTL.I2C_ENABLE", "backend.IC_TX_I2C_ADDR", "backend.IC_TX_REG_ADDR",
+                 "backend.IC_TX_DATA", "backend.IC_TX_N_READ", "backend.IC_RX_DATA", "backend.IC_RX_EMPTY",
+                 "backend.CTL.IC_TX_FIFO_LOAD", "backend.CTL.IC_START_WRITE", "backend.CTL.IC_START_READ",
+                 "backend.CTL.IC_RX_FIFO_ADV"]
+        if self.occupancy:
+            paths.append("backend.IC_RX_OCCUPANCY")
+        return paths
+
+    def getNode(self, path):
+        return Node(self, path)
+
+    def dispatch(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        queue, self.queue = self.queue, []
+        for op, path, arg in queue:
+            if op == "write":
+                self._write(path, arg)
+            else:
+                arg._value = self._read(path)
+        self.tx_busy = False
+
+    def _write(self, path, value):
+        if path in ("backend.CTL.IC_TX_FIFO_LOAD", "backend.CTL.IC_START_WRITE", "backend.CTL.IC_START_READ"):
+            if self.tx_busy:
+                raise RuntimeError("IC frame loaded before the previous one was sent")
+            self.tx_busy = path != "backend.CTL.IC_TX_FIFO_LOAD"
+
+        if path == "backend.CTL.IC_TX_FIFO_LOAD":
+            self.tx_fifo.append(self.ctrl.get("backend.IC_TX_DATA", 0))
+        elif path == "backend.CTL.IC_START_WRITE":
+            reg = self.ctrl.get("backend.IC_TX_REG_ADDR", 0)
+            for i, val in enumerate(self.tx_fifo):
+                self.registers[reg + i] = val & 0xFF
+            self.tx_fifo = []
+        elif path == "backend.CTL.IC_START_READ":
+            reg = self.ctrl.get("backend.IC_TX_REG_ADDR", 0)
+            nread = self.ctrl.get("backend.IC_TX_N_READ", 1)
+            # Header and trailer words around the data, as in the real reply frame
+            self.rx_fifo += [0] * 7
+            self.rx_fifo += [self.registers.get(reg + i, 0) for i in range(nread)]
+            self.rx_fifo += [0]
+        elif path == "backend.CTL.IC_RX_FIFO_ADV":
+            if self.rx_fifo:
+                self.rx_fifo.pop(0)
+        else:
+            self.ctrl[path] = value
+
+    def _read(self, path):
+        if path == "backend.IC_RX_DATA":
+            return self.rx_fifo[0] if self.rx_fifo else 0
+        elif path == "backend.IC_RX_EMPTY":
+            return 1 if len(self.rx_fifo) == 0 else 0
+        elif path == "backend.IC_RX_OCCUPANCY":
+            return len(self.rx_fifo)
+        return self.ctrl.get(path, 0)
+
+
+class ConnectionManager:
+    def __init__(self, xml, **kwargs):
+        self.kwargs = kwargs
+
+    def getDevice(self, name):
+        return FakeHwInterface(**self.kwargs)
+
+
+if __name__ == "__main__":
+    import argparse
+    import iic
+
+    parser = argparse.ArgumentParser(description="Count IC round trips for common iic operations")
+    parser.add_argument('--count', type=int, default=100, help='Registers per operation')
+    parser.add_argument('--no-occupancy', action='store_true', help='Model firmware without IC_RX_OCCUPANCY')
+    args = parser.parse_args()
+
+    class manager(ConnectionManager):
+        def __init__(self, xml):
+            super().__init__(xml, occupancy=not args.no_occupancy)
+
+    class backend:
+        LogLevel = LogLevel
+        setLogLevelTo = staticmethod(setLogLevelTo)
+        ConnectionManager = manager
+
+    bus = iic.iic(mode="IC", uhal_module=backend)
+    bus.connect()
+
+    def measure(name, operation):
+        before = bus.hw.round_trips
+        start = time.time()
+        operation()
+        trips = bus.hw.round_trips - before
+        print("%-32s %6d round trips (%.2f per register), %.3f s" % (name, trips, trips / float(args.count), time.time() - start))
+
+    def batched_writes():
+        with bus.transaction_IC():
+            for reg in range(args.count):
+                bus.write_lpgbt(reg, reg & 0xFF)
+
+    measure("write_lpgbt", lambda: [bus.write_lpgbt(reg, reg & 0xFF) for reg in range(args.count)])
+    measure("write_lpgbt in transaction", batched_writes)
+    measure("write_lpgbt_block", lambda: bus.write_lpgbt_block(0, bytearray(range(args.count))))
+    measure("read_lpgbt", lambda: [bus.read_lpgbt(reg) for reg in range(args.count)])
+    measure("read_lpgbt_block", lambda: bus.read_lpgbt_block(0, args.count))
+
+    def batched_reads():
+        with bus.transaction_IC():
+            values = [bus.read_lpgbt_later(reg) for reg in range(args.count)]
+        assert [value.result() for value in values] == [reg & 0xFF for reg in range(args.count)]
+
+    measure("read_lpgbt_later in transaction", batched_reads)
+
+    def scattered():
+        with bus.transaction_IC():
+            for reg in range(0, 2 * args.count, 2):
+                bus.write_lpgbt(reg, 0x5a)
+            values = [bus.read_lpgbt_later(reg) for reg in range(0, 2 * args.count, 2)]
+        assert all(value.result() == 0x5a for value in values)
+
+    measure("scattered in transaction", scattered)
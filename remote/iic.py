@@ -1,6 +1,21 @@
 #!/usr/bin/python
 
-import struct, fcntl, os, sys
+import struct, fcntl, os, sys, time
+import concurrent.futures
+import contextlib
+import ctypes
+
+# From linux/i2c-dev.h and linux/i2c.h
+I2C_SLAVE=0x0703
+I2C_RDWR=0x0707
+I2C_M_RD=0x0001
+
+class i2c_msg(ctypes.Structure):
+    _fields_ = [("addr", ctypes.c_uint16), ("flags", ctypes.c_uint16),
+                ("len", ctypes.c_uint16), ("buf", ctypes.POINTER(ctypes.c_uint8))]
+
+class i2c_rdwr_ioctl_data(ctypes.Structure):
+    _fields_ = [("msgs", ctypes.POINTER(i2c_msg)), ("nmsgs", ctypes.c_uint32)]
 
 def determineDefaults():
     # see if this is a Raspberry Pi, in which case the defaults are clear
@@ -17,33 +32,142 @@ class I2CException(Exception):
     """Raised when an I2C error was encountered"""
     pass
 
+class I2CTimeoutException(I2CException):
+    """Raised when an I2C transaction did not finish before its deadline"""
+    pass
+
+class poll_stats:
+    """Latency and poll count of each transaction waited on with poll_until"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.transactions = 0
+        self.timeouts = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_polls = 0
+        self.max_polls = 0
+
+    def record(self, elapsed, polls, timed_out=False):
+        self.transactions += 1
+        self.timeouts += 1 if timed_out else 0
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.total_polls += polls
+        self.max_polls = max(self.max_polls, polls)
+
+    def summary(self):
+        n = max(self.transactions, 1)
+        return {
+            "transactions": self.transactions,
+            "timeouts": self.timeouts,
+            "mean_time": self.total_time / n,
+            "max_time": self.max_time,
+            "mean_polls": self.total_polls / float(n),
+            "max_polls": self.max_polls,
+        }
+
+def poll_until(read, done, timeout=1.0, spin=8, interval=0.0001, max_interval=0.01, stats=None):
+    """Call read() until done(value) is true, and return the last value
+
+    The first spin polls go back to back, as most transactions finish quickly.
+    After that the sleep between polls starts at interval and doubles up to
+    max_interval. done() may raise to abort on an error status.
+    Raises I2CTimeoutException once timeout seconds have passed.
+    """
+    start = time.time()
+    deadline = start + timeout
+    polls = 0
+    while True:
+        value = read()
+        polls += 1
+        try:
+            finished = done(value)
+        except Exception:
+            if stats is not None: stats.record(time.time() - start, polls)
+            raise
+        if finished:
+            if stats is not None: stats.record(time.time() - start, polls)
+            return value
+
+        now = time.time()
+        if now > deadline:
+            if stats is not None: stats.record(now - start, polls, timed_out=True)
+            raise I2CTimeoutException("Transaction not finished after %.3f s and %d polls" % (now - start, polls))
+        if polls > spin:
+            time.sleep(min(interval, deadline - now))
+            interval = min(interval * 2, max_interval)
+
+# I2C addresses of the lpGBTs on a trophy; B, C and D sit behind A's I2C master
+LPGBT_ADDRESSES = {'A': 0x70, 'B': 0x71, 1: 0x71, 'C': 0x72, 2: 0x72, 'D': 0x73, 3: 0x73}
+
+# Registers never served from the shadow cache: I2C master status and
+# read-back registers change on their own, and writing a command register
+# runs the command again even when it holds the same value
+VOLATILE_REGISTERS = (0x0fd, 0x104, 0x176, 0x178, 0x18b, 0x18d)
+
 class iic:
 
-    def __init__(self, mode="I2C"):
+    # Most bytes moved in one I2C block transfer
+    block_size = 256
+
+    def __init__(self, mode="I2C", uhal_module=None):
+        # uhal_module replaces the uhal package in IC mode, eg. fake_uhal
         self.fd = None
+        self.bus = None
+        self.addr = None
         self.hw = None
+        self.ic_depth = 0
+        # IC frames held back by transaction_IC: [op, reg, data or length, futures]
+        self.ic_pending = []
+        # Deadline for I2C master transactions, in seconds, and their statistics
+        self.timeout = 1.0
+        self.stats = poll_stats()
+        self.ic_has_occupancy = False
+        # Write-through shadow of register values, off until enable_cache()
+        self.device = None
+        self.cache = None
+        self.uncached = set(VOLATILE_REGISTERS)
+        # Last control word written to each I2C master, keyed by (device, command register)
+        self.i2cm_control = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.mode = "I2C"
         if mode in ("I2C","IC"):
             self.mode = mode
         else: 
             print("mode not supported, will use I2C mode (options: I2C, IC)")
         if mode=="IC": 
-            global uhal
-            import uhal
+            if uhal_module is None:
+                import uhal as uhal_module
+            self.uhal = uhal_module
 
     def connect(self,dev="/dev/i2c-23",addr=0x70,xml="file://connections.xml",uhaldevice="zcu"):
-        if self.mode == "I2C":
+        self.device = dev if self.mode == "I2C" else uhaldevice
+        self.invalidate_cache()
+        if self.mode == "I2C" and not isinstance(dev, str):
+            # A simulated bus from iic_sim
+            self.bus = dev
+            self.addr = addr
+        elif self.mode == "I2C":
             self.fd = os.open(dev, os.O_RDWR)
-            fcntl.ioctl(self.fd,0x0703,addr)
+            self.addr = addr
+            fcntl.ioctl(self.fd,I2C_SLAVE,addr)
         elif self.mode == "IC":
-            uhal.setLogLevelTo( uhal.LogLevel.WARNING )
-            self.hw = uhal.ConnectionManager(xml).getDevice(uhaldevice)
+            self.uhal.setLogLevelTo( self.uhal.LogLevel.WARNING )
+            self.hw = self.uhal.ConnectionManager(xml).getDevice(uhaldevice)
+            # Newer firmware reports the RX FIFO fill level
+            self.ic_has_occupancy = "IC_RX_OCCUPANCY" in self.hw.getNode("backend").getNodes()
             frontend=self.hw.getNode("frontend")
             # disable I2C
             frontend.getNode("CTL.I2C_ENABLE").write(0)
             self.hw.dispatch()
 
     def close(self):
+        self.invalidate_cache()
+        self.bus = None
         if self.fd:
             os.close(self.fd)
             self.fd=None
@@ -54,7 +178,75 @@ class iic:
             self.hw.dispatch()
             self.hw=None
             
+    ## ----------- Shadow cache ----------- ##
+    # Remembers the last value written to (or read from) each register, keyed by
+    # (device, lpGBT address, register), and skips writes of the value already there.
+    # Only valid while nothing else writes to the lpGBTs, so it is off by default.
+
+    def enable_cache(self, uncached=()):
+        # Start caching, treating the registers in uncached as volatile as well
+        self.cache = {}
+        self.uncached.update(uncached)
+
+    def disable_cache(self):
+        self.cache = None
+        self.i2cm_control = {}
+
+    def invalidate_cache(self):
+        # Forget every value, eg. after a reset or power cycle
+        if self.cache is not None:
+            self.cache = {}
+        self.i2cm_control = {}
+
+    def mark_uncached(self, reg):
+        self.uncached.add(reg)
+        self.forget(reg)
+
+    def forget(self, reg, lpgbt=None):
+        # Drop cached values of reg, on one or every lpGBT
+        if self.cache is None: return
+        for key in list(self.cache):
+            if key[2] == reg and (lpgbt is None or key[1] == LPGBT_ADDRESSES.get(lpgbt)):
+                del self.cache[key]
+
+    def cache_key(self, reg, lpgbt='A'):
+        if self.cache is None or reg in self.uncached or lpgbt not in LPGBT_ADDRESSES:
+            return None
+        return (self.device, LPGBT_ADDRESSES[lpgbt], reg)
+
+    def cache_stats(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses,
+                "entries": 0 if self.cache is None else len(self.cache)}
+
+    def write_i2cm_control(self,data_reg,command_reg,control):
+        # Set an I2C master's control register (speed and byte count), by putting the
+        # value in its first data register and sending the WRITE_CR command (0x0)
+        # The data register is reused for every transaction, so the cache can't tell
+        # whether the control register already holds the value; this remembers it instead
+        key = (self.device, command_reg)
+        if self.cache is not None:
+            if self.i2cm_control.get(key) == control:
+                self.cache_hits += 2
+                return
+            self.cache_misses += 2
+        self.write_lpgbt(data_reg, control)
+        self.write_lpgbt(command_reg, 0x0)
+        if self.cache is not None:
+            self.i2cm_control[key] = control
+
     def write_lpgbt(self,reg,val, lpgbt='A'): 
+        key = self.cache_key(reg, lpgbt)
+        if key is not None:
+            if self.cache.get(key) == val:
+                self.cache_hits += 1
+                return
+            self.cache_misses += 1
+
+        self.write_lpgbt_uncached(reg, val, lpgbt)
+        if key is not None:
+            self.cache[key] = val
+
+    def write_lpgbt_uncached(self,reg,val, lpgbt='A'):
         if lpgbt!='A': 
             self.write_lpgbt_trig(lpgbt,reg,val)
         elif self.mode == "I2C":
@@ -63,26 +255,96 @@ class iic:
             self.write_IC(reg,val)
 
     def read_lpgbt(self,reg, lpgbt='A'):
+        val = self.read_lpgbt_uncached(reg, lpgbt)
+        key = self.cache_key(reg, lpgbt)
+        if key is not None:
+            self.cache[key] = val
+        return val
+
+    def read_lpgbt_uncached(self,reg, lpgbt='A'):
         if lpgbt!='A': 
             return self.read_lpgbt_trig(lpgbt,reg)
         elif self.mode == "I2C":
-            self.write([reg&0xFF,((reg>>8)&0xFF)])
-            return self.read(1)[0]
+            return bytearray(self.write_read([reg&0xFF,((reg>>8)&0xFF)],1))[0]
         elif self.mode == "IC":
             return self.read_IC(reg)[0]
 
+    def read_lpgbt_later(self,reg,lpgbt='A'):
+        # A future of reg's value. Inside transaction_IC (IC mode, lpGBT A) the read is
+        # sent with the transaction's other frames, so many cost few round trips; the
+        # future is resolved when they are dispatched. Anywhere else it reads at once
+        future = concurrent.futures.Future()
+        if self.mode != "IC" or lpgbt != 'A' or self.ic_depth == 0:
+            future.set_result(self.read_lpgbt(reg,lpgbt))
+            return future
+
+        def cache(done):
+            key = self.cache_key(reg, lpgbt)
+            if key is not None and done.exception() is None:
+                self.cache[key] = done.result()
+        future.add_done_callback(cache)
+        self.queue_IC("read", reg, 1, future)
+        return future
+
+    def read_lpgbt_block(self,reg,nbytes,lpgbt='A'):
+        # Read nbytes consecutive registers starting at reg, as bytes
+        data = self.read_lpgbt_block_uncached(reg,nbytes,lpgbt)
+        values = bytearray(data)
+        for i in range(len(values)):
+            key = self.cache_key(reg+i, lpgbt)
+            if key is not None:
+                self.cache[key] = values[i]
+        return data
+
+    def read_lpgbt_block_uncached(self,reg,nbytes,lpgbt='A'):
+        if lpgbt!='A':
+            return bytes(bytearray([self.read_lpgbt_trig(lpgbt,reg+i) for i in range(nbytes)]))
+        elif self.mode == "I2C":
+            # The lpGBT increments the register address after each byte
+            out = bytearray()
+            for start in range(0,nbytes,self.block_size):
+                n = min(self.block_size,nbytes-start)
+                at = reg+start
+                out += self.write_read([at&0xFF,((at>>8)&0xFF)],n)
+            return bytes(out)
+        elif self.mode == "IC":
+            return bytes(bytearray(self.read_IC(reg,nbytes)))
+
+    def write_lpgbt_block(self,reg,data,lpgbt='A'):
+        # Write the bytes in data to consecutive registers starting at reg
+        data = bytearray(data)
+        if lpgbt!='A':
+            for i in range(len(data)):
+                self.write_lpgbt(reg+i,data[i],lpgbt)
+            return
+
+        keys = [self.cache_key(reg+i, lpgbt) for i in range(len(data))]
+        if self.cache is not None:
+            # Skip the block only if every register is known to hold its value already
+            if all(keys[i] is not None and self.cache.get(keys[i]) == data[i] for i in range(len(data))):
+                self.cache_hits += 1
+                return
+            self.cache_misses += 1
+
+        if self.mode == "I2C":
+            for start in range(0,len(data),self.block_size):
+                at = reg+start
+                self.write(bytearray([at&0xFF,((at>>8)&0xFF)])+data[start:start+self.block_size])
+        elif self.mode == "IC":
+            self.write_IC_block(reg,data)
+
+        for i in range(len(data)):
+            if keys[i] is not None:
+                self.cache[keys[i]] = data[i]
+
     def read(self,nbytes):
         # For use with I2C path
+        if self.bus is not None:
+            return self.bus.read(self.addr,nbytes)
         rv=os.read(self.fd,nbytes)
-        if rv is not None:
-            rvi=[]
-            for item in rv:
-               if sys.version_info > (3, 0):
-                  rvi.append(item)
-               else:
-                  rvi.append(ord(item))
-            return rvi
-        else: return None
+        if rv is not None and sys.version_info < (3, 0):
+            return bytearray(rv)
+        return rv
         
     def write(self,mybuf):
         # For use with I2C path
@@ -90,8 +352,39 @@ class iic:
         #for val in (mybuf):
         #    s += chr(val)
         #os.write(self.fd,s)
+        if self.bus is not None:
+            self.bus.write(self.addr,bytes(bytearray(mybuf)))
+            return
         os.write(self.fd,bytes(bytearray(mybuf)))
 
+    def write_read(self,wbuf,nbytes):
+        # For use with I2C path
+        # Write then read with a repeated start in between, in one ioctl
+        wbuf = bytes(bytearray(wbuf))
+        if self.bus is not None:
+            return self.bus.write_read(self.addr,wbuf,nbytes)
+        wdata = (ctypes.c_uint8*len(wbuf)).from_buffer_copy(wbuf)
+        rdata = (ctypes.c_uint8*nbytes)()
+        msgs = (i2c_msg*2)(
+            i2c_msg(self.addr, 0, len(wbuf), wdata),
+            i2c_msg(self.addr, I2C_M_RD, nbytes, rdata))
+        fcntl.ioctl(self.fd, I2C_RDWR, i2c_rdwr_ioctl_data(msgs, 2))
+        return bytes(memoryview(rdata))
+
+    def wait_i2cm(self,status_reg):
+        # Wait for an lpGBT I2C master transaction to finish, raising on bus errors
+        def finished(status):
+            if status & 0x4:
+                return True
+            if status & 0x40:
+                print("Problem: I2C NACK")
+                raise I2CException("I2C NACK encountered")
+            elif status & 0x8:
+                print("Problem: SDA low before starting transaction")
+                raise I2CException("SDA low before starting transaction")
+            return False
+        return poll_until(lambda: self.read_lpgbt(status_reg), finished, self.timeout, stats=self.stats)
+
     def write_lpgbt_trig(self,lpgbt_id,reg,val):
         # Assuming a one-byte val  
         lpgbt_addr = None
@@ -106,9 +399,7 @@ class iic:
             return
 
         # set speed to 100 kHz, and write three bytes 
-        self.write_lpgbt(0x0f9, ((3) << 2)+0x0)
-        # send command to write to control register
-        self.write_lpgbt(0x0fd, 0x0)
+        self.write_i2cm_control(0x0f9, 0x0fd, ((3) << 2)+0x0)
 
         # Set up what all should be sent, and where                                                                                                                                                        
         self.write_lpgbt(0x0f8, lpgbt_addr)
@@ -121,16 +412,7 @@ class iic:
         self.write_lpgbt(0x0fd, 0xc)
 
         # Check the status of the transaction 
-        status = self.read_lpgbt(0x176)
-        while not (status & 0x4):
-            if status & 0x40:
-                print("Problem: I2C NACK")
-                raise I2CException("I2C NACK encountered")
-            elif status & 0x8:
-                print("Problem: SDA low before starting transaction")
-                raise I2CException("SDA low before starting transaction")
-            else:
-                status = self.read_lpgbt(0x176)
+        self.wait_i2cm(0x176)
 
 
     def read_lpgbt_trig(self,lpgbt_id,reg):
@@ -147,9 +429,7 @@ class iic:
             return
 
         # set speed to 100 kHz, and write 2 bytes (for the reg address) 
-        self.write_lpgbt(0x0f9, ((2)<<2)+0x0 )
-        # send command to write to control register 
-        self.write_lpgbt(0x0fd, 0x0)
+        self.write_i2cm_control(0x0f9, 0x0fd, ((2)<<2)+0x0)
 
         self.write_lpgbt(0x0f8, lpgbt_addr)
         self.write_lpgbt(0x0f9, reg&0xFF)
@@ -160,32 +440,14 @@ class iic:
         self.write_lpgbt(0x0fd, 0xc)
 
         # Check the status of the transaction  
-        status = self.read_lpgbt(0x176)
-        while not (status & 0x4):
-            if status & 0x40:
-                print("Problem: I2C NACK")
-                raise I2CException("I2C NACK encountered")
-            elif status & 0x8:
-                print("Problem: SDA low before starting transaction")
-                raise I2CException("SDA low before starting transaction")
-            else:
-                status = self.read_lpgbt(0x176)
+        self.wait_i2cm(0x176)
 
         # Now try reading 
         # Write command word for reading 
         self.write_lpgbt(0x0f8, lpgbt_addr)
         self.write_lpgbt(0x0fd, 0x3)
 
-        status = self.read_lpgbt(0x176)
-        while not (status & 0x4):
-            if status & 0x40:
-                print("Problem: I2C NACK")
-                raise I2CException("I2C NACK encountered")
-            elif status & 0x8:
-                print("Problem: SDA low before starting transaction")
-                raise I2CException("SDA low before starting transaction")
-            else:
-                status = self.read_lpgbt(0x176)
+        self.wait_i2cm(0x176)
 
         # Read back  
         output = self.read_lpgbt(0x178)
@@ -198,9 +460,7 @@ class iic:
         vtrx_addr = 0x50
 
         # set speed to 100 kHz, and write 2 bytes 
-        self.write_lpgbt(0x100, ((2)<<2)+0x0 )
-        # send command to write to control register 
-        self.write_lpgbt(0x104, 0x0)
+        self.write_i2cm_control(0x100, 0x104, ((2)<<2)+0x0)
 
         self.write_lpgbt(0x0ff, vtrx_addr)
         self.write_lpgbt(0x100, reg&0xFF)
@@ -211,25 +471,14 @@ class iic:
         self.write_lpgbt(0x104, 0xc)
 
         # Check the status of the transaction  
-        status = self.read_lpgbt(0x18b)
-        while not (status & 0x4):
-            if status & 0x40:
-                print("Problem: I2C NACK")
-                raise I2CException("I2C NACK encountered")
-            elif status & 0x8:
-                print("Problem: SDA low before starting transaction")
-                raise I2CException("SDA low before starting transaction")
-            else:
-                status = self.read_lpgbt(0x18b)
+        self.wait_i2cm(0x18b)
 
     def read_vtrx(self,reg):
         # Reading back one byte from reg  
         vtrx_addr = 0x50
 
         # set speed to 100 kHz, and write 1 bytes (for the reg address) 
-        self.write_lpgbt(0x100, ((1)<<2)+0x0 )
-        # send command to write to control register 
-        self.write_lpgbt(0x104, 0x0)
+        self.write_i2cm_control(0x100, 0x104, ((1)<<2)+0x0)
 
         self.write_lpgbt(0x0ff, vtrx_addr)
         self.write_lpgbt(0x100, reg&0xFF)  #vtrx has 1-byte address
@@ -239,32 +488,14 @@ class iic:
         self.write_lpgbt(0x104, 0xc)
 
         # Check the status of the transaction  
-        status = self.read_lpgbt(0x18b)
-        while not (status & 0x4):
-            if status & 0x40:
-                print("Problem: I2C NACK")
-                raise I2CException("I2C NACK encountered")
-            elif status & 0x8:
-                print("Problem: SDA low before starting transaction")
-                raise I2CException("SDA low before starting transaction")
-            else:
-                status = self.read_lpgbt(0x18b)
+        self.wait_i2cm(0x18b)
 
         # Now try reading 
         # Write command word for reading 
         self.write_lpgbt(0x0ff, vtrx_addr)
         self.write_lpgbt(0x104, 0x3)
 
-        status = self.read_lpgbt(0x18b)
-        while not (status & 0x4):
-            if status & 0x40:
-                print("Problem: I2C NACK")
-                raise I2CException("I2C NACK encountered")
-            elif status & 0x8:
-                print("Problem: SDA low before starting transaction")
-                raise I2CException("SDA low before starting transaction")
-            else:
-                status = self.read_lpgbt(0x18b)
+        self.wait_i2cm(0x18b)
 
         # Read back  
         output = self.read_lpgbt(0x18d)
@@ -275,39 +506,148 @@ class iic:
 
 
     ## ----------- Start IC stuff ----------- ##
+    # Each hw.dispatch() is a network round trip to the FPGA, so IC accesses
+    # queue as much as possible into each dispatch.
+
+    # Words the IC reply frame wraps around the data read back
+    IC_RX_HEADER_WORDS = 7
+    IC_RX_TRAILER_WORDS = 1
+
+    def dispatch_IC(self):
+        # Dispatch queued IC accesses, unless inside an IC transaction
+        if self.ic_depth == 0:
+            self.hw.dispatch()
+
+    @contextlib.contextmanager
+    def transaction_IC(self):
+        # Hold back IC writes (and read_lpgbt_later reads) made inside the with block and
+        # send them together at the end. Writes to consecutive registers are merged into
+        # one frame, as are reads; other reads inside the block send everything held first
+        self.ic_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.ic_depth -= 1
+            if self.ic_depth == 0:
+                self.drop_IC()
+            raise
+        self.ic_depth -= 1
+        if self.ic_depth == 0:
+            self.flush_IC()
+
+    def queue_IC(self, op, reg, data, future=None):
+        # Hold back a write of the bytes in data, or a read of data registers,
+        # extending the last held frame when it is the same op and ends at reg
+        if self.ic_pending and self.ic_pending[-1][0] == op:
+            last = self.ic_pending[-1]
+            end = last[1] + (len(last[2]) if op == "write" else last[2])
+            if end == reg:
+                if op == "write":
+                    last[2] += bytearray(data)
+                else:
+                    last[3].append((last[2], data, future))
+                    last[2] += data
+                return
+        if op == "write":
+            self.ic_pending.append([op, reg, bytearray(data), []])
+        else:
+            self.ic_pending.append([op, reg, data, [(0, data, future)]])
+
+    def flush_IC(self):
+        # Send every held frame in order. The TX FIFO can only be loaded again once the
+        # frame before has gone out, so each frame is a dispatch of its own
+        pending, self.ic_pending = self.ic_pending, []
+        for index, (op, reg, data, futures) in enumerate(pending):
+            if op == "write":
+                self.send_IC_write(reg, data)
+                self.hw.dispatch()
+                continue
+            try:
+                words = self.read_IC(reg, data)
+            except Exception as e:
+                for _, _, future in futures:
+                    future.set_exception(e)
+                for _, _, _, later in pending[index + 1:]:
+                    for _, _, future in later:
+                        future.cancel()
+                raise
+            for offset, n, future in futures:
+                future.set_result(words[offset] if n == 1 else words[offset:offset + n])
+
+    def drop_IC(self):
+        # Forget held frames, eg. when the transaction raised
+        for _, _, _, futures in self.ic_pending:
+            for _, _, future in futures:
+                future.cancel()
+        self.ic_pending = []
+
     def write_IC(self, reg, val):
+        self.write_IC_block(reg, [val])
+
+    def write_IC_block(self, reg, data):
+        # Write every byte to consecutive registers, held back inside a transaction
+        if self.ic_depth > 0:
+            self.queue_IC("write", reg, data)
+            return
+        self.send_IC_write(reg, data)
+        self.hw.dispatch()
+
+    def send_IC_write(self, reg, data):
+        # Queue one write frame: load the bytes into the TX FIFO and start it
         backend = self.hw.getNode("backend")
         backend.getNode("IC_TX_I2C_ADDR").write(0x70)
-        self.hw.dispatch()
         backend.getNode("IC_TX_REG_ADDR").write(reg)
-        backend.getNode("IC_TX_DATA").write(val) 
-        backend.getNode("CTL.IC_TX_FIFO_LOAD").write(1)
-        self.hw.dispatch()
+        for val in bytearray(data):
+            backend.getNode("IC_TX_DATA").write(val)
+            backend.getNode("CTL.IC_TX_FIFO_LOAD").write(1)
         backend.getNode("CTL.IC_START_WRITE").write(1)  # write 1, gets cleared automatically
-        self.hw.dispatch()
-
 
     def read_IC(self, reg, nread=1):
+        # Writes held by a transaction go first, so the read sees them
+        if self.ic_pending:
+            self.flush_IC()
         backend=self.hw.getNode("backend")
         backend.getNode("IC_TX_I2C_ADDR").write(0x70)
-        self.hw.dispatch()
         backend.getNode("IC_TX_REG_ADDR").write(reg)
         backend.getNode("IC_TX_N_READ").write(nread)
-        self.hw.dispatch()
         backend.getNode("CTL.IC_START_READ").write(1)
         self.hw.dispatch()
-        empty= backend.getNode("IC_RX_EMPTY").read()
+
+        words = self.drain_IC(self.IC_RX_HEADER_WORDS + nread + self.IC_RX_TRAILER_WORDS)
+        return words[self.IC_RX_HEADER_WORDS:-self.IC_RX_TRAILER_WORDS]
+
+    def drain_IC(self, expected):
+        # Read the RX FIFO, taking the expected number of words in one dispatch
+        # Without an occupancy register the count is a guess, so the empty flag is read
+        # before each word, and words read from an empty FIFO are dropped
+        backend=self.hw.getNode("backend")
+        if self.ic_has_occupancy:
+            count = backend.getNode("IC_RX_OCCUPANCY").read()
+        else:
+            count = backend.getNode("IC_RX_EMPTY").read()
         self.hw.dispatch()
 
+        if self.ic_has_occupancy:
+            count = int(count)
+        else:
+            count = 0 if count else expected
+
         words = []
+        empty = count == 0
         while not empty:
-            word = backend.getNode("IC_RX_DATA").read()
-            self.hw.dispatch()
-            words.append(word)
-            backend.getNode("CTL.IC_RX_FIFO_ADV").write(1) 
-            self.hw.dispatch()
-            empty= backend.getNode("IC_RX_EMPTY").read()
+            queued = []
+            for i in range(max(count, 1)):
+                was_empty = None if self.ic_has_occupancy else backend.getNode("IC_RX_EMPTY").read()
+                queued.append((was_empty, backend.getNode("IC_RX_DATA").read()))
+                backend.getNode("CTL.IC_RX_FIFO_ADV").write(1)
+            empty = backend.getNode("IC_RX_EMPTY").read()
             self.hw.dispatch()
 
-        return words[7:-1]
-        
+            words += [int(word) for was_empty, word in queued if was_empty is None or not was_empty]
+            # More arrived than expected, take the rest a word at a time
+            count = 1
+
+        if len(words) < expected:
+            raise IOError("IC read returned %d words, expected %d" % (len(words), expected))
+        return words
+
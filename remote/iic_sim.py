@@ -0,0 +1,311 @@
+#!/usr/bin/python
+
+"""In-process simulation of the I2C devices iic talks to, for use without hardware
+
+An i2c_bus_sim stands in for a /dev/i2c-* node: pass it as dev to iic.connect()
+(or as the device to mm_power_man) and every transaction goes to the simulated
+devices on it instead of the kernel:
+
+    bus = iic_sim.trophy_bus()
+    lpgbt = iic.iic()
+    lpgbt.connect(dev=bus, addr=0x70)
+    lpgbt.write_lpgbt(0x123, 0x45, lpgbt='B')
+
+Modelled are the lpGBT register file with both I2C masters (status bits, NACK
+and SDA-low errors included), secondary lpGBTs and the VTRx behind them, and
+the multimodule power hub's ADC and GPIO expander.
+"""
+
+import errno
+import time
+
+
+def nack():
+    return OSError(errno.EREMOTEIO, "Remote I/O error (simulated NACK)")
+
+
+class i2c_bus_sim:
+    """A bus of simulated devices, keyed by their 7-bit address
+
+    latency is added to every transaction, in seconds.
+    """
+
+    def __init__(self, latency=0.0):
+        self.devices = {}
+        self.latency = latency
+        self.transactions = 0
+
+    def attach(self, device):
+        self.devices[device.address] = device
+        return device
+
+    def device(self, addr):
+        self.transactions += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if addr not in self.devices or not self.devices[addr].ready():
+            raise nack()
+        return self.devices[addr]
+
+    def write(self, addr, data):
+        self.device(addr).i2c_write(bytearray(data))
+
+    def read(self, addr, nbytes):
+        return bytes(self.device(addr).i2c_read(nbytes))
+
+    def write_read(self, addr, data, nbytes):
+        # Repeated start: both halves happen in one transaction, without a stop in between
+        dev = self.device(addr)
+        if hasattr(dev, "i2c_write_read"):
+            return bytes(dev.i2c_write_read(bytearray(data), nbytes))
+        dev.i2c_write(bytearray(data), stop=False)
+        return bytes(dev.i2c_read(nbytes))
+
+
+class register_device:
+    """A device with a register file and an auto-incrementing address pointer"""
+
+    def __init__(self, address, size, address_bytes):
+        self.address = address
+        self.registers = bytearray(size)
+        self.address_bytes = address_bytes
+        self.pointer = 0
+
+    def ready(self):
+        return True
+
+    def i2c_write(self, data, stop=True):
+        if len(data) < self.address_bytes:
+            return
+        if self.address_bytes == 2:
+            self.pointer = data[0] | (data[1] << 8)
+        else:
+            self.pointer = data[0]
+        for val in data[self.address_bytes:]:
+            self.write_reg(self.pointer, val)
+            self.pointer = (self.pointer + 1) % len(self.registers)
+
+    def i2c_read(self, nbytes):
+        out = bytearray()
+        for i in range(nbytes):
+            out.append(self.read_reg(self.pointer))
+            self.pointer = (self.pointer + 1) % len(self.registers)
+        return out
+
+    def write_reg(self, reg, val):
+        self.registers[reg] = val & 0xFF
+
+    def read_reg(self, reg):
+        return self.registers[reg]
+
+
+class i2c_master_sim:
+    """One lpGBT I2C master: its registers, the command engine and the bus behind it
+
+    transaction_time is how long each command keeps the status register at 0.
+    sda_low makes every command fail with the SDA-low error bit.
+    """
+
+    CMD_WRITE_CRA = 0x0
+    CMD_1BYTE_WRITE = 0x2
+    CMD_1BYTE_READ = 0x3
+    CMD_W_MULTI_4BYTE0 = 0x8
+    CMD_WRITE_MULTI = 0xc
+
+    STATUS_SUCCESS = 0x4
+    STATUS_LEVEL_ERROR = 0x8
+    STATUS_NOACK = 0x40
+
+    def __init__(self, lpgbt, address_reg, cmd_reg, status_reg, read_reg, transaction_time=0.0):
+        self.lpgbt = lpgbt
+        self.address_reg = address_reg
+        self.data_regs = [address_reg + 1 + i for i in range(4)]
+        self.cmd_reg = cmd_reg
+        self.status_reg = status_reg
+        self.read_reg = read_reg
+        self.transaction_time = transaction_time
+        self.bus = i2c_bus_sim()
+        self.sda_low = False
+        self.nbytes = 0
+        self.buffer = bytearray(16)
+        self.status = 0
+        self.done_at = 0.0
+
+    def command(self, cmd):
+        regs = self.lpgbt.registers
+        data = [regs[reg] for reg in self.data_regs]
+        slave = regs[self.address_reg] & 0x7F
+
+        if cmd == self.CMD_WRITE_CRA:
+            self.nbytes = (data[0] >> 2) & 0x1F
+            return
+        if cmd == self.CMD_W_MULTI_4BYTE0:
+            self.buffer[0:4] = bytearray(data)
+            return
+
+        self.status = 0
+        self.done_at = time.time() + self.transaction_time
+        if self.sda_low:
+            self.result = self.STATUS_LEVEL_ERROR
+            return
+
+        try:
+            if cmd == self.CMD_WRITE_MULTI:
+                self.bus.write(slave, self.buffer[:self.nbytes])
+            elif cmd == self.CMD_1BYTE_WRITE:
+                self.bus.write(slave, bytearray(data[:1]))
+            elif cmd == self.CMD_1BYTE_READ:
+                regs[self.read_reg] = bytearray(self.bus.read(slave, 1))[0]
+            self.result = self.STATUS_SUCCESS
+        except OSError:
+            self.result = self.STATUS_NOACK
+
+    def read_status(self):
+        if self.done_at and time.time() >= self.done_at:
+            self.status = self.result
+            self.done_at = 0.0
+        return self.status
+
+
+class lpgbt_sim(register_device):
+    """An lpGBT as seen over I2C: a 16-bit addressed register file, with I2C masters 1 and 2"""
+
+    def __init__(self, address=0x70, transaction_time=0.0):
+        register_device.__init__(self, address, 0x200, 2)
+        self.masters = {
+            1: i2c_master_sim(self, 0x0f8, 0x0fd, 0x176, 0x178, transaction_time),
+            2: i2c_master_sim(self, 0x0ff, 0x104, 0x18b, 0x18d, transaction_time),
+        }
+
+    def write_reg(self, reg, val):
+        register_device.write_reg(self, reg, val)
+        for master in self.masters.values():
+            if reg == master.cmd_reg:
+                master.command(val)
+
+    def read_reg(self, reg):
+        for master in self.masters.values():
+            if reg == master.status_reg:
+                return master.read_status()
+        return register_device.read_reg(self, reg)
+
+
+class vtrx_sim(register_device):
+    """A VTRx+ control interface: 8-bit addressed registers"""
+
+    def __init__(self, address=0x50):
+        register_device.__init__(self, address, 0x100, 1)
+
+
+def trophy_bus(latency=0.0, transaction_time=0.0):
+    """The primary lpGBT, with secondaries B/C/D on its master 1 and the VTRx on master 2"""
+    bus = i2c_bus_sim(latency)
+    primary = bus.attach(lpgbt_sim(0x70, transaction_time))
+    for address in (0x71, 0x72, 0x73):
+        primary.masters[1].bus.attach(lpgbt_sim(address, transaction_time))
+    primary.masters[2].bus.attach(vtrx_sim(0x50))
+    return bus
+
+
+class adc_sim:
+    """The power hub's ADC: a channel-multiplexed converter that NACKs while converting
+
+    A conversion starts after every stop, on the channel selected by the last write.
+    A write followed by a read with a repeated start selects the next channel and
+    reads out the previous result in one go.
+    """
+
+    def __init__(self, hub, address=0x76, conversion_time=0.15):
+        self.hub = hub
+        self.address = address
+        self.conversion_time = conversion_time
+        self.command = 0xB0
+        self.result = None
+        self.done_at = 0.0
+        self.start()
+
+    def start(self):
+        self.converting = self.command
+        self.done_at = time.time() + self.conversion_time
+
+    def ready(self):
+        return time.time() >= self.done_at
+
+    def finished(self):
+        chan = self.converting & 0x0F
+        single = (self.converting & 0x10) != 0
+        return self.encode(self.hub.channel_voltage(chan, single))
+
+    def i2c_write(self, data, stop=True):
+        if len(data) > 0:
+            self.command = data[0]
+        if stop:
+            self.start()
+
+    def i2c_read(self, nbytes):
+        out = self.finished()
+        self.start()
+        return out[:nbytes]
+
+    def i2c_write_read(self, data, nbytes):
+        out = self.finished()
+        self.i2c_write(data)
+        return out[:nbytes]
+
+    def encode(self, volts):
+        code = int(round(volts / 1.25 * 0x10000))
+        if code >= 0x10000:
+            return bytearray([0xC0, 0, 0])
+        if code < -0x10000:
+            return bytearray([0x00, 0, 0])
+        prefix = 0x80
+        if code < 0:
+            prefix = 0x40
+            code = code + 0x10000
+        return bytearray([prefix | ((code >> 10) & 0x3F), (code >> 2) & 0xFF, (code & 0x3) << 6])
+
+
+class gpio_sim(register_device):
+    """The power hub's GPIO expander: enables on register 2, power-good flags on register 1"""
+
+    def __init__(self, hub, address=0x27):
+        register_device.__init__(self, address, 8, 1)
+        self.hub = hub
+
+    def read_reg(self, reg):
+        if reg == 1:
+            stat = 0
+            for module in (1, 2, 3):
+                if self.hub.enabled(module):
+                    stat |= 0x3 << ((3 - module) * 2)
+            return stat
+        return register_device.read_reg(self, reg)
+
+
+class power_hub_sim:
+    """The multimodule power hub: an ADC and a GPIO expander on one bus
+
+    Enabled modules draw current_analog and current_digital amps.
+    """
+
+    SHUNT_RESISTOR = 0.05
+
+    def __init__(self, latency=0.0, conversion_time=0.15, input_voltage=1.5, current_analog=0.65, current_digital=0.95):
+        self.bus = i2c_bus_sim(latency)
+        self.input_voltage = input_voltage
+        self.current_analog = current_analog
+        self.current_digital = current_digital
+        self.adc = self.bus.attach(adc_sim(self, conversion_time=conversion_time))
+        self.gpio = self.bus.attach(gpio_sim(self))
+
+    def enabled(self, module):
+        return (self.gpio.registers[2] & (1 << (module - 1))) != 0
+
+    def channel_voltage(self, chan, single):
+        if single:
+            return self.input_voltage - 1.25 if chan == 0 else 0.0
+        module = 3 - chan // 2
+        if not self.enabled(module):
+            return 0.0
+        current = self.current_analog if chan % 2 else self.current_digital
+        return current * self.SHUNT_RESISTOR
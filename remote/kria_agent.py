@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+"""Control agent running on the Kria, answering structured requests over zmq
+
+Replaces shell commands sent over SSH for the operations the GUI needs. Each
+request is a JSON object with an "op" and its arguments; each reply is a JSON
+object with "ok" and either "result" or "error". A request's "lane" (by default
+"control") picks the worker thread it runs on: requests on one lane run in order,
+and lanes run side by side, so a status request is answered during a firmware load.
+
+    gpio_export  pins, direction      export the pins and set their direction
+    gpio_set     pins, value          set output pins to value
+    gpio_get     pins                 {pin: value}
+    fw_load      name                 load a firmware with fw-loader, {stdout, stderr, code}
+    fw_query                          the output of fw-loader list
+    service_status  services          {service: {active, sub}}
+    service_restart service           restart a systemd service, {active, sub} after
+    ping
+
+It only listens on --bind (by default localhost). Listening anywhere else needs a
+shared secret, which every request must carry as "secret"; the GUI sends the one
+in its KRIA_AGENT_SECRET environment variable:
+
+    KRIA_AGENT_SECRET=... python kria_agent.py --bind 192.168.1.10 --port 5560
+
+--fake answers from in-memory state instead, for testing the GUI offline:
+
+    python kria_agent.py --fake --port 5560
+"""
+
+import argparse
+import hmac
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+
+import zmq
+
+
+class kria_backend:
+    """The real Kria: sysfs GPIO, fw-loader and systemd"""
+
+    def gpio_export(self, pins, direction="out"):
+        for pin in pins:
+            try:
+                with open("/sys/class/gpio/export", "w") as f:
+                    f.write(str(pin))
+            except OSError:
+                # Already exported
+                pass
+            with open("/sys/class/gpio/gpio%d/direction" % pin, "w") as f:
+                f.write(direction)
+
+    def gpio_set(self, pins, value):
+        for pin in pins:
+            with open("/sys/class/gpio/gpio%d/value" % pin, "w") as f:
+                f.write(str(int(value)))
+
+    def gpio_get(self, pins):
+        values = {}
+        for pin in pins:
+            with open("/sys/class/gpio/gpio%d/value" % pin) as f:
+                values[str(pin)] = int(f.read().strip())
+        return values
+
+    def fw_load(self, name):
+        process = subprocess.run(["fw-loader", "load", name], capture_output=True, text=True)
+        return {"stdout": process.stdout, "stderr": process.stderr, "code": process.returncode}
+
+    def fw_query(self):
+        return subprocess.run(["fw-loader", "list"], capture_output=True, text=True).stdout
+
+    def service_status(self, services):
+        states = {}
+        for service in services:
+            output = subprocess.run(["systemctl", "show", "-p", "ActiveState", "-p", "SubState", service],
+                                    capture_output=True, text=True).stdout
+            fields = dict(line.split("=", 1) for line in output.splitlines() if "=" in line)
+            states[service] = {"active": fields.get("ActiveState", "unknown"), "sub": fields.get("SubState", "unknown")}
+        return states
+
+    def service_restart(self, service):
+        process = subprocess.run(["systemctl", "restart", service], capture_output=True, text=True)
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr.strip())
+        return self.service_status([service])[service]
+
+
+class fake_backend:
+    """In-memory stand-in for the Kria, with no hardware behind it
+
+    Restarted services report activating for restart_time seconds.
+    """
+
+    def __init__(self, restart_time=0.5):
+        self.restart_time = restart_time
+        self.gpio = {}
+        self.firmware = None
+        self.restarted_at = {}
+
+    def gpio_export(self, pins, direction="out"):
+        for pin in pins:
+            self.gpio.setdefault(pin, 0)
+
+    def gpio_set(self, pins, value):
+        for pin in pins:
+            if pin not in self.gpio:
+                raise RuntimeError("GPIO %d not exported" % pin)
+            self.gpio[pin] = int(value)
+
+    def gpio_get(self, pins):
+        return {str(pin): self.gpio[pin] for pin in pins}
+
+    def fw_load(self, name):
+        self.firmware = name
+        return {"stdout": "Loaded %s\n" % name, "stderr": "", "code": 0}
+
+    def fw_query(self):
+        return "" if self.firmware is None else self.firmware + "\n"
+
+    def service_status(self, services):
+        states = {}
+        for service in services:
+            if time.time() - self.restarted_at.get(service, 0) < self.restart_time:
+                states[service] = {"active": "activating", "sub": "start"}
+            else:
+                states[service] = {"active": "active", "sub": "running"}
+        return states
+
+    def service_restart(self, service):
+        self.restarted_at[service] = time.time()
+        return self.service_status([service])[service]
+
+
+def handle(backend, request, secret=None):
+    args = dict(request)
+    given = args.pop("secret", None)
+    if secret is not None and not hmac.compare_digest(str(given).encode(), secret.encode()):
+        raise PermissionError("Missing or wrong secret")
+    args.pop("lane", None)
+    op = args.pop("op", None)
+    if op == "ping":
+        return None
+    if op not in ("gpio_export", "gpio_set", "gpio_get", "fw_load", "fw_query", "service_status", "service_restart"):
+        raise ValueError("Unknown op %s" % op)
+    return getattr(backend, op)(**args)
+
+
+def work(backend, secret, context, requests):
+    """Answer one lane's requests in order, passing replies back to serve over inproc"""
+    replies = context.socket(zmq.PUSH)
+    replies.connect("inproc://replies")
+    while True:
+        envelope, request = requests.get()
+        try:
+            reply = {"ok": True, "result": handle(backend, request, secret)}
+        except Exception as e:
+            reply = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+        replies.send_multipart(envelope + [json.dumps(reply).encode()])
+
+
+def serve(backend, bind, port, secret=None):
+    """Take requests on a ROUTER socket and hand each to its lane's worker
+
+    Only this thread uses the sockets; workers send their replies back through
+    an inproc socket, which is polled alongside the requests.
+    """
+    context = zmq.Context()
+    socket = context.socket(zmq.ROUTER)
+    socket.bind("tcp://%s:%d" % (bind, port))
+    replies = context.socket(zmq.PULL)
+    replies.bind("inproc://replies")
+
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    poller.register(replies, zmq.POLLIN)
+    lanes = {}
+    while True:
+        ready = dict(poller.poll())
+        if replies in ready:
+            socket.send_multipart(replies.recv_multipart())
+        if socket in ready:
+            # A REQ client's message is its identity, an empty delimiter, then the request
+            frames = socket.recv_multipart()
+            envelope, message = frames[:-1], frames[-1]
+            try:
+                request = json.loads(message)
+                lane = str(request.get("lane", "control"))
+            except Exception as e:
+                error = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+                socket.send_multipart(envelope + [json.dumps(error).encode()])
+                continue
+
+            if lane not in lanes:
+                lanes[lane] = queue.Queue()
+                threading.Thread(target=work, args=(backend, secret, context, lanes[lane]), daemon=True).start()
+            lanes[lane].put((envelope, request))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Kria control agent")
+    parser.add_argument('--bind', default='127.0.0.1', help='Address of the interface to answer requests on')
+    parser.add_argument('--port', type=int, default=5560, help='Port to answer requests on')
+    parser.add_argument('--secret', default=os.environ.get('KRIA_AGENT_SECRET'),
+                        help='Shared secret requests must carry, by default $KRIA_AGENT_SECRET')
+    parser.add_argument('--fake', action='store_true', help='Answer from in-memory state, with no hardware')
+    args = parser.parse_args()
+
+    if args.bind not in ('127.0.0.1', 'localhost') and not args.secret:
+        parser.error('--secret (or KRIA_AGENT_SECRET) is needed to listen on %s' % args.bind)
+
+    serve(fake_backend() if args.fake else kria_backend(), args.bind, args.port, args.secret or None)
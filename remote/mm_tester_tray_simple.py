@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import iic
+import sys
 import time
 import argparse
 import json
@@ -11,6 +12,10 @@ class mm_power_man:
    GPIO_STATUS_REG=1
    GPIO_ENABLE_REG_CFG=6
    GPIO_STATUS_REG_CFG=7
+   # The ADC does not acknowledge while converting (about 150 ms per conversion)
+   ADC_POLL_INTERVAL=0.005
+   ADC_TIMEOUT=1.0
+   SHUNT_RESISTOR=0.05
    
    def __init__(self,device):
       self.adc=iic.iic()
@@ -21,13 +26,12 @@ class mm_power_man:
          self.gpio_write(self.GPIO_ENABLE_REG,0)
          self.gpio_write(self.GPIO_ENABLE_REG_CFG,0xF8)
          
-   def adc_read(self,chan,diff=True):
+   def adc_command(self,chan,diff=True):
       cmd=0x80|0x20|chan
       if not diff: cmd=cmd|0x10
-      time.sleep(0.16)
-      self.adc.write([cmd])
-      time.sleep(0.16)
-      x=self.adc.read(3)
+      return cmd
+
+   def adc_decode(self,x):
       val=((int(x[0])&0x3F)<<10)|(int(x[1])<<2)|(int(x[2])>>6)
       if (int(x[0])&0xC0)==0x40:
          val=val-0x10000
@@ -39,15 +43,64 @@ class mm_power_man:
       val=val*1.25000/0x10000
       return val
 
+   def adc_retry(self,transaction):
+      """Retry an ADC transaction until the ADC acknowledges, meaning its conversion is ready"""
+      def attempt():
+         try:
+            return (True,transaction())
+         except OSError:
+            return (False,None)
+      return iic.poll_until(attempt,lambda result: result[0],self.ADC_TIMEOUT,spin=0,
+         interval=self.ADC_POLL_INTERVAL,max_interval=self.ADC_POLL_INTERVAL,stats=self.adc.stats)[1]
+
+   def read_all_channels(self,channels,oversample=1):
+      """Convert each (chan,diff) in channels oversample times, and return the average of each
+
+      Conversions are pipelined: the ADC's combined write/read selects the next channel
+      while reading out the previous result, and the next conversion starts right after.
+      """
+      commands=[]
+      for chan,diff in channels:
+         commands += [self.adc_command(chan,diff)]*oversample
+      totals=[0.0]*len(channels)
+
+      self.adc_retry(lambda: self.adc.write([commands[0]]))
+      for i in range(len(commands)):
+         if i+1<len(commands):
+            x=self.adc_retry(lambda: self.adc.write_read([commands[i+1]],3))
+         else:
+            x=self.adc_retry(lambda: self.adc.read(3))
+         totals[i//oversample]+=self.adc_decode(x)
+      return [total/oversample for total in totals]
+
+   def adc_read(self,chan,diff=True):
+      return self.read_all_channels([(chan,diff)])[0]
+
    def input_voltage(self):   
       return self.adc_read(0,False)+1.25
       #return self.adc_read(0,False)
 
-   def current(self,module,analog=False):   
+   def current_channel(self,module,analog=False):
       chan=(3-module)*2
       if analog: chan=chan+1
-      resistor=0.05
-      return self.adc_read(chan,True)/resistor
+      return chan
+
+   def current(self,module,analog=False):   
+      return self.adc_read(self.current_channel(module,analog),True)/self.SHUNT_RESISTOR
+
+   def snapshot(self,modules=(1,2,3),oversample=1):
+      """Input voltage and every module's analog and digital current, in one pipelined pass"""
+      channels=[(0,False)]
+      for module in modules:
+         channels.append((self.current_channel(module,True),True))
+         channels.append((self.current_channel(module,False),True))
+      values=self.read_all_channels(channels,oversample)
+
+      data={"IN_VOLTAGE":values[0]+1.25}
+      for i,module in enumerate(modules):
+         data[f'MODULE_{module}_ANALOG_CURRENT']=values[1+2*i]/self.SHUNT_RESISTOR
+         data[f'MODULE_{module}_DIGITAL_CURRENT']=values[2+2*i]/self.SHUNT_RESISTOR
+      return data
    
    def gpio_write(self,ireg,value):
       self.gpio.write([int(ireg),int(value)])
@@ -80,6 +133,92 @@ class mm_power_man:
          flags["M%d.ANALOG_OK"%(3-i)]=((stat&(1<<(i*2+1)))!=0)
       return flags
          
+
+
+class fake_power_man:
+   """Stand-in for mm_power_man with no hardware behind it, for testing clients"""
+
+   def __init__(self,device):
+      self.enabled=0
+
+   def input_voltage(self):
+      return 12.0
+
+   def current(self,module,analog=False):
+      if not self.enabled&(1<<(module-1)): return 0.0
+      return 0.65 if analog else 0.95
+
+   def set_enabled(self,imodule=0,enabled=True):
+      mask=0x7 if imodule==0 else (1<<(imodule-1))
+      if enabled:
+         self.enabled=self.enabled|mask
+      else:
+         self.enabled=self.enabled&~mask
+
+   def snapshot(self,modules=(1,2,3),oversample=1):
+      data={"IN_VOLTAGE":self.input_voltage()}
+      for module in modules:
+         data[f'MODULE_{module}_ANALOG_CURRENT']=self.current(module,True)
+         data[f'MODULE_{module}_DIGITAL_CURRENT']=self.current(module,False)
+      return data
+
+   def status_flags(self):
+      # The status register has module 3's bits first, as the hardware does
+      stat=0
+      for module in range(1,4):
+         if self.enabled&(1<<(module-1)):
+            stat=stat|(0x3<<((3-module)*2))
+      flags={}
+      for i in range(0,3):
+         flags["M%d.ENABLED"%(i+1)]=((self.enabled&(1<<i))!=0)
+         flags["M%d.DIGITAL_OK"%(3-i)]=((stat&(1<<(i*2)))!=0)
+         flags["M%d.ANALOG_OK"%(3-i)]=((stat&(1<<(i*2+1)))!=0)
+      return flags
+
+
+def status(pmanager,modules,oversample=1):
+   flags=pmanager.status_flags()
+   data=pmanager.snapshot(list(modules),oversample)
+   for module in modules:
+       data[f'MODULE_{module}_STATE']="ON" if flags["M%d.ENABLED"%module] else "OFF"
+       data[f'MODULE_{module}_ANALOG_STATE']="OK" if flags["M%d.ANALOG_OK"%module] else "OFF"
+       data[f'MODULE_{module}_DIGITAL_STATE']="OK" if flags["M%d.DIGITAL_OK"%module] else "OFF"
+   return data
+
+
+def serve(pmanager,fin=sys.stdin,fout=sys.stdout):
+   """Answer requests until the input closes, keeping the I2C handles open
+
+   Each request is one JSON object per line, such as {"command": "status", "module": 1}.
+   Commands are status, on, off and ping; module is optional and defaults to all.
+   Status also takes an optional oversample count.
+   Each response is one JSON object per line, with "ok" and either "data" or "error".
+   """
+   for line in iter(fin.readline,""):
+      line=line.strip()
+      if not line: continue
+      try:
+         request=json.loads(line)
+         command=request.get("command")
+         module=request.get("module")
+         if command=="status":
+            oversample=request.get("oversample",1)
+            response={"ok":True,"data":status(pmanager,range(1,4) if module is None else [module],oversample)}
+         elif command in ("on","off"):
+            if module is None:
+               pmanager.set_enabled(enabled=(command=="on"))
+            else:
+               pmanager.set_enabled(imodule=module,enabled=(command=="on"))
+            response={"ok":True}
+         elif command=="ping":
+            response={"ok":True}
+         else:
+            response={"ok":False,"error":"Unknown command %s"%command}
+      except Exception as e:
+         response={"ok":False,"error":str(e)}
+      fout.write(json.dumps(response)+"\n")
+      fout.flush()
+
    
 if __name__ == "__main__":
    parser=argparse.ArgumentParser(description="Simplistic MM power tray interface")
@@ -88,20 +227,19 @@ if __name__ == "__main__":
    parser.add_argument('--module',choices=[1,2,3],type=int,default=None,help='Module choice')
    parser.add_argument('--on',action='store_true',help='Turn all modules or the given module on')
    parser.add_argument('--off',action='store_true',help='Turn all modules or the given module off')
+   parser.add_argument('--oversample',type=int,default=1,help='Conversions averaged per ADC channel for --status')
+   parser.add_argument('--server',action='store_true',help='Answer JSON requests on stdin until it closes')
+   parser.add_argument('--fake',action='store_true',help='Use a stand-in power manager with no hardware')
 
    args=parser.parse_args()
-   pmanager=mm_power_man(args.device)
+   pmanager=fake_power_man(args.device) if args.fake else mm_power_man(args.device)
+
+   if args.server:
+      serve(pmanager)
+      sys.exit(0)
 
    if args.status:
-      flags=pmanager.status_flags()
-      data = { "IN_VOLTAGE": pmanager.input_voltage() }
-      for module in (range(1,4) if args.module is None else [args.module]):
-          data[f'MODULE_{module}_STATE']="ON" if flags["M%d.ENABLED"%module] else "OFF"
-          data[f'MODULE_{module}_ANALOG_STATE']="OK" if flags["M%d.ANALOG_OK"%module] else "OFF"
-          data[f'MODULE_{module}_ANALOG_CURRENT']=pmanager.current(module,True)
-          data[f'MODULE_{module}_DIGITAL_STATE']="OK" if flags["M%d.DIGITAL_OK"%module] else "OFF"
-          data[f'MODULE_{module}_DIGITAL_CURRENT']=pmanager.current(module,False)
-      print(json.dumps(data))
+      print(json.dumps(status(pmanager,range(1,4) if args.module is None else [args.module],args.oversample)))
    if args.on or args.off:
       if args.module is None:
          pmanager.set_enabled(enabled=args.on)
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+"""Stand-in for the upload endpoint, storing what the GUI uploads in a local directory
+
+Speaks the protocol of flows/assembled_electrical/uploader.py:
+
+    POST  /records          {"records": [{"hash", "record"}]}, appended to records.ndjson once each
+    HEAD  /blobs/<sha256>   Upload-Offset: bytes received, Upload-Complete: 1 once whole
+    PATCH /blobs/<sha256>   a chunk at Upload-Offset, of a file of Upload-Length bytes,
+                            answering Upload-Offset, and Upload-Complete: 1 once whole
+
+Completed files are checked against their hash and kept as blobs/<sha256>. --fail
+answers that fraction of requests with an error, for testing retries:
+
+    python upload_server.py --dir ./uploads --port 8090 --fail 0.2
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import threading
+
+blob_pattern = re.compile(r"^/blobs/([0-9a-f]{64})$")
+
+class UploadHandler(http.server.BaseHTTPRequestHandler):
+    def blob_paths(self, digest):
+        blobs = os.path.join(self.server.directory, "blobs")
+        return os.path.join(blobs, digest), os.path.join(blobs, digest + ".partial")
+
+    def reply(self, code, headers=None, body=b""):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def failing(self):
+        if random.random() < self.server.fail:
+            self.reply(503)
+            return True
+        return False
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.failing():
+            return
+        if self.path != "/records":
+            return self.reply(404)
+
+        stored = []
+        with self.server.lock:
+            with open(os.path.join(self.server.directory, "records.ndjson"), "a") as fout:
+                for entry in json.loads(body)["records"]:
+                    if entry["hash"] in self.server.record_hashes:
+                        continue
+                    fout.write(json.dumps(entry) + "\n")
+                    self.server.record_hashes.add(entry["hash"])
+                    stored.append(entry["hash"])
+        self.reply(200, { "Content-Type": "application/json" }, json.dumps({ "stored": stored }).encode())
+
+    def do_HEAD(self):
+        match = blob_pattern.match(self.path)
+        if match is None:
+            return self.reply(404)
+        complete, partial = self.blob_paths(match.group(1))
+        if os.path.exists(complete):
+            return self.reply(200, { "Upload-Offset": os.path.getsize(complete), "Upload-Complete": 1 })
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        self.reply(200, { "Upload-Offset": offset, "Upload-Complete": 0 })
+
+    def do_PATCH(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        match = blob_pattern.match(self.path)
+        if match is None:
+            return self.reply(404)
+        if self.failing():
+            return
+        digest = match.group(1)
+        complete, partial = self.blob_paths(digest)
+
+        with self.server.lock:
+            if os.path.exists(complete):
+                return self.reply(204, { "Upload-Offset": os.path.getsize(complete), "Upload-Complete": 1 })
+            offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+            if int(self.headers["Upload-Offset"]) != offset:
+                return self.reply(409, { "Upload-Offset": offset })
+
+            with open(partial, "ab") as fout:
+                fout.write(body)
+            offset += len(body)
+
+            if offset >= int(self.headers["Upload-Length"]):
+                sha = hashlib.sha256()
+                with open(partial, "rb") as fin:
+                    for block in iter(lambda: fin.read(1024 * 1024), b""):
+                        sha.update(block)
+                if sha.hexdigest() != digest:
+                    os.remove(partial)
+                    return self.reply(422)
+                os.replace(partial, complete)
+                print(f"Received {self.headers.get('Upload-Name')} ({offset} bytes) as {digest}")
+                return self.reply(204, { "Upload-Offset": offset, "Upload-Complete": 1 })
+        self.reply(204, { "Upload-Offset": offset, "Upload-Complete": 0 })
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in upload endpoint")
+    parser.add_argument("--dir", default="./uploads", help="Directory to keep uploads in")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--fail", type=float, default=0, help="Fraction of requests to fail")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(args.dir, "blobs"), exist_ok=True)
+    server = http.server.ThreadingHTTPServer(("", args.port), UploadHandler)
+    server.directory = args.dir
+    server.fail = args.fail
+    server.lock = threading.Lock()
+    server.record_hashes = set()
+    records = os.path.join(args.dir, "records.ndjson")
+    if os.path.exists(records):
+        with open(records) as fin:
+            server.record_hashes = { json.loads(line)["hash"] for line in fin if line.strip() }
+
+    print(f"Storing uploads in {args.dir}, listening on port {args.port}")
+    server.serve_forever()
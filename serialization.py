@@ -0,0 +1,171 @@
+import collections
+import datetime
+import enum
+import json
+import logging
+import sys
+
+import msgpack
+import numpy as np
+
+logger = logging.getLogger("serialization")
+
+# Test results as msgpack, with extension types for the values steps return that
+# neither msgpack nor JSON know. Anything else is written as its text, so writing
+# results never fails. to_json converts the results back to JSON for people to read
+
+EXT_ENUM = 1
+EXT_NDARRAY = 2
+EXT_DATETIME = 3
+EXT_ERROR = 4
+EXT_OTHER = 5
+
+# Decoded enums whose class is not loaded, and values that could only be kept as text
+EnumValue = collections.namedtuple("EnumValue", ["type", "name", "value"])
+StepError = collections.namedtuple("StepError", ["type", "message"])
+Unserializable = collections.namedtuple("Unserializable", ["type", "text"])
+
+def type_name(value: object) -> str:
+    return f"{type(value).__module__}.{type(value).__qualname__}"
+
+def pack_value(value: object) -> bytes:
+    return msgpack.packb(value, default=encode, use_bin_type=True)
+
+def unpack_value(data: bytes) -> object:
+    return msgpack.unpackb(data, ext_hook=decode, raw=False, strict_map_key=False)
+
+def encode(value: object) -> msgpack.ExtType:
+    if isinstance(value, enum.Enum):
+        return msgpack.ExtType(EXT_ENUM, pack_value([type_name(value), value.name, value.value]))
+    if isinstance(value, (np.ndarray, np.generic)):
+        array = np.asarray(value)
+        dtype = array.dtype.descr if array.dtype.names is not None else array.dtype.str
+        if array.dtype.hasobject:
+            return msgpack.ExtType(EXT_OTHER, pack_value([type_name(value), array.tolist()]))
+        return msgpack.ExtType(EXT_NDARRAY, pack_value([dtype, list(array.shape), np.ascontiguousarray(array).tobytes()]))
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return msgpack.ExtType(EXT_DATETIME, pack_value([type(value).__name__, value.isoformat()]))
+    if isinstance(value, BaseException):
+        return msgpack.ExtType(EXT_ERROR, pack_value([type_name(value), str(value)]))
+    if isinstance(value, (tuple, set, frozenset)):
+        return list(value)
+
+    logger.warning(f"Writing a {type_name(value)} as text")
+    return msgpack.ExtType(EXT_OTHER, pack_value([type_name(value), str(value)]))
+
+def decode(code: int, data: bytes) -> object:
+    fields = unpack_value(data)
+    if code == EXT_ENUM:
+        return load_enum(*fields)
+    if code == EXT_NDARRAY:
+        dtype, shape, buffer = fields
+        dtype = np.dtype([structured_field(field) for field in dtype]) if isinstance(dtype, list) else np.dtype(dtype)
+        array = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+        return array[()] if len(shape) == 0 else array.copy()
+    if code == EXT_DATETIME:
+        kind, text = fields
+        return getattr(datetime, kind).fromisoformat(text)
+    if code == EXT_ERROR:
+        return StepError(*fields)
+    if code == EXT_OTHER:
+        return Unserializable(*fields)
+    logger.warning(f"Unknown extension type {code}")
+    return msgpack.ExtType(code, data)
+
+# A field of a structured dtype's descr, which msgpack turned from tuples into lists
+def structured_field(field: list) -> tuple:
+    if len(field) > 2:
+        return (field[0], field[1], tuple(field[2]))
+    return (field[0], field[1])
+
+# The enum itself if its class is loaded, never importing anything to find it
+def load_enum(name: str, member: str, value: object) -> object:
+    module, _, qualname = name.rpartition(".")
+    target = sys.modules.get(module)
+    for part in qualname.split("."):
+        target = getattr(target, part, None)
+    if isinstance(target, type) and issubclass(target, enum.Enum) and member in target.__members__:
+        return target[member]
+    return EnumValue(name, member, value)
+
+def dump(value: object, path: str) -> None:
+    with open(path, "wb") as fout:
+        fout.write(pack_value(value))
+
+def load(path: str) -> object:
+    with open(path, "rb") as fin:
+        return unpack_value(fin.read())
+
+# JSON for a decoded value, with the extension types as tagged objects so nothing is lost
+# Non-string map keys (eg. the test stages of debug records) become their names or text
+def to_json(value: object) -> object:
+    if isinstance(value, dict):
+        return { json_key(key): to_json(item) for key, item in value.items() }
+    if isinstance(value, EnumValue):
+        return { "__enum__": value.type, "name": value.name, "value": to_json(value.value) }
+    if isinstance(value, enum.Enum):
+        return { "__enum__": type_name(value), "name": value.name, "value": to_json(value.value) }
+    if isinstance(value, StepError):
+        return { "__error__": value.type, "message": value.message }
+    if isinstance(value, BaseException):
+        return { "__error__": type_name(value), "message": str(value) }
+    if isinstance(value, Unserializable):
+        return { "__text__": value.type, "text": to_json(value.text) }
+    if isinstance(value, (np.ndarray, np.generic)):
+        array = np.asarray(value)
+        if array.dtype.names is not None:
+            fields = { name: array[name].tolist() for name in array.dtype.names }
+            return { "__ndarray__": array.dtype.descr, "shape": list(array.shape), "fields": fields }
+        return { "__ndarray__": array.dtype.str, "shape": list(array.shape), "data": array.tolist() }
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return { "__" + type(value).__name__ + "__": value.isoformat() }
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    return value
+
+# The values to_json tagged, back from its JSON (eg. a journal's records)
+def from_json(value: object) -> object:
+    if isinstance(value, list):
+        return [from_json(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "__enum__" in value:
+        return load_enum(value["__enum__"], value["name"], from_json(value["value"]))
+    if "__error__" in value:
+        return StepError(value["__error__"], value["message"])
+    if "__text__" in value:
+        return Unserializable(value["__text__"], value["text"])
+    if "__ndarray__" in value:
+        if "fields" in value:
+            array = np.empty(value["shape"], dtype=np.dtype([structured_field(field) for field in value["__ndarray__"]]))
+            for name, items in value["fields"].items():
+                array[name] = items
+            return array
+        array = np.array(value["data"], dtype=np.dtype(value["__ndarray__"])).reshape(value["shape"])
+        return array[()] if len(value["shape"]) == 0 else array
+    for kind in ["datetime", "date", "time"]:
+        if "__" + kind + "__" in value:
+            return getattr(datetime, kind).fromisoformat(value["__" + kind + "__"])
+    return { key: from_json(item) for key, item in value.items() }
+
+def json_key(key: object) -> str:
+    if isinstance(key, (enum.Enum, EnumValue)):
+        return key.name
+    return key if isinstance(key, str) else str(key)
+
+# For json.dump's default, eg. json.dumps(value, default=json_default)
+def json_default(value: object) -> object:
+    converted = to_json(value)
+    return converted if converted is not value else str(value)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python serialization.py <output.msgpack> [output.json]")
+        sys.exit(1)
+
+    output = to_json(load(sys.argv[1]))
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "w") as fout:
+            json.dump(output, fout, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
@@ -145,8 +145,8 @@ class VerifyStep(TestStep):
 
 # A step that shows a dropdown with options and asks for one
 class SelectStep(TestStep):
-    def __init__(self, name: str, message: str, options: list[str]) -> None:
-        super().__init__(name)
+    def __init__(self, name: str, message: str, options: list[str], data_field: str = None) -> None:
+        super().__init__(name, data_field)
         self._message = message
         self._options = options
 
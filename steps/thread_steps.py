@@ -4,6 +4,10 @@ from PyQt6.QtGui import QPixmap
 
 from objects import TestStep, TestWidget
 
+import log_utils
+
+from collections.abc import Mapping
+
 import glob
 import traceback
 import os
@@ -166,6 +170,10 @@ class DynamicThread(QThread):
         self._data = data
     
     def run(self):
+        # Attribute this thread's logs to the slot running the step
+        if isinstance(self._data, Mapping) and "_slot" in self._data:
+            log_utils.set_slot(self._data["_slot"])
+
         try:
             result = self._method(self._data)
             self.data.emit(result)
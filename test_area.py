@@ -4,12 +4,26 @@ from misc_widgets import QHLine
 from objects import TestFlow, TestStage, TestWidget, TestFinishedBehavior
 
 import datetime
+import functools
 import logging
 import log_utils
+import time
+
+from journal import Journal
+
+from test_data import TestDataStore
 
 
 logger = logging.getLogger("testing")
 
+# Tag logs emitted while handling a slot's events with that slot
+def slot_logging(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with log_utils.slot_context(self._slot):
+            return method(self, *args, **kwargs)
+    return wrapper
+
 # This contains all the LEDs
 class StatusWidget(QWidget):
     def __init__(self, flow: TestFlow) -> None:
@@ -102,20 +116,23 @@ class InteractionAreaWidget(QFrame):
         self._current_widget = widget
 
 # The main test area, which handles everything
+# Slot names a test station when several run in one process
 class TestArea(QWidget):
-    def __init__(self, flow: TestFlow) -> None:
+    def __init__(self, flow: TestFlow, slot: str = None) -> None:
         super().__init__()
         # Logs
-        logger.info("Created Test Area.")
+        logger.info(f"Created Test Area for slot {slot}.")
         logger.info(f"Using flow {flow}")
 
         # Initial Variables
+        self._slot = slot
         self._flow = flow
         self._status = StatusWidget(flow)
         self._stage = TestStage.SETUP
         self._index = 0
         self._interaction = InteractionAreaWidget()
-        self._test_data = {}
+        self._test_data = TestDataStore()
+        self._journal = None
         
         # Layout, Status, Interaction Area
         layout = QHBoxLayout()
@@ -126,7 +143,7 @@ class TestArea(QWidget):
         status_layout = QHBoxLayout()
         status_layout.setContentsMargins(0, 0, 0, 0)
         status_layout.addWidget(self._status)
-        status_layout.addWidget(flow.get_watcher(lambda: self._test_data))
+        status_layout.addWidget(flow.get_watcher(lambda: self._test_data.snapshot()))
 
         status_frame.setFrameShape(QFrame.Shape.StyledPanel)
         status_frame.setFrameShadow(QFrame.Shadow.Raised)
@@ -142,19 +159,63 @@ class TestArea(QWidget):
         self.update_input_area("Starting Over")
 
     # Start a new test!
+    @slot_logging
     def start_new_test(self):
         # Wipe Logs
         logger.info("Starting New Test. Clearing Logs...")
-        log_utils.logs = []
+        log_utils.clear_logs(self._slot)
         logger.info("Starting New Test. Logs Cleared.")
 
         self._stage = TestStage.SETUP
         self._index = 0
-        self._test_data = {}
+        # Debug records of each step, by stage and step name, written out by cleanup
         self._debug_data = {}
+        self._test_data = TestDataStore({ "_slot": self._slot, "_debug": self._debug_data })
+
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = None
+        self._journal_pending = []
+        self._step_started = time.time()
+
+    # Append a record of the current step to the test's journal
+    # Records are held until the flow knows where the journal goes, then written in order
+    def journal(self, record_type: str, data: dict = None, **fields) -> None:
+        current_step = self._flow.get_steps(self._stage)[self._index]
+        record = {
+            "type": record_type,
+            "stage": self._stage.name,
+            "step": current_step.get_name(),
+            "time": datetime.datetime.now().isoformat(),
+            "duration": time.time() - self._step_started,
+            **fields
+        }
+        if data is not None:
+            record["data"] = { key: value for key, value in data.items() if not str(key).startswith("_") }
+        self._journal_pending.append(record)
+
+        if self._journal is None:
+            path = self._flow.get_journal_path(self._test_data.snapshot())
+            if path is None:
+                return
+            try:
+                self._journal = Journal(path)
+            except Exception as e:
+                logger.critical(f"Could not open journal {path}: {e}")
+                return
+            self._test_data["_journal"] = self._journal
+            logger.info(f"Journaling test to {path}")
+
+        for pending in self._journal_pending:
+            try:
+                self._journal.append(pending)
+            except Exception as e:
+                logger.critical(f"Could not write to journal {self._journal.path}: {e}")
+        self._journal_pending = []
 
     # A step crashed with an error
     # Process that, skip to cleanup
+    @slot_logging
     def step_crashed(self, error):
         logger.critical(f"Stage {self._stage} step ID {self._index} crashed with error {error}")
         current_step = self._flow.get_steps(self._stage)[self._index]
@@ -169,6 +230,8 @@ class TestArea(QWidget):
             "time_finished": datetime.datetime.now()
         }
 
+        self.journal("crash", error=str(error))
+
         self.handle_output_action({
             "color": "red",
             "message": f"Step crashed (See Console)",
@@ -177,6 +240,7 @@ class TestArea(QWidget):
 
     # A step finished with data.
     # Process that data, then call the advance step function
+    @slot_logging
     def step_finished(self, data):
         logger.debug(f"Stage {self._stage} step ID {self._index} finished.")
         current_step = self._flow.get_steps(self._stage)[self._index]
@@ -184,20 +248,26 @@ class TestArea(QWidget):
         # Log Data
         # Case: Returned "EXPLODE data"
         data_field = current_step.get_data_field()
+        written = {}
         if type(data) == dict and "_explode" in data and data["_explode"]:
             logger.debug(f"Step {current_step.get_name()} returned data {data}.")
             logger.debug(f"Ignoring data field!")
 
+            # Published as one snapshot, so readers never see half a step's output
+            exploded = {}
             for key in data:
                 if key == "_explode":
                     pass
                 value = data[key]
 
                 logger.debug(f"Assigning key {key} and data {value}")
-                self._test_data[key] = value
+                exploded[key] = value
+            self._test_data.update(exploded)
+            written = exploded
         elif data_field != None:
             logger.debug(f"Step {current_step.get_name()} returned data {data}. Assigning to {data_field}")
             self._test_data[data_field] = data
+            written = { data_field: data }
         elif data != None:
             logger.critical(f"Step {current_step.get_name()} returned data {data} but isn't exploded and doesn't have a data field!")
 
@@ -210,8 +280,10 @@ class TestArea(QWidget):
             "time_finished": datetime.datetime.now()
         }
 
+        self.journal("step", written)
+
         # Update LEDs
-        action = current_step.get_output_action(self._test_data, data)
+        action = current_step.get_output_action(self._test_data.snapshot(), data)
 
         # Convert non-object actions
         if type(action) == bool:
@@ -238,6 +310,7 @@ class TestArea(QWidget):
         self.handle_output_action(action)
         
     # Handle an output action
+    @slot_logging
     def handle_output_action(self, action):
         self._status.set_message(self._stage, self._index, action['message'], action["color"])
 
@@ -303,6 +376,7 @@ class TestArea(QWidget):
                 self.start_new_test()
 
     # Call this method whenever self._stage or self._index is updated
+    @slot_logging
     def update_input_area(self, reason: str) -> None:
         logger.debug(f"Updating input with reason {reason}")
 
@@ -315,7 +389,8 @@ class TestArea(QWidget):
         logger.info(f"Loading widget with test data {self._test_data}")
 
         # Load New Widget
-        widget = step.create_widget(self._test_data)
+        self._step_started = time.time()
+        widget = step.create_widget(self._test_data.snapshot())
         widget.finished.connect(self.step_finished)
         widget.crashed.connect(self.step_crashed)
         widget.advance.connect(self.update_input_area)
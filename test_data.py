@@ -0,0 +1,100 @@
+from collections.abc import Mapping
+
+import itertools
+import threading
+
+# Every store gets its own id, so readers can tell one test's snapshots from the next's
+test_ids = itertools.count(1)
+
+# The prefix of a key is the part before the first ":", so eg. every
+# PEDESTAL_RUN:* key shares one bucket and one version counter
+# Underscored keys like _ARRAYS:PEDESTAL_RUN hold something of the prefix after them,
+# so each is its own prefix, changing only with what it's about
+def prefix(key) -> str:
+    if not isinstance(key, str):
+        return key
+    return key if key.startswith("_") else key.split(":", 1)[0]
+
+# A read-only view of test data at one moment
+# Snapshots are never changed once published, so any thread can read one
+# without locking. Keys are stored in one bucket per prefix
+class TestDataSnapshot(Mapping):
+    __slots__ = ("_buckets", "_versions", "_length", "_version", "test_id")
+
+    def __init__(self, buckets: dict, versions: dict, length: int, version: int, test_id: int) -> None:
+        self._buckets = buckets
+        self._versions = versions
+        self._length = length
+        self._version = version
+        self.test_id = test_id
+
+    def __getitem__(self, key) -> object:
+        return self._buckets[prefix(key)][key]
+
+    def __contains__(self, key) -> bool:
+        bucket = self._buckets.get(prefix(key))
+        return bucket is not None and key in bucket
+
+    def __iter__(self):
+        for bucket in self._buckets.values():
+            yield from bucket
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+    # Changes each time a key starting with prefix is set, or with no prefix, each time any key is
+    def version(self, prefix: str = None) -> int:
+        if prefix is None:
+            return self._version
+        return self._versions.get(prefix, 0)
+
+# The data of one test, written by the test area as steps finish
+# Each write publishes a new snapshot sharing every bucket but the ones written to,
+# so it costs the size of those buckets, not of the whole test
+class TestDataStore:
+    def __init__(self, initial: dict = None) -> None:
+        self._lock = threading.Lock()
+        self._snapshot = TestDataSnapshot({}, {}, 0, 0, next(test_ids))
+        if initial is not None:
+            self.update(initial)
+
+    # The current data. Cheap, and safe to hold on to from any thread
+    def snapshot(self) -> TestDataSnapshot:
+        return self._snapshot
+
+    # Set several keys at once, publishing one snapshot for all of them
+    def update(self, items: dict) -> None:
+        with self._lock:
+            current = self._snapshot
+            buckets = dict(current._buckets)
+            versions = dict(current._versions)
+            length = current._length
+
+            copied = set()
+            for key, value in items.items():
+                key_prefix = prefix(key)
+                if key_prefix not in copied:
+                    buckets[key_prefix] = dict(buckets[key_prefix]) if key_prefix in buckets else {}
+                    versions[key_prefix] = versions.get(key_prefix, 0) + 1
+                    copied.add(key_prefix)
+
+                if key not in buckets[key_prefix]:
+                    length += 1
+                buckets[key_prefix][key] = value
+
+            self._snapshot = TestDataSnapshot(buckets, versions, length, current._version + 1, current.test_id)
+
+    def __setitem__(self, key, value) -> None:
+        self.update({ key: value })
+
+    def __getitem__(self, key) -> object:
+        return self._snapshot[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._snapshot
+
+    def __repr__(self) -> str:
+        return repr(self._snapshot)
@@ -0,0 +1,167 @@
+from PyQt6.QtCore import QThread, pyqtSignal
+
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+import threading
+import time
+import traceback
+
+logger = logging.getLogger("watcher")
+
+# One thing the watcher keeps an eye on
+# probe(data) returns a dict of status entries, and runs every interval seconds
+# while active(data) is true. While inactive, idle is shown instead and probe isn't run
+# A probe that raises, or takes longer than timeout, shows error and is retried
+# with its interval doubled each time, up to max_backoff
+class Probe:
+    def __init__(self, name: str, probe, interval: float, timeout: float = None,
+                 active=None, idle: dict = None, error: dict = None, max_backoff: float = 30) -> None:
+        self.name = name
+        self.probe = probe
+        self.interval = interval
+        self.timeout = timeout
+        self.active = active
+        self.idle = idle if idle is not None else {}
+        self.error = error if error is not None else {}
+        self.max_backoff = max_backoff
+
+        self.reset()
+
+    def reset(self) -> None:
+        self.failures = 0
+        self.next_run = 0
+        self.future = None
+        self.started = 0
+        self.timed_out = False
+
+    def is_active(self, data: object) -> bool:
+        return self.active is None or self.active(data)
+
+    def schedule(self, now: float, failed: bool) -> None:
+        self.failures = self.failures + 1 if failed else 0
+        delay = min(self.interval * 2 ** self.failures, max(self.interval, self.max_backoff))
+        self.next_run = now + delay
+
+# A persistent thread running each probe on its own schedule
+# Only status entries that changed since the last emit are sent out,
+# with None for entries that no longer have a value
+class WatcherService(QThread):
+    output = pyqtSignal(object)
+
+    def __init__(self, fetch_data, probes: list[Probe]) -> None:
+        super().__init__()
+        self.fetch_data = fetch_data
+        self.probes = probes
+
+        self._wake = threading.Event()
+        self._stopped = False
+        self._data_id = None
+        self._results = { probe.name: {} for probe in probes }
+        self._shown = {}
+        # Slow probes don't hold up the others
+        self._executor = ThreadPoolExecutor(max_workers=len(probes), thread_name_prefix="probe")
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wake.set()
+
+    # Run every probe again now, eg. after something changed that they watch
+    def poke(self) -> None:
+        for probe in self.probes:
+            probe.next_run = 0
+        self._wake.set()
+
+    def run(self) -> None:
+        while not self._stopped:
+            try:
+                wait = self.tick()
+            except Exception as e:
+                logger.critical(f"Exception in watcher: {e}\n{traceback.format_exc()}")
+                wait = 1
+            self._wake.wait(wait)
+            self._wake.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # Collect finished probes, start due ones, and emit changes
+    # Returns how long to sleep until something is due again
+    def tick(self) -> float:
+        data = self.fetch_data()
+        now = time.time()
+
+        # A new test starts every probe over
+        test_id = data.test_id if hasattr(data, "test_id") else id(data)
+        if test_id != self._data_id:
+            self._data_id = test_id
+            for probe in self.probes:
+                probe.reset()
+
+        wake = now + 1
+        for probe in self.probes:
+            if probe.future is not None:
+                if probe.future.done():
+                    self.collect(probe, now)
+                elif not probe.timed_out and probe.timeout is not None and now - probe.started > probe.timeout:
+                    logger.warning(f"Probe {probe.name} timed out after {probe.timeout}s")
+                    probe.timed_out = True
+                    self._results[probe.name] = probe.error
+                    probe.schedule(now, True)
+                elif not probe.timed_out and probe.timeout is not None:
+                    wake = min(wake, probe.started + probe.timeout)
+
+            if not probe.is_active(data):
+                self._results[probe.name] = probe.idle
+                probe.next_run = 0
+                continue
+
+            # A probe still running (even one given up on) isn't started twice
+            if probe.future is None and now >= probe.next_run:
+                probe.started = now
+                probe.timed_out = False
+                probe.future = self._executor.submit(probe.probe, data)
+                self._wake_when_done(probe.future)
+            elif probe.future is None:
+                wake = min(wake, probe.next_run)
+
+        self.emit_changes()
+        return max(0, wake - time.time())
+
+    def _wake_when_done(self, future) -> None:
+        future.add_done_callback(lambda _: self._wake.set())
+
+    def collect(self, probe: Probe, now: float) -> None:
+        future = probe.future
+        probe.future = None
+        try:
+            result = future.result()
+            failed = False
+        except Exception as e:
+            logger.critical(f"Probe {probe.name} failed with {e}\n{traceback.format_exc()}")
+            result = probe.error
+            failed = True
+
+        # A late answer from a probe that timed out is still used, but its backoff stands
+        if probe.timed_out:
+            if not failed:
+                probe.failures = 0
+            probe.timed_out = False
+        else:
+            probe.schedule(now, failed)
+        self._results[probe.name] = result
+
+    def emit_changes(self) -> None:
+        status = {}
+        for result in self._results.values():
+            status.update(result)
+
+        changes = {}
+        for key, value in status.items():
+            if key not in self._shown or self._shown[key] != value:
+                changes[key] = value
+        for key in self._shown:
+            if key not in status:
+                changes[key] = None
+
+        self._shown = status
+        if len(changes) > 0:
+            self.output.emit(changes)